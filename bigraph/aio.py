@@ -0,0 +1,195 @@
+import os
+import time
+import shutil
+import signal
+import asyncio
+import tempfile
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+from bigraph.bigraph import ram_directory, check_systems
+
+
+class AsyncBigrapher():
+    '''run bigrapher from an asyncio event loop.
+
+    at most `concurrency` bigrapher processes run at once. writing the model
+    and reading and decoding the states happen on a thread pool, so the loop
+    is never blocked on files or json. cancelling a task that is waiting on
+    bigrapher kills the child process'''
+
+    def __init__(self, concurrency=None, executor=None):
+        self.concurrency = concurrency or os.cpu_count() or 1
+        self.executor = executor or ThreadPoolExecutor(max_workers=self.concurrency)
+        self.semaphore = None
+        self.running = set()
+
+    def limit(self):
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.concurrency)
+        return self.semaphore
+
+    async def offload(self, function, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor,
+            lambda: function(*args, **kwargs))
+
+    async def execute(
+            self,
+            system,
+            path=None,
+            key=None,
+            subcommand='sim',
+            format='json',
+            steps=None,
+            console=False):
+
+        command = system.command(
+            path=path,
+            key=key,
+            subcommand=subcommand,
+            format=format,
+            steps=steps)
+
+        async with self.limit():
+            process = await asyncio.create_subprocess_exec(
+                *[str(token) for token in command],
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE)
+            self.running.add(process)
+            try:
+                output, error = await process.communicate()
+            except asyncio.CancelledError:
+                if process.returncode is None:
+                    process.kill()
+                    await process.wait()
+                raise
+            finally:
+                self.running.discard(process)
+
+        if console:
+            print(' '.join([str(token) for token in command]))
+            print('\n\n\n')
+            print(output)
+            print('\n\n\n')
+            print(error)
+            print('\n\n\n')
+
+        return process.returncode
+
+    async def read(self, system, path=None, key=None, format='json'):
+        ''' every state of the last run, decoded on the thread pool '''
+        def load():
+            with system.read(path=path, key=key, format=format) as trajectory:
+                return trajectory.load(workers=1)
+
+        return await self.offload(load)
+
+    async def simulate(
+            self,
+            system,
+            path=None,
+            key=None,
+            subcommand='sim',
+            format=('json', 'svg'),
+            steps=None,
+            console=False,
+            pipe=False):
+        ''' the counterpart of `BigraphicalReactiveSystem.simulate`, including its `pipe` mode '''
+
+        system.check()
+        key = key or system.key
+        if pipe:
+            directory = Path(await self.offload(tempfile.mkdtemp, prefix='bigraph-', dir=ram_directory()))
+            format = 'json'
+        else:
+            directory = Path(path or system.path)
+
+        try:
+            await self.offload(system.write, path=directory, key=key)
+            await self.execute(
+                system,
+                path=directory,
+                key=key,
+                subcommand=subcommand,
+                format=format,
+                steps=steps,
+                console=console)
+            return await self.read(system, path=directory, key=key)
+        finally:
+            if pipe:
+                await self.offload(shutil.rmtree, directory, ignore_errors=True)
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+
+async def simulate_all(systems, steps=None, concurrency=None, pipe=True):
+    ''' simulate each of `systems` concurrently, returning their trajectories in order '''
+    check_systems(systems)
+    bigrapher = AsyncBigrapher(concurrency=concurrency)
+    try:
+        return await asyncio.gather(*[
+            bigrapher.simulate(system, steps=steps, format='json', pipe=pipe)
+            for system in systems])
+    finally:
+        bigrapher.close()
+
+
+def test_async_bigrapher(tmp_path):
+    from bigraph.fake import fake_system, fake_environment
+
+    path = tmp_path
+    system = fake_system(path)
+    system.path = Path(path) / 'system'
+
+    async def concurrent():
+        bigrapher = AsyncBigrapher(concurrency=2)
+        peak = 0
+
+        async def watch():
+            nonlocal peak
+            while True:
+                peak = max(peak, len(bigrapher.running))
+                await asyncio.sleep(0.01)
+
+        watcher = asyncio.create_task(watch())
+        histories = await asyncio.gather(*[
+            bigrapher.simulate(system, steps=steps, pipe=True)
+            for steps in range(5)])
+        watcher.cancel()
+        bigrapher.close()
+        return histories, peak
+
+    with fake_environment(delay=0.2):
+        histories, peak = asyncio.run(concurrent())
+    assert [len(history) for history in histories] == [1, 2, 3, 4, 5]
+    assert histories[4][-1].render() == 'Step(4)'
+    assert peak == 2
+    assert not system.path.exists()
+
+    async def cancelled():
+        bigrapher = AsyncBigrapher(concurrency=1)
+        task = asyncio.create_task(bigrapher.simulate(system, steps=1, pipe=True))
+        while not bigrapher.running:
+            await asyncio.sleep(0.01)
+        process = next(iter(bigrapher.running))
+        start = time.perf_counter()
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        bigrapher.close()
+        return process, time.perf_counter() - start
+
+    with fake_environment(delay=30):
+        process, elapsed = asyncio.run(cancelled())
+    assert process.returncode == -signal.SIGKILL
+    assert elapsed < 5
+
+
+if __name__ == '__main__':
+    import fire
+    fire.Fire(test_async_bigrapher)
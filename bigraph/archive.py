@@ -0,0 +1,218 @@
+import os
+import mmap
+import json
+import time
+import zlib
+import struct
+from array import array
+from pathlib import Path
+
+from bigraph.graph import TransitionGraph, TRANSITION_FIELDS
+
+
+MAGIC = b'BIGP'
+VERSION = 1
+
+# magic, version, kind, states, transitions, length of the labels
+HEADER = struct.Struct('<4sHHQQQ')
+OFFSET = struct.Struct('<Q')
+
+KINDS = list(TRANSITION_FIELDS)
+
+# the files bigrapher may write for each state
+STATE_FORMATS = ['json', 'txt', 'svg']
+
+
+def archive_path(path, key='system'):
+    return Path(path) / f'{key}.pack'
+
+
+def pack(path, key='system', archive=None, level=6, remove=False):
+    '''pack the states and transitions bigrapher wrote to `path` into the
+    single file `archive`, by default `{path}/{key}.pack`.
+
+    the file is a header, the labels of the states and the reactions of the
+    transitions, the transitions as compressed sparse row arrays, a table of
+    the offset of every state, and then each state's json compressed on its
+    own, so any one state is read without touching the others. only the json
+    of the states is packed. with `remove` the transitions and every file of
+    the states, in any of bigrapher's formats, are deleted once the archive
+    is written'''
+
+    path = Path(path)
+    archive = Path(archive or archive_path(path, key))
+    graph = TransitionGraph.load(path, key=key)
+
+    reactions = graph.reactions if any(reaction is not None for reaction in graph.reactions) else None
+    labels = zlib.compress(json.dumps({
+        'labels': graph.labels,
+        'reactions': reactions}).encode('utf-8'), level)
+
+    records = []
+    for state in range(len(graph)):
+        with open(graph.state_path(state), 'rb') as state_file:
+            records.append(zlib.compress(state_file.read(), level))
+
+    partial = archive.with_suffix('.partial')
+    with open(partial, 'wb') as archive_file:
+        archive_file.write(HEADER.pack(
+            MAGIC,
+            VERSION,
+            KINDS.index(graph.kind),
+            len(graph),
+            graph.transition_count(),
+            len(labels)))
+        archive_file.write(labels)
+        archive_file.write(array('q', graph.indptr).tobytes())
+        archive_file.write(array('q', graph.targets).tobytes())
+        if graph.weights is not None:
+            archive_file.write(array('d', graph.weights).tobytes())
+        offset = 0
+        for record in records:
+            archive_file.write(OFFSET.pack(offset))
+            offset += len(record)
+        archive_file.write(OFFSET.pack(offset))
+        for record in records:
+            archive_file.write(record)
+    os.replace(partial, archive)
+
+    if remove:
+        for state in range(len(graph)):
+            for format in STATE_FORMATS:
+                state_path = graph.state_path(state, format=format)
+                if state_path.exists():
+                    os.remove(state_path)
+        os.remove(path / f'{key}.json')
+
+    return archive
+
+
+class Archive():
+    '''a packed run opened through `mmap`. `graph` holds the transitions, and
+    `state` decodes one state by its label straight from the mapped file'''
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.file = open(self.path, 'rb')
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, kind, states, transitions, length = HEADER.unpack_from(self.data, 0)
+        if magic != MAGIC:
+            raise Exception(f'{self.path} is not a packed run')
+        if version != VERSION:
+            raise Exception(f'{self.path} is packed in version {version}, but only version {VERSION} can be read')
+
+        position = HEADER.size
+        index = json.loads(zlib.decompress(self.data[position:position + length]))
+        position += length
+
+        def section(typecode, count):
+            nonlocal position
+            values = array(typecode)
+            values.frombytes(self.data[position:position + count * values.itemsize])
+            position += count * values.itemsize
+            return values
+
+        indptr = section('q', states + 1)
+        targets = section('q', transitions)
+        weights = section('d', transitions) if TRANSITION_FIELDS[KINDS[kind]] else None
+        self.graph = TransitionGraph(
+            indptr,
+            targets,
+            index['labels'],
+            weights=weights,
+            reactions=index['reactions'],
+            kind=KINDS[kind])
+        self.states = {
+            label: state
+            for state, label in enumerate(self.graph.labels)}
+        self.offsets = position
+        self.records = position + (states + 1) * OFFSET.size
+
+    def __len__(self):
+        return len(self.graph)
+
+    def state_bytes(self, label):
+        position = self.offsets + self.states[str(label)] * OFFSET.size
+        start, = OFFSET.unpack_from(self.data, position)
+        end, = OFFSET.unpack_from(self.data, position + OFFSET.size)
+        return zlib.decompress(self.data[self.records + start:self.records + end])
+
+    def state(self, label, counts=False):
+        from bigraph.trajectory import decode_bytes
+        return decode_bytes(self.state_bytes(label), counts=counts)
+
+    def close(self):
+        self.data.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+
+
+def decode_archived(path, labels, counts=False):
+    with Archive(path) as archive:
+        return [archive.state(label, counts=counts) for label in labels]
+
+
+def test_archive(tmp_path):
+    from bigraph.fake import fake_system
+
+    path = tmp_path
+    system = fake_system(path)
+    system.path = Path(path) / 'system'
+    expected = [state.render() for state in system.simulate(steps=30, format=('json', 'txt', 'svg'))]
+
+    archive = pack(system.path, remove=True)
+    assert sorted(os.listdir(system.path)) == ['system.big', 'system.pack']
+
+    with Archive(archive) as packed:
+        assert len(packed) == 31
+        assert packed.state('17').render() == 'Step(17)'
+        assert [packed.graph.labels[state] for state in packed.graph.trajectory()] == [str(step) for step in range(31)]
+
+    # read opens the archive in place of the directory, until the trajectory is closed
+    with system.read() as trajectory:
+        assert [state.render() for state in trajectory] == expected
+        assert [state.render() for state in trajectory.load(workers=2, processes=True)] == expected
+        archived = trajectory.archive
+    assert archived.data.closed and archived.file.closed
+    with system.read(stride=10) as trajectory:
+        assert [state.render() for state in trajectory] == expected[::10]
+
+
+def benchmark_archive(steps=5000, reads=1000, path='out/test/archive/benchmark'):
+    import random
+    import shutil
+    from bigraph.fake import fake_system
+
+    shutil.rmtree(path, ignore_errors=True)
+    system = fake_system(path)
+    system.path = Path(path) / 'system'
+    system.simulate(steps=steps, format='json')
+    size = sum(entry.stat().st_size for entry in os.scandir(system.path))
+    picks = [random.randrange(steps + 1) for read in range(reads)]
+
+    start = time.perf_counter()
+    trajectory = system.read(cache_size=1)
+    for pick in picks:
+        trajectory[pick]
+    print(f'directory: {steps + 2} files, {size} bytes, {reads} random states in {time.perf_counter() - start:.3f}s')
+
+    start = time.perf_counter()
+    archive = pack(system.path, remove=True)
+    print(f'packed in {time.perf_counter() - start:.3f}s')
+
+    start = time.perf_counter()
+    with system.read(cache_size=1) as trajectory:
+        for pick in picks:
+            trajectory[pick]
+    print(f'archive: 1 file, {archive.stat().st_size} bytes, {reads} random states in {time.perf_counter() - start:.3f}s')
+
+
+if __name__ == '__main__':
+    import fire
+    fire.Fire(pack)
@@ -1,27 +1,39 @@
 import os
 import copy
 import json
-import fire
+import time
+import tempfile
 import subprocess
-import networkx as nx
 from pathlib import Path
-from IPython.display import SVG, HTML, display
 
 
 AVAILABLE_OUTPUT_FORMATS = ['json', 'svg', 'txt']
+
+# memory backed filesystems used for the private directory of a pipe run
+RAM_DIRECTORIES = ['/dev/shm', '/run/shm']
 PARAMETER_SYMBOLS = 'abcdefghijklmnopqrstuvwxyz'
 
 
 def show_svg(path):
+    from IPython.display import SVG, display
     display(SVG(filename=path))
 
 
 def show_svgs(paths):
+    from IPython.display import SVG, display
     display([
         SVG(filename=path)
         for path in paths])
 
 
+def ram_directory():
+    ''' a writable memory backed directory, or `None` to use the default temporary directory '''
+    for directory in RAM_DIRECTORIES:
+        if os.path.isdir(directory) and os.access(directory, os.W_OK):
+            return directory
+    return None
+
+
 def none_index(seq):
     for index, value in enumerate(seq):
         if value is None:
@@ -177,6 +189,21 @@ class Base():
         return root
 
 
+def term_nodes(term):
+    ''' every `Node` in a term, walking through merges, parallels and nesting '''
+    stack = [term]
+    while stack:
+        term = stack.pop()
+        if isinstance(term, Node):
+            yield term
+            if term.subnodes:
+                stack.append(term.subnodes)
+        elif isinstance(term, Merge):
+            stack.extend(term.parts)
+        elif isinstance(term, Parallel):
+            stack.extend(term.parallel)
+
+
 class SequentialGenerator():
     def __init__(self, initial_count=0):
         self.count = initial_count
@@ -292,13 +319,16 @@ class Control(Base):
     def __init__(
             self,
             symbol=None,
-            arity=0,
+            arity=None,
             atomic=False,
             fun=()):
 
         super().__init__()
         self.symbol = symbol
-        self.arity = arity
+        # nodes linking more ports grow `arity`, while `declared` keeps the
+        # arity the control was given, if any, for `problems` to check
+        self.declared = arity
+        self.arity = arity or 0
         self.atomic = atomic
         self.fun = fun
             
@@ -899,7 +929,8 @@ class BigraphicalReactiveSystem(Base):
         return cls(bigraphs=[state])
 
     def ground_initial(self):
-        if self.system and self.bigraphs:
+        # a missing init bigraph is reported by `check`
+        if self.system and self.system.init and self.system.init.symbol in self.bigraphs:
             symbol = self.system.init.symbol
             self.bigraphs[symbol].ground()
 
@@ -914,24 +945,88 @@ class BigraphicalReactiveSystem(Base):
         with open(big_path, 'w') as big_file:
             big_file.write(render)
 
+    def problems(self):
+        '''mistakes in the model that bigrapher would reject, found without
+        running it: a missing system or `init` bigraph, rules and predicates
+        naming no reaction or bigraph, and nodes of undeclared controls or
+        with the wrong number of ports or params'''
+
+        problems = []
+        if self.system is None:
+            return ['no reactive system declared']
+
+        init = self.system.init
+        if init is None:
+            problems.append('no init bigraph for the system')
+        elif init.symbol not in self.bigraphs:
+            problems.append(f'init bigraph {init.symbol} is not declared')
+
+        for group in self.system.rules.rule_groups:
+            for rule in group.rules:
+                symbol = rule.symbol if isinstance(rule, Param) else rule
+                if symbol not in self.reactions:
+                    problems.append(f'rule {symbol} has no reaction')
+
+        if self.system.preds:
+            for pred in self.system.preds.rules.rules:
+                symbol = pred.symbol if isinstance(pred, Param) else pred
+                if symbol not in self.bigraphs:
+                    problems.append(f'predicate {symbol} has no bigraph')
+
+        terms = [
+            (f'bigraph {symbol}', big.root)
+            for symbol, big in self.bigraphs.items()]
+        for symbol, reaction in self.reactions.items():
+            terms.append((f'reaction {symbol}', reaction.redex))
+            terms.append((f'reaction {symbol}', reaction.reactum))
+
+        for where, term in terms:
+            for node in term_nodes(term):
+                symbol = node.symbol()
+                if symbol == '1' or symbol == 'id':
+                    continue
+                control = self.controls.get(symbol)
+                if control is None:
+                    # a name for another bigraph, used in place of a control
+                    if symbol not in self.bigraphs:
+                        problems.append(f'{where} uses control {symbol}, which is not declared')
+                    continue
+                ports = len(node.ports.edges)
+                arity = control.arity if control.declared is None else control.declared
+                if ports and ports != arity:
+                    problems.append(f'{where} links {ports} ports of {symbol}, which has arity {arity}')
+                if len(node.params) != len(control.fun):
+                    problems.append(f'{where} gives {len(node.params)} params to {symbol}, which takes {len(control.fun)}')
+
+        return problems
+
+    def check(self):
+        ''' raise the problems found by `problems`, if any, before anything is written or run '''
+        problems = self.problems()
+        if problems:
+            raise Exception(f'invalid model {self.key}:\n    ' + '\n    '.join(problems))
+
     def subcommand_options(self, subcommand, path, key, steps=None):
         command = [subcommand]
         if subcommand == 'sim':
             command.extend(['-s', '-t', path / key])
             if steps is not None:
                 command.extend(['-S', str(steps)])
+        elif subcommand == 'full':
+            command.extend(['-s', '-t', path / key])
+            if steps is not None:
+                command.extend(['-M', str(steps)])
         elif subcommand == 'validate':
             command.extend(['-s', '-t', path / key])
         return command
 
-    def execute(
+    def command(
             self,
             path=None,
             key=None,
             subcommand='sim',
             format='json',
-            steps=None,
-            console=False):
+            steps=None):
 
         if isinstance(format, str):
             format = (format,)
@@ -955,6 +1050,24 @@ class BigraphicalReactiveSystem(Base):
             ','.join(format),
             path / f'{key}.big'])
 
+        return command
+
+    def execute(
+            self,
+            path=None,
+            key=None,
+            subcommand='sim',
+            format='json',
+            steps=None,
+            console=False):
+
+        command = self.command(
+            path=path,
+            key=key,
+            subcommand=subcommand,
+            format=format,
+            steps=steps)
+
         bigrapher_process = subprocess.Popen(command, stdout=subprocess.PIPE)
         output, error = bigrapher_process.communicate()
 
@@ -966,37 +1079,52 @@ class BigraphicalReactiveSystem(Base):
             print(error)
             print('\n\n\n')
 
-    def read(self, path=None, key=None, format='json'):
+        return output
+
+    def read(self, path=None, key=None, format='json', stride=1, last_n=None, cache_size=None, counts=False, intern=None):
+        '''the trajectory of the last run, as a `trajectory.Trajectory` which
+        decodes each state only when it is asked for. `stride` keeps every
+        `stride`th state and `last_n` only the last `last_n` of those.
+
+        states are read from bigrapher's `json` or its shorter `txt` output,
+        and with `counts` each is read as the number of nodes of each
+        control only, skipping the bigraph. given an `intern.StateTable` as
+        `intern`, equal states across reads share one object.
+
+        the transitions are held as a `graph.TransitionGraph` in the
+        trajectory's `graph`. a simulation is read in the order its states
+        were reached, and a run that branches, like `full`, lists every
+        reachable state layer by layer, its branches left in `graph`.
+
+        a run packed by `archive.pack` is read from `{key}.pack` in place of
+        the files it replaced. the archive stays open until the trajectory
+        is closed, so use it in a `with` block'''
+        from bigraph.graph import TransitionGraph
+        from bigraph.trajectory import Trajectory, CACHE_SIZE
+        from bigraph.archive import Archive, archive_path
+
+        if format not in AVAILABLE_OUTPUT_FORMATS:
+            raise Exception(f'format {format} not supported')
+
         path = Path(path or self.path)
         key = key or self.key
 
-        with open(path / f'{key}.json', 'r') as system_file:
-            transitions = json.load(system_file)['brs']
-
-        if len(transitions) > 0:
-            trajectory = nx.DiGraph()
-            for transition in transitions:
-                edge = [transition['source'], transition['target']]
-                trajectory.add_edge(*edge)
-            steps = nx.topological_generations(trajectory)
+        archive = None
+        if not (path / f'{key}.json').exists() and archive_path(path, key).exists():
+            if format != 'json':
+                raise Exception(f'format {format} not supported for packed runs, only json')
+            archive = Archive(archive_path(path, key))
+            graph = archive.graph
         else:
-            steps = [['0']]
-
-        history = []
-        for step in steps:
-            for parallel in step:
-                if format == 'svg':
-                    svg_path = path / f'{parallel}.svg'
-                    history.append(svg_path)
-                elif format == 'json':
-                    with open(path / f'{parallel}.{format}', 'r') as step_file:
-                        state = json.load(step_file)
-                        root = Base.from_spec(state)
-                        history.append(root)
-                else:
-                    raise Exception(f'format {format} not supported')
+            graph = TransitionGraph.load(path, key=key)
+
+        ids = [
+            graph.labels[state]
+            for state in graph.order()][::stride]
+        if last_n is not None:
+            ids = ids[len(ids) - last_n:] if last_n < len(ids) else ids
 
-        return history
+        return Trajectory(path, ids, format=format, cache_size=cache_size or CACHE_SIZE, graph=graph, archive=archive, counts=counts, table=intern)
 
     def html_transitions(self, path=None, key=None):
         transition_paths = self.read(path=path, key=key, format='svg')
@@ -1013,6 +1141,7 @@ class BigraphicalReactiveSystem(Base):
         return result
 
     def display_transitions(self, path=None, key=None):
+        from IPython.display import HTML, display
         result = self.html_transitions(path=path, key=key)
         return display(HTML(result))
 
@@ -1023,11 +1152,70 @@ class BigraphicalReactiveSystem(Base):
             subcommand='sim',
             format=('json', 'svg'),
             steps=None,
-            console=False):
+            console=False,
+            pipe=False,
+            cache=None,
+            sample=None):
+        '''run bigrapher on this system and read back the trajectory.
+
+        with `pipe` the model and everything bigrapher writes live in a
+        private directory on a memory backed filesystem, which is removed
+        once the states have been read, so nothing touches `path`. only json
+        is produced in this mode, as the svgs would not outlive the run.
+
+        the states are always returned decoded in a list, so a later run to
+        the same path leaves them as they are. `read` gives the lazy
+        `trajectory.Trajectory` of the last run instead.
+
+        given a `cache.ResultCache`, a run already made with the same model,
+        options and `sample` returns the stored trajectory without starting
+        bigrapher. `sample` only labels the stored run, as bigrapher is given
+        no seed, and a `sim` run without one is never cached'''
+
+        self.check()
+
+        def run():
+            return self.run_bigrapher(
+                path=path,
+                key=key,
+                subcommand=subcommand,
+                format=format,
+                steps=steps,
+                console=console,
+                pipe=pipe)
+
+        if cache is None:
+            return run()
+        return cache.run(self, run, subcommand=subcommand, steps=steps, format=format, sample=sample)
+
+    def run_bigrapher(
+            self,
+            path=None,
+            key=None,
+            subcommand='sim',
+            format=('json', 'svg'),
+            steps=None,
+            console=False,
+            pipe=False):
 
-        path = Path(path or self.path)
         key = key or self.key
 
+        if pipe:
+            with tempfile.TemporaryDirectory(prefix='bigraph-', dir=ram_directory()) as directory:
+                directory = Path(directory)
+                self.write(path=directory, key=key)
+                self.execute(
+                    path=directory,
+                    key=key,
+                    subcommand=subcommand,
+                    format='json',
+                    steps=steps,
+                    console=console)
+                with self.read(path=directory, key=key) as trajectory:
+                    return trajectory.load()
+
+        path = Path(path or self.path)
+
         self.write(path=path, key=key)
         self.execute(
             path=path,
@@ -1036,9 +1224,136 @@ class BigraphicalReactiveSystem(Base):
             format=format,
             steps=steps,
             console=console)
-        result = self.read(path=path, key=key)
 
-        return result
+        with self.read(path=path, key=key) as trajectory:
+            return trajectory.load()
+
+    def stream(
+            self,
+            path=None,
+            key=None,
+            steps=None,
+            poll=0.01,
+            console=False,
+            pipe=False):
+        '''run `sim`, yielding each state as soon as bigrapher has written it.
+
+        bigrapher numbers the states of a simulation in order, so the state
+        after `{n}.json` is `{n+1}.json`. a state file still being written is
+        read again on the next poll. closing the generator before the run
+        ends kills bigrapher'''
+
+        self.check()
+        key = key or self.key
+        if pipe:
+            directory = tempfile.TemporaryDirectory(prefix='bigraph-', dir=ram_directory())
+            path = Path(directory.name)
+        else:
+            directory = None
+            path = Path(path or self.path)
+
+        process = None
+        try:
+            self.write(path=path, key=key)
+            for stale in path.glob('*.json'):
+                if stale.stem.isdigit():
+                    stale.unlink()
+
+            command = self.command(
+                path=path,
+                key=key,
+                subcommand='sim',
+                format='json',
+                steps=steps)
+            output = None if console else subprocess.DEVNULL
+            process = subprocess.Popen(
+                [str(token) for token in command],
+                stdout=output,
+                stderr=output)
+
+            index = 0
+            while True:
+                finished = process.poll() is not None
+                state_path = path / f'{index}.json'
+                if state_path.exists():
+                    try:
+                        with open(state_path, 'r') as state_file:
+                            state = json.load(state_file)
+                    except json.JSONDecodeError:
+                        if finished:
+                            raise
+                        time.sleep(poll)
+                        continue
+                    yield Base.from_spec(state)
+                    index += 1
+                elif finished:
+                    break
+                else:
+                    time.sleep(poll)
+        finally:
+            if process is not None and process.poll() is None:
+                process.kill()
+                process.wait()
+            if directory is not None:
+                directory.cleanup()
+
+    def simulate_until(
+            self,
+            until,
+            path=None,
+            key=None,
+            steps=None,
+            poll=0.01,
+            pipe=False):
+        '''simulate as `stream` does, stopping bigrapher as soon as any of the
+        predicates in `until` holds. each predicate is called with the
+        trajectory so far. returns the trajectory up to and including the
+        state where it stopped'''
+
+        if callable(until):
+            until = [until]
+
+        trajectory = []
+        states = self.stream(
+            path=path,
+            key=key,
+            steps=steps,
+            poll=poll,
+            pipe=pipe)
+        try:
+            for state in states:
+                trajectory.append(state)
+                if any(predicate(trajectory) for predicate in until):
+                    break
+        finally:
+            states.close()
+        return trajectory
+
+    def explore(
+            self,
+            path=None,
+            key=None,
+            states=None,
+            console=False):
+        '''run bigrapher's exhaustive exploration, stopping after `states`
+        states if given, and stream its transitions into a `TransitionGraph`
+        whose states are read lazily'''
+        from bigraph.graph import TransitionGraph
+
+        self.check()
+        path = Path(path or self.path)
+        key = key or self.key
+
+        self.write(path=path, key=key)
+        self.execute(
+            path=path,
+            key=key,
+            subcommand='full',
+            format='json',
+            steps=states,
+            console=console)
+
+        return TransitionGraph.load(path, key=key)
 
     def render(self, parent=False):
         controls = '\n'.join([
@@ -1096,17 +1411,36 @@ def visualize(
         subcommand='sim',
         format=('json','svg'))
     
-    visualize_transition(0)
+    visualize_transition(0, path=path)
 
     return result[0]
 
 
+def check_systems(systems):
+    ''' check each distinct system of a batch once, so a bad model fails before any run of the batch starts '''
+    checked = set()
+    for system in systems:
+        if id(system) not in checked:
+            checked.add(id(system))
+            system.check()
+
+
 def react(
         reaction,
         big,
         names=PARAMETER_SYMBOLS,
         path='out/test/react',
-        executable='bigrapher'):
+        executable='bigrapher',
+        cache=None,
+        sample=None,
+        session=None):
+    '''the state after applying `reaction` once to `big`, the second state
+    of a `sim` run of one step, as a `session.ReactionSession` takes it. with
+    a `cache` the run is only reused under a `sample`, so without one
+    bigrapher always runs'''
+
+    if session is not None:
+        return session.react(reaction, big)
 
     bigraph = Bigraph.unfold(big)
     bigraph_symbol = 'initial'
@@ -1146,21 +1480,80 @@ def react(
         subcommand='sim',
         format=('json','svg'),
         # console=True,
-        steps=0)
+        steps=1,
+        cache=cache,
+        sample=sample)
     
     return result[1]
 
 
-def apply_reactions(reactions, initial):
+def apply_reactions(
+        reactions,
+        initial,
+        cache=None,
+        sample=None,
+        path='out/test/react',
+        executable='bigrapher',
+        session=False):
+    '''the history of applying each of `reactions` in turn to `initial`.
+    with a `cache` runs are only reused under a `sample`, see `react`. with
+    `session` the reactions run in one `session.ReactionSession`, so repeats
+    of a reaction share a bigrapher run'''
+
+    if session:
+        from bigraph.session import ReactionSession
+        session = ReactionSession(
+            path=path,
+            executable=executable,
+            cache=cache,
+            sample=sample)
+        return session.apply(reactions, initial)
+
     history = [initial]
     state = initial
     for reaction in reactions:
-        state = react(reaction, state)
+        state = react(reaction, state, path=path, executable=executable, cache=cache, sample=sample)
         history.append(state)
     return history
 
 
+def test_apply_reactions(tmp_path):
+    from bigraph.parse import bigraph
+    from bigraph.fake import fake_bigrapher, fake_environment
+
+    path = tmp_path
+    grow = bigraph('''
+        react grow =
+            A
+            -->
+            A.B''')
+    shrink = bigraph('''
+        react shrink =
+            A.B
+            -->
+            A''')
+    initial = bigraph('A')
+    script = [grow, shrink, grow]
+
+    # one reaction at a time and in a session, bigrapher runs the same steps
+    histories = {}
+    commands = {}
+    for session in (False, True):
+        log = Path(path) / f'log-{session}'
+        with fake_environment(log=log):
+            histories[session] = [
+                state.render()
+                for state in apply_reactions(script, initial, path=Path(path) / 'run', executable=fake_bigrapher(path), session=session)]
+        with open(log, 'r') as log_file:
+            commands[session] = [
+                line.split()[line.split().index('-S') + 1]
+                for line in log_file]
+    assert histories[False] == histories[True] == ['A', 'Step(1)', 'Step(1)', 'Step(1)']
+    assert commands[False] == commands[True] == ['1', '1', '1']
+
+
 def test_bigraphical_system(
+        tmp_path,
         executable='bigrapher'):
 
     ctrl = {
@@ -1277,7 +1670,7 @@ def test_bigraphical_system(
         reactions=reactions,
         system=system,
         executable=executable,
-        path='out/test/execute')
+        path=tmp_path)
 
     result = reactive_system.simulate(
        format='json',
@@ -1290,7 +1683,116 @@ def test_bigraphical_system(
         print(transition.render())
 
 
+def test_pipe(tmp_path):
+    from bigraph.fake import fake_system, fake_environment
+
+    path = tmp_path
+    log = path / 'log'
+
+    brs = fake_system(path)
+    brs.path = path / 'run'
+
+    with fake_environment(log=log):
+        history = brs.simulate(steps=2, pipe=True)
+
+    assert [state.render() for state in history] == ['Step(0)', 'Step(1)', 'Step(2)']
+    assert not brs.path.exists()
+
+    # bigrapher ran in a private directory, which is gone after the run
+    with open(log, 'r') as log_file:
+        arguments = log_file.read().split()
+    directory = Path(arguments[arguments.index('-t') + 1]).parent
+    assert not directory.exists()
+    if ram_directory():
+        assert str(directory).startswith(ram_directory())
+
+    disk = brs.simulate(steps=2, format='json')
+    assert [state.render() for state in disk] == ['Step(0)', 'Step(1)', 'Step(2)']
+    assert (brs.path / 'system.json').exists()
+
+
+def test_simulate_until(tmp_path):
+    from bigraph.fake import fake_system, fake_environment
+
+    path = tmp_path
+
+    brs = fake_system(path)
+    brs.path = Path(path) / 'run'
+
+    def third(trajectory):
+        return trajectory[-1].render() == 'Step(3)'
+
+    # fifty states take over two seconds, but the run stops at the fourth
+    start = time.perf_counter()
+    with fake_environment(step=0.05):
+        trajectory = brs.simulate_until(third, steps=50)
+    elapsed = time.perf_counter() - start
+    assert [state.render() for state in trajectory] == ['Step(0)', 'Step(1)', 'Step(2)', 'Step(3)']
+    assert elapsed < 2.0
+    time.sleep(0.2)
+    assert not (brs.path / '10.json').exists()
+
+    # a run whose predicates never hold returns every state
+    with fake_environment(step=0.01):
+        trajectory = brs.simulate_until(lambda trajectory: False, steps=5, pipe=True)
+    assert len(trajectory) == 6
+
+
+def test_check(tmp_path):
+    from bigraph.parse import bigraph
+    from bigraph.fake import fake_bigrapher, fake_environment
+    from bigraph.scheduler import simulate_all
+
+    path = tmp_path
+    broken = bigraph('''
+        ctrl A = 1;
+        fun ctrl B(a) = 0;
+
+        react grow =
+            A{x}
+            -->
+            A{x,y}.C;
+
+        big start = A{x}.B(1,2);
+
+        begin brs
+            init initial;
+            rules = [{grow, shrink}];
+            preds = {start, done};
+        end''')
+    broken.executable = fake_bigrapher(path)
+    broken.path = Path(path) / 'system'
+
+    assert sorted(broken.problems()) == sorted([
+        'init bigraph initial is not declared',
+        'rule shrink has no reaction',
+        'predicate done has no bigraph',
+        'reaction grow links 2 ports of A, which has arity 1',
+        'reaction grow uses control C, which is not declared',
+        'bigraph start gives 2 params to B, which takes 1'])
+
+    # a control built in python keeps the arity it was declared with
+    A = Control(symbol='A', arity=1)
+    built = BigraphicalReactiveSystem(
+        controls={'A': A},
+        bigraphs={'start': Big(symbol='start', root=Node(A, ports=['x', 'y']))},
+        system=System(init=Init(symbol='start')))
+    assert built.problems() == ['bigraph start links 2 ports of A, which has arity 1']
+
+    # nothing is written and bigrapher never starts
+    log = Path(path) / 'log'
+    with fake_environment(log=log):
+        for run in (lambda: broken.simulate(steps=1), lambda: simulate_all([broken], steps=1), lambda: broken.explore(states=1)):
+            try:
+                run()
+                assert False
+            except Exception as error:
+                assert 'rule shrink has no reaction' in str(error)
+    assert not log.exists() and not broken.path.exists()
+
+
 def test_bigraph(
+        tmp_path,
         executable='bigrapher'):
 
     controls = {
@@ -1331,18 +1833,19 @@ def test_bigraph(
 
     bigraph.nodes['3'].assign('y', 14)
 
-    transition = visualize(bigraph.roots)
+    transition = visualize(bigraph.roots, path=tmp_path)
 
     print('\n\n\n')
     print('TRANSITION:')
     print(transition.render())
 
 
-def test_all():
-    test_bigraphical_system()
+def test_all(tmp_path):
+    test_bigraphical_system(Path(tmp_path) / 'execute')
     print('\n\n\n')
-    test_bigraph()
+    test_bigraph(Path(tmp_path) / 'visualize')
 
 
 if __name__ == '__main__':
+    import fire
     fire.Fire(test_all)
@@ -0,0 +1,724 @@
+import io
+import json
+import time
+import struct
+
+from bigraph.bigraph import Base, Bigraph, Control, Node, One, Id, Edge, EdgeGroup, Parallel, Merge, Big, InGroup, Condition, Reaction, Range, Assign, Init, Param, RuleGroup, Rules, Preds, System, BigraphicalReactiveSystem
+
+
+MAGIC = b'BIGB'
+VERSION = 2
+
+# kinds of top level object stored in a stream
+KIND_TERM = 0
+KIND_BIGRAPH = 1
+KIND_SYSTEM = 2
+
+# section tags, every section is `tag varint(length) payload`
+SECTION_END = 0
+SECTION_STRINGS = 1
+SECTION_CONTROLS = 2
+SECTION_BIGRAPH = 3
+SECTION_REACTION = 4
+SECTION_SYSTEM = 5
+SECTION_TERM = 6
+SECTION_DECLARED = 7
+
+# place structure tags
+TERM_NODE = 0
+TERM_MERGE = 1
+TERM_PARALLEL = 2
+TERM_ID = 3
+TERM_ONE = 4
+TERM_EDGES = 5
+TERM_NONE = 6
+
+# generic value tags, used for params, rates, bindings and rules
+VALUE_NONE = 0
+VALUE_INT = 1
+VALUE_NEGATIVE = 2
+VALUE_FLOAT = 3
+VALUE_STRING = 4
+VALUE_PARAM = 5
+VALUE_LIST = 6
+VALUE_RANGE = 7
+VALUE_TERM = 8
+
+DOUBLE = struct.Struct('<d')
+
+
+def encode_varint(buffer, value):
+    while value > 0x7f:
+        buffer.append((value & 0x7f) | 0x80)
+        value >>= 7
+    buffer.append(value)
+
+
+def decode_varint(data, position):
+    result = 0
+    shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result, position
+        shift += 7
+
+
+class StringTable():
+    '''strings are written once and referred to by index after that.
+    the writer flushes only the strings added since the last section,
+    so a table can be grown while streaming'''
+
+    def __init__(self):
+        self.strings = []
+        self.index = {}
+        self.flushed = 0
+
+    def intern(self, string):
+        string = str(string)
+        index = self.index.get(string)
+        if index is None:
+            index = len(self.strings)
+            self.index[string] = index
+            self.strings.append(string)
+        return index
+
+    def pending(self):
+        return self.strings[self.flushed:]
+
+    def flush(self):
+        pending = self.pending()
+        self.flushed = len(self.strings)
+        return pending
+
+
+class ControlTable(StringTable):
+    '''controls are defined once in a controls section and referred to
+    by index after that, like strings. controls that differ in arity,
+    atomicity or parameters get their own entries'''
+
+    def intern(self, control):
+        key = (control.symbol, control.arity, control.atomic, tuple(control.fun or ()))
+        index = self.index.get(key)
+        if index is None:
+            index = len(self.strings)
+            self.index[key] = index
+            self.strings.append(control)
+        return index
+
+
+class Encoder():
+    def __init__(self, strings, controls):
+        self.strings = strings
+        self.controls = controls
+        self.buffer = bytearray()
+
+    def varint(self, value):
+        encode_varint(self.buffer, value)
+
+    def flag(self, value):
+        self.buffer.append(1 if value else 0)
+
+    def string(self, string):
+        self.varint(self.strings.intern(string))
+
+    def value(self, value):
+        buffer = self.buffer
+        if value is None:
+            buffer.append(VALUE_NONE)
+        elif isinstance(value, bool):
+            buffer.append(VALUE_INT)
+            self.varint(int(value))
+        elif isinstance(value, int):
+            if value >= 0:
+                buffer.append(VALUE_INT)
+                self.varint(value)
+            else:
+                buffer.append(VALUE_NEGATIVE)
+                self.varint(-value)
+        elif isinstance(value, float):
+            buffer.append(VALUE_FLOAT)
+            buffer.extend(DOUBLE.pack(value))
+        elif isinstance(value, str):
+            buffer.append(VALUE_STRING)
+            self.string(value)
+        elif isinstance(value, Param):
+            buffer.append(VALUE_PARAM)
+            self.string(value.symbol)
+            self.values(value.params)
+        elif isinstance(value, Range):
+            buffer.append(VALUE_RANGE)
+            self.value(value.start)
+            self.value(value.step)
+            self.value(value.stop)
+        elif isinstance(value, (list, tuple)):
+            buffer.append(VALUE_LIST)
+            self.values(value)
+        elif isinstance(value, Base):
+            buffer.append(VALUE_TERM)
+            self.term(value)
+        else:
+            raise Exception(f'cannot encode value {value} of type {type(value)}')
+
+    def values(self, values):
+        values = values or ()
+        self.varint(len(values))
+        for value in values:
+            self.value(value)
+
+    def control(self, control):
+        self.varint(self.controls.intern(control))
+
+    def define(self, control):
+        self.string(control.symbol)
+        self.varint(control.arity)
+        self.flag(control.atomic)
+        fun = control.fun or ()
+        self.varint(len(fun))
+        for symbol in fun:
+            self.string(symbol)
+
+    def edges(self, edges):
+        self.varint(len(edges))
+        for edge in edges:
+            self.string(edge.symbol if edge.symbol is not None else '')
+
+    def term(self, term):
+        buffer = self.buffer
+        if term is None:
+            buffer.append(TERM_NONE)
+        elif isinstance(term, Node):
+            buffer.append(TERM_NODE)
+            self.control(term.control)
+            self.values(term.params)
+            self.edges(term.ports.edges)
+            self.term(term.subnodes)
+        elif isinstance(term, Merge):
+            buffer.append(TERM_MERGE)
+            self.varint(len(term.parts))
+            for part in term.parts:
+                self.term(part)
+        elif isinstance(term, Parallel):
+            buffer.append(TERM_PARALLEL)
+            self.varint(len(term.parallel))
+            for part in term.parallel:
+                self.term(part)
+        elif isinstance(term, Id):
+            buffer.append(TERM_ID)
+        elif isinstance(term, One):
+            buffer.append(TERM_ONE)
+        elif isinstance(term, EdgeGroup):
+            buffer.append(TERM_EDGES)
+            self.edges(term.edges)
+        elif isinstance(term, Edge):
+            buffer.append(TERM_EDGES)
+            self.edges([term])
+        else:
+            raise Exception(f'cannot encode term {term} of type {type(term)}')
+
+    def reaction(self, reaction):
+        self.string(reaction.symbol)
+        self.values(reaction.params)
+        self.term(reaction.redex)
+        self.values(reaction.arrow)
+        self.term(reaction.reactum)
+        self.flag(reaction.instantiation is not None)
+        if reaction.instantiation is not None:
+            self.values(reaction.instantiation)
+        groups = reaction.condition.groups if reaction.condition else []
+        self.flag(reaction.condition is not None)
+        self.varint(len(groups))
+        for group in groups:
+            self.flag(group.negate)
+            self.string(group.target)
+            self.term(group.control)
+
+    def big(self, big):
+        self.string(big.symbol)
+        self.term(big.root)
+
+    def rule_group(self, group):
+        self.flag(group.deterministic)
+        self.values(group.rules)
+
+    def system(self, system):
+        self.string(system.system_type)
+        self.varint(len(system.bindings))
+        for binding in system.bindings:
+            self.string(binding.assign_type)
+            self.string(binding.symbol)
+            self.value(binding.value)
+        self.flag(system.init is not None)
+        if system.init is not None:
+            self.string(system.init.symbol)
+        self.varint(len(system.rules.rule_groups))
+        for group in system.rules.rule_groups:
+            self.rule_group(group)
+        self.flag(bool(system.preds))
+        if system.preds:
+            self.rule_group(system.preds.rules)
+
+
+class Decoder():
+    def __init__(self, data, strings, controls):
+        self.data = data
+        self.position = 0
+        self.strings = strings
+        self.controls = controls
+
+    def varint(self):
+        data = self.data
+        position = self.position
+        byte = data[position]
+        if byte < 0x80:
+            self.position = position + 1
+            return byte
+        value, self.position = decode_varint(data, position)
+        return value
+
+    def byte(self):
+        byte = self.data[self.position]
+        self.position += 1
+        return byte
+
+    def flag(self):
+        return self.byte() == 1
+
+    def string(self):
+        return self.strings[self.varint()]
+
+    def value(self):
+        tag = self.byte()
+        if tag == VALUE_INT:
+            return self.varint()
+        elif tag == VALUE_STRING:
+            return self.string()
+        elif tag == VALUE_NONE:
+            return None
+        elif tag == VALUE_NEGATIVE:
+            return -self.varint()
+        elif tag == VALUE_FLOAT:
+            value = DOUBLE.unpack_from(self.data, self.position)[0]
+            self.position += DOUBLE.size
+            return value
+        elif tag == VALUE_PARAM:
+            symbol = self.string()
+            return Param(symbol=symbol, params=self.values())
+        elif tag == VALUE_RANGE:
+            start = self.value()
+            step = self.value()
+            stop = self.value()
+            return Range(start=start, step=step, stop=stop)
+        elif tag == VALUE_LIST:
+            return self.values()
+        elif tag == VALUE_TERM:
+            return self.term()
+        else:
+            raise Exception(f'unknown value tag {tag} at {self.position - 1}')
+
+    def values(self):
+        return [
+            self.value()
+            for _ in range(self.varint())]
+
+    def control(self):
+        return self.controls[self.varint()]
+
+    def define(self):
+        symbol = self.string()
+        arity = self.varint()
+        atomic = self.flag()
+        fun = [
+            self.string()
+            for _ in range(self.varint())]
+        return Control(
+            symbol=symbol,
+            arity=arity,
+            atomic=atomic,
+            fun=fun)
+
+    def edges(self):
+        return [
+            Edge(symbol=self.string())
+            for _ in range(self.varint())]
+
+    def term(self):
+        tag = self.byte()
+        if tag == TERM_NODE:
+            control = self.control()
+            params = self.values()
+            ports = EdgeGroup(edges=self.edges())
+            node = Node(
+                control=control,
+                params=params,
+                ports=ports)
+            subnodes = self.term()
+            if subnodes is not None:
+                node.nest(subnodes)
+            return node
+        elif tag == TERM_MERGE:
+            return Merge([
+                self.term()
+                for _ in range(self.varint())])
+        elif tag == TERM_ONE:
+            return One()
+        elif tag == TERM_ID:
+            return Id()
+        elif tag == TERM_NONE:
+            return None
+        elif tag == TERM_PARALLEL:
+            return Parallel([
+                self.term()
+                for _ in range(self.varint())])
+        elif tag == TERM_EDGES:
+            return EdgeGroup(edges=self.edges())
+        else:
+            raise Exception(f'unknown term tag {tag} at {self.position - 1}')
+
+    def reaction(self):
+        symbol = self.string()
+        params = self.values()
+        redex = self.term()
+        arrow = self.values()
+        reactum = self.term()
+        instantiation = None
+        if self.flag():
+            instantiation = self.values()
+        has_condition = self.flag()
+        groups = []
+        for _ in range(self.varint()):
+            negate = self.flag()
+            target = self.string()
+            control = self.term()
+            groups.append(InGroup(
+                control=control,
+                target=target,
+                negate=negate))
+        condition = Condition(groups=groups) if has_condition else None
+        return Reaction(
+            symbol=symbol,
+            params=params,
+            redex=redex,
+            arrow=arrow,
+            reactum=reactum,
+            instantiation=instantiation,
+            condition=condition)
+
+    def big(self):
+        symbol = self.string()
+        return Big(symbol, self.term())
+
+    def rule_group(self):
+        deterministic = self.flag()
+        return RuleGroup(
+            deterministic=deterministic,
+            rules=self.values())
+
+    def system(self):
+        system_type = self.string()
+        bindings = []
+        for _ in range(self.varint()):
+            assign_type = self.string()
+            symbol = self.string()
+            bindings.append(Assign(
+                assign_type=assign_type,
+                symbol=symbol,
+                value=self.value()))
+        init = Init(symbol=self.string()) if self.flag() else None
+        rules = Rules(rule_groups=[
+            self.rule_group()
+            for _ in range(self.varint())])
+        preds = Preds(rules=self.rule_group()) if self.flag() else None
+        return System(
+            system_type=system_type,
+            bindings=bindings,
+            init=init,
+            rules=rules,
+            preds=preds)
+
+
+class BinaryWriter():
+    '''write bigraphical objects as a stream of length prefixed sections.
+    new controls are flushed in a controls section, and new strings in a
+    strings section after that, right before the first section that
+    refers to them'''
+
+    def __init__(self, file, kind=KIND_SYSTEM):
+        self.file = file
+        self.strings = StringTable()
+        self.controls = ControlTable()
+        header = bytearray(MAGIC)
+        encode_varint(header, VERSION)
+        encode_varint(header, kind)
+        self.file.write(header)
+
+    def section(self, tag, payload):
+        controls = None
+        pending = self.controls.flush()
+        if pending:
+            encoder = Encoder(self.strings, self.controls)
+            encoder.varint(len(pending))
+            for control in pending:
+                encoder.define(control)
+            controls = encoder.buffer
+        pending = self.strings.flush()
+        if pending:
+            strings = bytearray()
+            encode_varint(strings, len(pending))
+            for string in pending:
+                raw = string.encode('utf-8')
+                encode_varint(strings, len(raw))
+                strings.extend(raw)
+            self.emit(SECTION_STRINGS, strings)
+        if controls is not None:
+            self.emit(SECTION_CONTROLS, controls)
+        self.emit(tag, payload)
+
+    def emit(self, tag, payload):
+        header = bytearray([tag])
+        encode_varint(header, len(payload))
+        self.file.write(header)
+        self.file.write(payload)
+
+    def encode(self, tag, method, value):
+        encoder = Encoder(self.strings, self.controls)
+        getattr(encoder, method)(value)
+        self.section(tag, encoder.buffer)
+
+    def write_controls(self, controls):
+        ''' declare `controls` as the controls of a system '''
+        encoder = Encoder(self.strings, self.controls)
+        controls = [
+            control
+            for symbol, control in controls.items()
+            if symbol != '1' and symbol != 'id']
+        encoder.varint(len(controls))
+        for control in controls:
+            encoder.control(control)
+        self.section(SECTION_DECLARED, encoder.buffer)
+
+    def write_bigraph(self, big):
+        self.encode(SECTION_BIGRAPH, 'big', big)
+
+    def write_reaction(self, reaction):
+        self.encode(SECTION_REACTION, 'reaction', reaction)
+
+    def write_system(self, system):
+        self.encode(SECTION_SYSTEM, 'system', system)
+
+    def write_term(self, term):
+        self.encode(SECTION_TERM, 'term', term)
+
+    def close(self):
+        self.emit(SECTION_END, b'')
+
+
+class BinaryReader():
+    '''read the sections of a binary stream one at a time, yielding
+    `(tag, value)` pairs as they are decoded. strings and controls sections
+    only grow the tables the other sections refer to'''
+
+    def __init__(self, file):
+        self.file = file
+        magic = file.read(len(MAGIC))
+        if magic != MAGIC:
+            raise Exception(f'not a binary bigraph stream, found header {magic}')
+        self.version = self.read_varint()
+        if self.version > VERSION:
+            raise Exception(f'binary bigraph version {self.version} is newer than supported version {VERSION}')
+        if self.version < VERSION:
+            raise Exception(f'binary bigraph version {self.version} is older than supported version {VERSION}')
+        self.kind = self.read_varint()
+        self.strings = []
+        self.controls = []
+
+    def read_varint(self):
+        result = 0
+        shift = 0
+        while True:
+            byte = self.file.read(1)
+            if not byte:
+                raise Exception('unexpected end of binary bigraph stream')
+            byte = byte[0]
+            result |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                return result
+            shift += 7
+
+    def read_strings(self, payload):
+        count, position = decode_varint(payload, 0)
+        for _ in range(count):
+            length, position = decode_varint(payload, position)
+            self.strings.append(
+                bytes(payload[position:position + length]).decode('utf-8'))
+            position += length
+
+    def read_controls(self, payload):
+        decoder = Decoder(payload, self.strings, self.controls)
+        for _ in range(decoder.varint()):
+            self.controls.append(decoder.define())
+
+    def decode(self, tag, payload):
+        decoder = Decoder(payload, self.strings, self.controls)
+        if tag == SECTION_DECLARED:
+            return [
+                decoder.control()
+                for _ in range(decoder.varint())]
+        elif tag == SECTION_BIGRAPH:
+            return decoder.big()
+        elif tag == SECTION_REACTION:
+            return decoder.reaction()
+        elif tag == SECTION_SYSTEM:
+            return decoder.system()
+        elif tag == SECTION_TERM:
+            return decoder.term()
+        else:
+            # sections from a later version are skipped
+            return None
+
+    def __iter__(self):
+        while True:
+            tag = self.file.read(1)
+            if not tag or tag[0] == SECTION_END:
+                return
+            tag = tag[0]
+            length = self.read_varint()
+            payload = self.file.read(length)
+            if len(payload) < length:
+                raise Exception('unexpected end of binary bigraph stream')
+            if tag == SECTION_STRINGS:
+                self.read_strings(payload)
+            elif tag == SECTION_CONTROLS:
+                self.read_controls(payload)
+            else:
+                yield tag, self.decode(tag, payload)
+
+
+def dump(value, file):
+    '''write a `BigraphicalReactiveSystem`, `Bigraph` or bigraph term to a
+    binary file object'''
+
+    if isinstance(value, BigraphicalReactiveSystem):
+        writer = BinaryWriter(file, kind=KIND_SYSTEM)
+        writer.write_controls(value.controls)
+        for bigraph in value.bigraphs.values():
+            writer.write_bigraph(bigraph)
+        for reaction in value.reactions.values():
+            writer.write_reaction(reaction)
+        if value.system:
+            writer.write_system(value.system)
+    elif isinstance(value, Bigraph):
+        writer = BinaryWriter(file, kind=KIND_BIGRAPH)
+        writer.write_term(value.roots)
+    else:
+        writer = BinaryWriter(file, kind=KIND_TERM)
+        writer.write_term(value)
+    writer.close()
+
+
+def dumps(value):
+    file = io.BytesIO()
+    dump(value, file)
+    return file.getvalue()
+
+
+def load(file, executable='bigrapher', path='.', key='system'):
+    '''read back whatever `dump` wrote. bigraphs are rebuilt through
+    `Bigraph.unfold`, so their node ids are renumbered'''
+
+    reader = BinaryReader(file)
+    controls = {}
+    bigraphs = {}
+    reactions = {}
+    system = None
+    terms = []
+
+    for tag, value in reader:
+        if tag == SECTION_DECLARED:
+            for control in value:
+                controls[control.symbol] = control
+        elif tag == SECTION_BIGRAPH:
+            bigraphs[value.symbol] = value
+        elif tag == SECTION_REACTION:
+            reactions[value.symbol] = value
+        elif tag == SECTION_SYSTEM:
+            system = value
+        elif tag == SECTION_TERM:
+            terms.append(value)
+
+    if reader.kind == KIND_SYSTEM:
+        return BigraphicalReactiveSystem(
+            controls=controls,
+            bigraphs=bigraphs,
+            reactions=reactions,
+            system=system,
+            executable=executable,
+            path=path,
+            key=key)
+    elif reader.kind == KIND_BIGRAPH:
+        return Bigraph.unfold(terms[0])
+    else:
+        return terms[0] if len(terms) == 1 else terms
+
+
+def loads(data, **kwargs):
+    return load(io.BytesIO(data), **kwargs)
+
+
+def test_binary(path='examples/big/PSD_FIFO_ctrl.big'):
+    from bigraph.parse import parse_big, bigraph
+    from bigraph.metabolism import Metabolism
+
+    with open(path, 'r') as big_file:
+        source = big_file.read()
+
+    brs = parse_big(path)
+    render = brs.render()
+    data = dumps(brs)
+    loaded = loads(data)
+    assert loaded.render() == render
+
+    metabolism = Metabolism().brs
+    assert loads(dumps(metabolism)).render() == metabolism.render()
+
+    state = metabolism.bigraphs['initial'].root
+    assert loads(dumps(state)).render() == state.render()
+
+    # a control is defined once however many nodes refer to it
+    repeated = bigraph(' | '.join(['Ready.M{a, b}'] * 100))
+    reader = BinaryReader(io.BytesIO(dumps(repeated)))
+    terms = [value for tag, value in reader]
+    assert len(reader.controls) == 2
+    assert terms[0].render() == repeated.render()
+
+    spec = Bigraph.unfold(bigraph('A{a}.Snd.(M{a, v_a} | Ready.Fun.1) | A{b}.Snd.M{a, v_b} | Mail.1'))
+    assert loads(dumps(spec)).roots.render() == spec.roots.render()
+
+    state_json = json.dumps(spec.get_spec(), default=list)
+    print(f'bytes: binary {len(dumps(spec))}, json {len(state_json)}')
+    print(f'bytes: binary {len(data)}, big {len(render)}')
+    assert len(data) < len(render)
+
+    start = time.perf_counter()
+    parse_big(path)
+    parse_time = time.perf_counter() - start
+
+    load_time = min(
+        timed_load(data)
+        for _ in range(5))
+
+    print(f'load: binary {load_time:.5f}s, parse {parse_time:.5f}s')
+    assert load_time * 10 < parse_time
+
+
+def timed_load(data):
+    start = time.perf_counter()
+    loads(data)
+    return time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    import fire
+    fire.Fire(test_binary)
@@ -0,0 +1,166 @@
+import os
+import time
+import pickle
+import hashlib
+from pathlib import Path
+
+
+# subcommands whose output depends only on the model. `sim` draws a random
+# trajectory, so its runs are only cached under a sample
+DETERMINISTIC_SUBCOMMANDS = ['full', 'validate']
+
+# bytes the cache may hold on disk before the least recently used entries go
+CACHE_SIZE = 1 << 30
+
+
+class ResultCache():
+    '''trajectories of bigrapher runs stored on disk under a hash of the
+    rendered model, the subcommand, the steps and the output formats.
+
+    a `sim` run chooses its transitions at random, so it is only stored when
+    given a `sample`, a label naming one stored trajectory. bigrapher is not
+    given a seed, so the first run under a sample is as random as any, and
+    later runs under the same sample return that trajectory. without a
+    sample it always runs. once the files pass `size` bytes the least
+    recently used entries are removed'''
+
+    def __init__(self, path='out/cache', size=CACHE_SIZE):
+        self.path = Path(path)
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.saved = 0.0
+
+    def key(self, source, subcommand='sim', steps=None, format='json', sample=None):
+        ''' the hash naming a run, or `None` when the run should not be cached '''
+        if sample is None and subcommand not in DETERMINISTIC_SUBCOMMANDS:
+            self.bypassed += 1
+            return None
+        if isinstance(format, str):
+            format = (format,)
+        digest = hashlib.sha256()
+        for part in (source, subcommand, steps, ','.join(sorted(format)), sample):
+            digest.update(repr(part).encode('utf-8'))
+            digest.update(b'\0')
+        return digest.hexdigest()
+
+    def entry_path(self, key):
+        return self.path / key[:2] / f'{key}.pickle'
+
+    def get(self, key):
+        if key is None:
+            return None
+        start = time.perf_counter()
+        entry_path = self.entry_path(key)
+        try:
+            with open(entry_path, 'rb') as entry_file:
+                entry = pickle.load(entry_file)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            self.misses += 1
+            return None
+        os.utime(entry_path)
+        self.hits += 1
+        self.saved += max(entry['elapsed'] - (time.perf_counter() - start), 0.0)
+        return entry['result']
+
+    def put(self, key, result, elapsed):
+        if key is None:
+            return
+        entry_path = self.entry_path(key)
+        entry_path.parent.mkdir(parents=True, exist_ok=True)
+        partial = entry_path.with_suffix(f'.{os.getpid()}.partial')
+        with open(partial, 'wb') as entry_file:
+            pickle.dump(
+                {'elapsed': elapsed, 'result': result},
+                entry_file,
+                protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(partial, entry_path)
+        self.evict()
+
+    def entries(self):
+        if not self.path.exists():
+            return []
+        return [
+            entry
+            for directory in os.scandir(self.path)
+            if directory.is_dir()
+            for entry in os.scandir(directory.path)
+            if entry.name.endswith('.pickle')]
+
+    def evict(self):
+        entries = self.entries()
+        total = sum(entry.stat().st_size for entry in entries)
+        if total <= self.size:
+            return
+        # the newest entry stays, however large
+        entries.sort(key=lambda entry: entry.stat().st_mtime)
+        for entry in entries[:-1]:
+            if total <= self.size:
+                break
+            total -= entry.stat().st_size
+            os.remove(entry.path)
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'bypassed': self.bypassed,
+            'saved': self.saved,
+            'entries': len(self.entries())}
+
+    def run(self, system, run, subcommand='sim', steps=None, format='json', sample=None):
+        ''' the result of `run()` for this system, from the cache when it is there '''
+        key = self.key(system.render(), subcommand, steps, format, sample)
+        result = self.get(key)
+        if result is not None:
+            return result
+        start = time.perf_counter()
+        result = run()
+        self.put(key, result, time.perf_counter() - start)
+        return result
+
+
+def test_result_cache(tmp_path):
+    from bigraph.fake import fake_system, fake_environment
+
+    path = tmp_path
+    system = fake_system(path)
+    system.path = Path(path) / 'system'
+    log = Path(path) / 'log'
+    cache = ResultCache(Path(path) / 'cache')
+
+    def runs():
+        with open(log, 'r') as log_file:
+            return len(log_file.readlines())
+
+    with fake_environment(log=log, delay=0.1):
+        first = system.simulate(steps=2, format='json', cache=cache, sample=1)
+        again = system.simulate(steps=2, format='json', cache=cache, sample=1)
+        assert runs() == 1
+        assert [state.render() for state in again] == [state.render() for state in first]
+
+        # another sample, other steps or no sample at all run bigrapher again
+        system.simulate(steps=2, format='json', cache=cache, sample=2)
+        system.simulate(steps=3, format='json', cache=cache, sample=1)
+        system.simulate(steps=2, format='json', cache=cache)
+        system.simulate(steps=2, format='json', cache=cache)
+        assert runs() == 5
+
+    stats = cache.stats()
+    assert stats['hits'] == 1 and stats['bypassed'] == 2 and stats['entries'] == 3
+    assert stats['saved'] > 0.05
+
+    # a small cache keeps only the most recently used entries
+    small = ResultCache(Path(path) / 'small', size=1)
+    for steps in range(3):
+        small.put(small.key('model', steps=steps, sample=0), ['state'] * steps, 1.0)
+        time.sleep(0.01)
+    assert small.stats()['entries'] == 1
+    assert small.get(small.key('model', steps=2, sample=0)) == ['state', 'state']
+    assert small.get(small.key('model', steps=1, sample=0)) is None
+
+
+if __name__ == '__main__':
+    import fire
+    fire.Fire(test_result_cache)
@@ -1,6 +1,5 @@
 """Console script for bigraph."""
 
-import fire
 
 def help():
     print("bigraph")
@@ -8,6 +7,7 @@ def help():
     print("a python implementation of Robin Milner's bigraph formalism")
 
 def main():
+    import fire
     fire.Fire({
         "help": help
     })
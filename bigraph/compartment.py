@@ -0,0 +1,381 @@
+import time
+import random
+import weakref
+
+from bigraph.bigraph import Node, Merge
+from bigraph.state import is_site, is_one, term_root
+from bigraph.engine import MAXIMUM_REDUCTIONS
+from bigraph.history import read_histories, write_histories
+
+
+class Compartment():
+    '''a place holding atoms and compartments. empty nodes of each control
+    are only counted, while a node with contents is a `Compartment` of its
+    own, so the place graph is a tree of count vectors'''
+
+    __slots__ = ('control', 'counts', 'kinds', 'children', 'parent')
+
+    def __init__(self, control, size, parent=None):
+        self.control = control
+        self.counts = [0] * size
+        self.kinds = [0] * size
+        self.children = []
+        self.parent = parent
+
+    def empty(self):
+        return not self.children and not any(self.counts)
+
+    def add(self, species, content):
+        if content is None or content.empty():
+            self.counts[species] += 1
+            return None
+        content.control = species
+        content.parent = self
+        self.kinds[species] += 1
+        self.children.append(content)
+        return content
+
+
+class PatternLeaf():
+    def __init__(self, species, site):
+        self.species = species
+        self.site = site
+
+
+class PatternPart():
+    def __init__(self, species, leaves, site):
+        self.species = species
+        self.leaves = leaves
+        self.site = site
+
+
+def flatten(term):
+    if is_one(term):
+        return []
+    elif isinstance(term, Merge):
+        parts = []
+        for part in term.parts:
+            parts.extend(flatten(part))
+        return parts
+    return [term]
+
+
+class CountsReaction():
+    '''a reaction compiled into updates of count vectors. the redex may hold
+    ions `Y` and at most one node `X.(Y | ... | id)`, and the reactum is built
+    from the same shapes with the contents of the sites moved across'''
+
+    def __init__(self, reaction, species):
+        self.symbol = reaction.symbol
+        self.species = species
+        self.sites = 0
+        self.redex_leaves, self.redex_part = self.compile_redex(reaction.redex)
+        self.redex_sites = self.sites
+        self.sites = 0
+        self.reactum = self.compile_reactum(reaction.reactum)
+        if reaction.instantiation:
+            self.instantiation = [
+                int(site)
+                for site in reaction.instantiation]
+        else:
+            self.instantiation = list(range(self.sites))
+
+        self.slots = self.group(self.redex_leaves)
+        self.inner_slots = self.group(self.redex_part.leaves if self.redex_part else [])
+
+    def group(self, leaves):
+        ''' the sites of `leaves` for each species, in order '''
+        slots = {}
+        for leaf in leaves:
+            slots.setdefault(leaf.species, []).append(leaf.site)
+        return slots
+
+    def control(self, term):
+        symbol = term.control.symbol
+        if symbol not in self.species:
+            raise Exception(f'reaction {self.symbol} uses control {symbol} which is not one of {list(self.species)}')
+        return self.species.index(symbol)
+
+    def site(self):
+        site = self.sites
+        self.sites += 1
+        return site
+
+    def compile_leaf(self, term):
+        if not isinstance(term, Node) or term.subnodes is not None:
+            raise Exception(f'reaction {self.symbol} is not a compartment reaction: {term.render()}')
+        return PatternLeaf(self.control(term), self.site())
+
+    def compile_part(self, term):
+        if term.subnodes is None:
+            return self.compile_leaf(term)
+        leaves = []
+        site = None
+        for inner in flatten(term.subnodes):
+            if is_site(inner):
+                if site is not None:
+                    raise Exception(f'reaction {self.symbol} has more than one site in {term.render()}')
+                site = self.site()
+            else:
+                leaves.append(self.compile_leaf(inner))
+        if site is None:
+            raise Exception(f'reaction {self.symbol} needs a site in {term.render()}')
+        return PatternPart(self.control(term), leaves, site)
+
+    def compile_redex(self, term):
+        leaves = []
+        part = None
+        for term in flatten(term_root(term)):
+            compiled = self.compile_part(term)
+            if isinstance(compiled, PatternLeaf):
+                leaves.append(compiled)
+            elif part is None:
+                part = compiled
+            else:
+                raise Exception(f'reaction {self.symbol} has more than one compartment in its redex')
+        return leaves, part
+
+    def compile_reactum(self, term):
+        return [
+            self.compile_part(part)
+            for part in flatten(term_root(term))]
+
+
+class CountsSystem():
+    ''' the reactions and initial state of a reactive system compiled for `CountsSimulator` '''
+
+    def __init__(self, brs):
+        if brs.system is None or brs.system.init is None:
+            raise Exception('a reactive system needs a `begin ... end` system block with `init` to simulate')
+        self.species = [
+            symbol
+            for symbol in brs.controls
+            if symbol not in ('1', 'id')]
+        self.size = len(self.species)
+
+        self.classes = []
+        self.reactions = []
+        for group in brs.system.rules.rule_groups:
+            indexes = []
+            for symbol in group.rules:
+                if not isinstance(symbol, str):
+                    raise Exception(f'counts simulation does not support parameterised rule {symbol}')
+                if symbol not in brs.reactions:
+                    raise Exception(f'rule {symbol} has no matching reaction')
+                indexes.append(len(self.reactions))
+                self.reactions.append(CountsReaction(brs.reactions[symbol], self.species))
+            self.classes.append((group.deterministic, indexes))
+
+        self.initial = self.from_term(brs.bigraphs[brs.system.init.symbol].root)
+
+        from bigraph.kernel import Kernel
+        self.kernel = Kernel(self)
+
+    def from_term(self, term, control=None):
+        place = Compartment(control, self.size)
+        for part in flatten(term_root(term)):
+            if not isinstance(part, Node) or part.control.symbol not in self.species:
+                raise Exception(f'cannot count {part.render()}')
+            species = self.species.index(part.control.symbol)
+            content = None
+            if part.subnodes is not None and not is_one(part.subnodes):
+                content = self.from_term(part.subnodes, species)
+            place.add(species, content)
+        return place
+
+
+compiled_systems = weakref.WeakKeyDictionary()
+
+
+def compile_system(brs):
+    compiled = compiled_systems.get(brs)
+    if compiled is None:
+        compiled = CountsSystem(brs)
+        compiled_systems[brs] = compiled
+    return compiled
+
+
+class CountsSimulator():
+    '''simulate a compartmental system like `Metabolism`, whose reactions
+    only move ions between places and split compartments, over count vectors.
+
+    like bigrapher, each step chooses uniformly among the distinct outcomes
+    of the first standard priority class that has any, where compartments
+    holding the same lead to the same outcomes. the places, their
+    counts and the outcomes of every reaction in each place are one flat
+    integer array, `memory`, run by `kernel`, and a rewrite only recounts
+    the outcomes that read what it changed. with numba installed the kernel
+    is compiled, the first time taking about a minute before numba caches
+    it'''
+
+    def __init__(self, brs, seed=None):
+        from bigraph.kernel import seed_state
+
+        self.brs = brs
+        self.system = compile_system(brs)
+        self.kernel = self.system.kernel
+        self.species = self.system.species
+        self.size = self.system.size
+        self.classes = self.system.classes
+        self.reactions = self.system.reactions
+        self.rng = seed_state(seed)
+        self.reset()
+
+    def reset(self):
+        ''' go back to the initial state, carrying on with the same random numbers '''
+        self.memory = self.kernel.initial.copy()
+
+    def advance(self, steps=None):
+        ''' take up to `steps` transitions, or until none apply, returning how many were taken '''
+        from bigraph.kernel import advance, DONE, TERMINAL, GROW, DIVERGED
+
+        taken = 0
+        while True:
+            remaining = -1 if steps is None else steps - taken
+            count, status = advance(self.kernel.program, self.memory, self.rng, remaining)
+            taken += count
+            if status == GROW:
+                self.memory = self.kernel.grow(self.memory)
+            elif status == DIVERGED:
+                raise Exception(f'reducible rules still match after {MAXIMUM_REDUCTIONS} applications')
+            elif status == DONE or status == TERMINAL:
+                return taken
+            else:
+                raise Exception('occurrence counts are inconsistent')
+
+    def step(self):
+        ''' advance one transition, returning the applied reaction or `None` '''
+        from bigraph.kernel import APPLIED
+
+        if not self.advance(1):
+            return None
+        return self.reactions[int(self.memory[APPLIED])]
+
+    def render(self):
+        return self.kernel.render(self.memory)
+
+    def run(self, steps=None):
+        ''' the rendered states of one trajectory, starting from the initial state '''
+        self.advance(0)
+        history = [self.render()]
+        count = 0
+        while steps is None or count < steps:
+            if self.step() is None:
+                break
+            history.append(self.render())
+            count += 1
+        return history
+
+
+def simulate_counts(brs, steps=None, seed=None):
+    return CountsSimulator(brs, seed=seed).run(steps=steps)
+
+
+def run_compartments(
+        path='histories/compartments',
+        above=43,
+        steps=8888,
+        runs=1000,
+        seed=None):
+    '''simulate `Metabolism` over counts `runs` times, appending every
+    trajectory longer than `above` states to the histories file `path`'''
+    from bigraph.metabolism import Metabolism
+
+    metabolism = Metabolism().brs
+    chooser = random.Random(seed)
+    kept = 0
+    for run in range(runs):
+        history = simulate_counts(metabolism, steps=steps, seed=chooser.getrandbits(64))
+        if len(history) > above:
+            write_histories(path, [history])
+            kept += 1
+    return kept
+
+
+def kolmogorov_smirnov(a, b):
+    ''' the largest distance between the empirical distributions of `a` and `b` '''
+    a = sorted(a)
+    b = sorted(b)
+    distance = 0.0
+    i = j = 0
+    while i < len(a) and j < len(b):
+        value = min(a[i], b[j])
+        while i < len(a) and a[i] == value:
+            i += 1
+        while j < len(b) and b[j] == value:
+            j += 1
+        distance = max(distance, abs(i / len(a) - j / len(b)))
+    return distance
+
+
+def test_counts_simulator(tmp_path):
+    from bigraph.parse import bigraph
+    from bigraph.state import State
+    from bigraph.metabolism import Metabolism
+
+    metabolism = Metabolism().brs
+    initial = State.from_term(metabolism.bigraphs['initial'].root).canonical()
+    history = simulate_counts(metabolism, seed=4)
+    assert State.from_term(bigraph(history[0])).canonical() == initial
+    for line in history:
+        assert len(State.from_term(bigraph(line))) == 21
+
+    # the reactions end once every atom is an empty B
+    assert history[-1] == ' | '.join(['B'] * 21)
+
+    path = tmp_path / 'histories'
+    write_histories(path, [history, history[:3]])
+    histories = read_histories(path)
+    assert [[line.strip() for line in lines] for lines in histories] == [history, history[:3]]
+
+
+def test_bigrapher_statistics(path='histories/metabolism', runs=600):
+    '''trajectory lengths match the bigrapher runs recorded in `path`,
+    by a two sample Kolmogorov-Smirnov test at the 1% level'''
+    import pytest
+    from bigraph.metabolism import Metabolism
+
+    recorded = [
+        len(history)
+        for history in read_histories(path)]
+    if not recorded:
+        pytest.skip(f'no histories at {path}')
+
+    metabolism = Metabolism().brs
+    lengths = [
+        len(simulate_counts(metabolism, steps=8888, seed=seed))
+        for seed in range(runs)]
+
+    critical = 1.63 * ((len(lengths) + len(recorded)) / (len(lengths) * len(recorded))) ** 0.5
+    assert kolmogorov_smirnov(lengths, recorded) < critical
+
+
+def benchmark_compartments(runs=100000):
+    from bigraph.metabolism import Metabolism
+    from bigraph.engine import Simulator
+
+    metabolism = Metabolism().brs
+
+    # the first run compiles the kernel, or loads it from numba's cache
+    simulator = CountsSimulator(metabolism, seed=0)
+    simulator.advance()
+
+    start = time.perf_counter()
+    steps = 0
+    for run in range(runs):
+        simulator.reset()
+        steps += simulator.advance()
+    elapsed = time.perf_counter() - start
+    print(f'counts: {steps} steps in {elapsed:.3f}s, {steps / elapsed:.0f} steps per second')
+
+    start = time.perf_counter()
+    simulator = Simulator(metabolism, seed=1)
+    for step in range(1000):
+        simulator.step()
+    elapsed = time.perf_counter() - start
+    print(f'native: 1000 steps in {elapsed:.3f}s, {1000 / elapsed:.0f} steps per second')
+
+
+if __name__ == '__main__':
+    import fire
+    fire.Fire(run_compartments)
@@ -0,0 +1,562 @@
+import ast
+import time
+import random
+import shutil
+import itertools
+import operator
+
+from bigraph.bigraph import Param, Range
+from bigraph.state import State
+from bigraph.match import Pattern, compile_reaction, atomic_controls, param_value
+from bigraph.incremental import MatchStore, outcome_key
+
+
+OPERATORS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.USub: operator.neg}
+
+# reducible classes are applied until none of their rules match. a class
+# that never stops matching is reported rather than looping forever
+MAXIMUM_REDUCTIONS = 100000
+
+
+def evaluate_param(value, bindings):
+    ''' substitute bound parameters into a reactum parameter like `m+n` '''
+    if not isinstance(value, str) or not bindings:
+        return value
+    if value in bindings:
+        return bindings[value]
+    if value.startswith('"'):
+        return value
+
+    def evaluate(node):
+        if isinstance(node, ast.Expression):
+            return evaluate(node.body)
+        elif isinstance(node, ast.Constant):
+            return node.value
+        elif isinstance(node, ast.Name):
+            if node.id not in bindings:
+                raise KeyError(node.id)
+            return param_value(bindings[node.id])
+        elif isinstance(node, ast.BinOp) and type(node.op) in OPERATORS:
+            return OPERATORS[type(node.op)](evaluate(node.left), evaluate(node.right))
+        elif isinstance(node, ast.UnaryOp) and type(node.op) in OPERATORS:
+            return OPERATORS[type(node.op)](evaluate(node.operand))
+        raise ValueError(value)
+
+    try:
+        return evaluate(ast.parse(value, mode='eval'))
+    except (SyntaxError, KeyError, ValueError, TypeError, ZeroDivisionError):
+        return value
+
+
+def binding_values(value, bindings):
+    ''' the concrete values a rule parameter ranges over '''
+    if isinstance(value, str) and value in bindings:
+        return binding_values(bindings[value], bindings)
+    elif isinstance(value, Range):
+        start = binding_values(value.start, bindings)[0]
+        step = binding_values(value.step, bindings)[0]
+        stop = binding_values(value.stop, bindings)[0]
+        return list(range(int(start), int(stop) + 1, int(step)))
+    elif isinstance(value, (list, tuple)):
+        values = []
+        for item in value:
+            values.extend(binding_values(item, bindings))
+        return values
+    return [value]
+
+
+class Change():
+    def __init__(self, removed, touched):
+        self.removed = removed
+        self.touched = touched
+
+
+class Rule():
+    ''' a reaction compiled for rewriting, with concrete `fun` parameters '''
+
+    def __init__(self, reaction, controls=None, bindings=None):
+        self.reaction = reaction
+        self.symbol = reaction.symbol
+        self.bindings = bindings or {}
+        self.compiled = compile_reaction(reaction, controls)
+        self.reactum = Pattern(
+            reaction.reactum,
+            variables=reaction.params,
+            atomic=atomic_controls(controls),
+            ordered=True)
+        if len(self.reactum.regions) != len(self.compiled.redex.regions):
+            raise Exception(f'reaction {self.symbol} has {len(self.compiled.redex.regions)} redex regions but {len(self.reactum.regions)} reactum regions')
+        self.instantiation = reaction.instantiation or None
+
+    def label(self):
+        if not self.bindings:
+            return self.symbol
+        params = ','.join([
+            str(self.bindings.get(param))
+            for param in self.reaction.params])
+        return f'{self.symbol}({params})'
+
+    def matches(self, state, places=None, anchors=None):
+        return self.compiled.matches(
+            state,
+            bindings=self.bindings,
+            places=places,
+            anchors=anchors)
+
+    def rate(self):
+        arrow = self.reaction.arrow
+        if not arrow:
+            return 1.0
+        return float(param_value(evaluate_param(arrow[0], self.bindings)))
+
+    def site_source(self, site):
+        if self.instantiation is None:
+            return site
+        if site < len(self.instantiation):
+            return int(self.instantiation[site])
+        return None
+
+    def rewrite(self, state, match):
+        '''replace the occurrence `match` of the redex in `state` with the
+        reactum, in place. returns a `Change` naming the removed nodes, and
+        the nodes that were added or moved together with the places whose
+        children changed'''
+
+        params = match.params
+        for roots in params:
+            for root in roots:
+                state.detach(root)
+
+        removed = []
+        for region in match.pattern.regions:
+            for part in region.parts:
+                state.remove_subtree(match.nodes[part.index], removed)
+
+        touched = set()
+        placed = [False] * len(params)
+        bindings = match.bindings
+
+        # names of the reactum the redex does not bind are new links
+        fresh = {}
+
+        def name_link(name):
+            if name in match.links:
+                return match.links[name]
+            if name not in fresh:
+                fresh[name] = state.fresh_name(name, taken=fresh.values())
+            return fresh[name]
+
+        def fill(site, place):
+            source = self.site_source(site)
+            if source is None or source >= len(params):
+                return
+            for root in params[source]:
+                if placed[source]:
+                    touched.add(state.copy_subtree(root, place))
+                else:
+                    state.attach(root, place)
+                    touched.add(root)
+            placed[source] = True
+
+        def build(pattern, place):
+            id = state.add_node(
+                place,
+                pattern.control,
+                [evaluate_param(param, bindings) for param in pattern.params],
+                [name_link(name) for name in pattern.ports])
+            touched.add(id)
+            for child in pattern.children:
+                build(child, id)
+            for site in pattern.sites:
+                fill(site, id)
+
+        for region, place in zip(self.reactum.regions, match.places):
+            touched.add(place)
+            for part in region.parts:
+                build(part, place)
+            for site in region.sites:
+                fill(site, place)
+
+        for source, roots in enumerate(params):
+            if not placed[source]:
+                for root in roots:
+                    state.remove_subtree(root, removed)
+
+        return Change(removed, touched)
+
+
+def system_rules(brs):
+    '''expand the priority classes of `brs.system.rules` into lists of
+    `Rule`, instantiating each `fun` reaction over its parameter values.
+    returns a list of `(reducible, rules)` in order of priority'''
+
+    system = brs.system
+    if system is None:
+        raise Exception('a reactive system needs a `begin ... end` system block to simulate')
+
+    bindings = {
+        binding.symbol: binding.value
+        for binding in system.bindings}
+
+    classes = []
+    for group in system.rules.rule_groups:
+        rules = []
+        for rule in group.rules:
+            if isinstance(rule, Param):
+                symbol = rule.symbol
+                values = [
+                    binding_values(param, bindings)
+                    for param in rule.params]
+            else:
+                symbol = rule
+                values = []
+            if symbol not in brs.reactions:
+                raise Exception(f'rule {symbol} has no matching reaction')
+            reaction = brs.reactions[symbol]
+            for combination in itertools.product(*values):
+                rules.append(Rule(
+                    reaction,
+                    controls=brs.controls,
+                    bindings=dict(zip(reaction.params, combination))))
+        classes.append((group.deterministic, rules))
+
+    return classes
+
+
+def initial_state(brs):
+    if brs.system is None or brs.system.init is None:
+        raise Exception('a reactive system needs an `init` bigraph to simulate')
+    symbol = brs.system.init.symbol
+    if symbol not in brs.bigraphs:
+        raise Exception(f'init bigraph {symbol} is not defined')
+    return State.from_term(brs.bigraphs[symbol].root, controls=brs.controls)
+
+
+class Simulator():
+    '''apply the reactions of a `BigraphicalReactiveSystem` in process.
+
+    priority classes are tried in order each step. a reducible class, written
+    `(...)` and held as a deterministic `RuleGroup`, is applied to its first
+    match until it no longer matches, without recording a transition. the
+    first standard class `{...}` with any match chooses uniformly among the
+    distinct outcomes of its occurrences, as bigrapher does, and one
+    occurrence of the chosen outcome becomes the next transition. occurrences
+    of a rule rewriting places that are the same up to swapping equal
+    subtrees, from subtrees equal up to the order of siblings, are one
+    outcome, found without rewriting.
+
+    with `incremental` the occurrences are kept in a `MatchStore` and only
+    searched again around the nodes each rewrite changes'''
+
+    def __init__(self, brs, seed=None, state=None, incremental=True):
+        self.brs = brs
+        self.random = random.Random(seed)
+        self.classes = system_rules(brs)
+        self.state = state.copy() if state is not None else initial_state(brs)
+        self.transitions = []
+
+        self.rules = []
+        self.groups = []
+        for reducible, rules in self.classes:
+            start = len(self.rules)
+            self.rules.extend(rules)
+            self.groups.append((reducible, range(start, len(self.rules))))
+        self.store = MatchStore(self.state, self.rules, outcomes=True) if incremental else None
+
+    def apply(self, index, match):
+        change = self.rules[index].rewrite(self.state, match)
+        if self.store is not None:
+            self.store.update(change)
+        return self.rules[index]
+
+    def first_match(self, index):
+        if self.store is not None:
+            return self.store.matches[index].first()
+        return next(self.rules[index].matches(self.state), None)
+
+    def reduce(self):
+        for count in range(MAXIMUM_REDUCTIONS):
+            applied = False
+            for reducible, indexes in self.groups:
+                if not reducible:
+                    continue
+                for index in indexes:
+                    match = self.first_match(index)
+                    if match is not None:
+                        self.apply(index, match)
+                        applied = True
+                        break
+                if applied:
+                    break
+            if not applied:
+                return
+        raise Exception(f'reducible rules still match after {MAXIMUM_REDUCTIONS} applications')
+
+    def candidates(self, indexes):
+        if self.store is not None:
+            return [
+                (index, match)
+                for index in indexes
+                for match in self.store.matches[index]]
+        return [
+            (index, match)
+            for index in indexes
+            for match in self.rules[index].matches(self.state)]
+
+    def outcomes(self, indexes):
+        '''the distinct outcomes of the rules in `indexes`, each as an
+        `(index, match)` reaching it. occurrences of a rule with the same
+        `incremental.outcome_key` are one outcome'''
+        if self.store is not None:
+            return [
+                (index, self.store.matches[index].get(next(iter(members))))
+                for index in indexes
+                for members in self.store.groups[index]]
+
+        digests = {}
+        outcomes = {}
+        for index, match in self.candidates(indexes):
+            outcomes.setdefault((index, outcome_key(self.state, match, digests)), (index, match))
+        return list(outcomes.values())
+
+    def choose(self, indexes):
+        ''' an occurrence of the rules in `indexes` chosen uniformly among their distinct outcomes, or `None` '''
+        if self.store is None:
+            outcomes = self.outcomes(indexes)
+            return self.random.choice(outcomes) if outcomes else None
+
+        total = sum(len(self.store.groups[index]) for index in indexes)
+        if total == 0:
+            return None
+        position = self.random.randrange(total)
+        for index in indexes:
+            groups = self.store.groups[index]
+            if position < len(groups):
+                return index, self.store.matches[index].get(next(iter(groups.at(position))))
+            position -= len(groups)
+
+    def step(self):
+        ''' advance one transition, returning the applied rule or `None` '''
+        self.reduce()
+        for reducible, indexes in self.groups:
+            if reducible:
+                continue
+            chosen = self.choose(indexes)
+            if chosen is not None:
+                rule = self.apply(*chosen)
+                self.reduce()
+                return rule
+        return None
+
+    def run(self, steps=None, terms=True):
+        '''simulate up to `steps` transitions, or until no rule applies.
+        returns the trajectory as bigraph terms (or `State` copies when
+        `terms` is false), starting with the initial state'''
+
+        self.reduce()
+        history = [self.state.to_term() if terms else self.state.copy()]
+        count = 0
+        while steps is None or count < steps:
+            rule = self.step()
+            if rule is None:
+                break
+            self.transitions.append((count, count + 1, rule.label()))
+            history.append(self.state.to_term() if terms else self.state.copy())
+            count += 1
+        return history
+
+
+def simulate_native(brs, steps=None, seed=None, terms=True, incremental=True):
+    return Simulator(brs, seed=seed, incremental=incremental).run(steps=steps, terms=terms)
+
+
+HELLO = '''
+ctrl Hello = 0;
+ctrl World = 0;
+
+react add_world =
+    Hello
+    -->
+    Hello.World;
+
+big initial = Hello.1;
+
+begin brs
+    init initial;
+    rules = [
+        {add_world}
+    ];
+end
+'''
+
+
+def test_native_simulator():
+    from bigraph.parse import bigraph
+    from bigraph.metabolism import Metabolism
+
+    hello = bigraph(HELLO)
+    history = simulate_native(hello, steps=6)
+    assert [state.render() for state in history] == [
+        'Hello',
+        'Hello.World',
+        'Hello.World.World',
+        'Hello.World.World.World',
+        'Hello.World.World.World.World',
+        'Hello.World.World.World.World.World',
+        'Hello.World.World.World.World.World.World']
+
+    reducible = bigraph('''
+        ctrl A = 0;
+        ctrl B = 0;
+        react grow = A.id --> A.(B.1 | id);
+        react collapse = B | B --> B;
+        big initial = A.1;
+        begin brs
+            init initial;
+            rules = [(collapse), {grow}];
+        end''')
+    history = simulate_native(reducible, steps=4)
+    assert [state.render() for state in history] == ['A', 'A.B', 'A.B', 'A.B', 'A.B']
+
+    fun = bigraph('''
+        fun ctrl C(n) = 0;
+        fun react count(m) = C(m) --> C(m+1);
+        big initial = C(0).1;
+        begin brs
+            int limit = [0:1:2];
+            init initial;
+            rules = [{count(limit)}];
+        end''')
+    history = simulate_native(fun, steps=10)
+    assert [state.render() for state in history] == ['C(0)', 'C(1)', 'C(2)', 'C(3)']
+
+    metabolism = Metabolism().brs
+    simulator = Simulator(metabolism, seed=5)
+    history = simulator.run(steps=200, terms=False)
+    assert all(len(state) == 21 for state in history)
+    assert len(simulator.transitions) == len(history) - 1
+
+    for system in [hello, reducible, fun]:
+        assert [state.render() for state in simulate_native(system, steps=6, incremental=False)] == [
+            state.render()
+            for state in simulate_native(system, steps=6)]
+
+    # the two occurrences of `a` lead to the same state, so it is one outcome
+    twice = bigraph('''
+        ctrl A = 0;
+        ctrl B = 0;
+        ctrl C = 0;
+        ctrl D = 0;
+        react a = A --> B;
+        react c = C --> D;
+        big initial = A.1 | A.1 | C.1;
+        begin brs
+            init initial;
+            rules = [{a, c}];
+        end''')
+    for incremental in (True, False):
+        simulator = Simulator(twice, incremental=incremental)
+        assert len(simulator.candidates(range(2))) == 3
+        assert len(simulator.outcomes(range(2))) == 2
+
+    # so are those in compartments equal up to the order of their contents
+    compartments = bigraph('''
+        ctrl B = 0;
+        ctrl F = 0;
+        react degrade = F --> 1;
+        big initial = B.(F.1 | B.1) | B.(B.1 | F.1) | B.(F.1 | F.1);
+        begin brs
+            init initial;
+            rules = [{degrade}];
+        end''')
+    for incremental in (True, False):
+        simulator = Simulator(compartments, incremental=incremental)
+        assert len(simulator.candidates(range(1))) == 4
+        assert len(simulator.outcomes(range(1))) == 2
+
+    # a name the redex does not bind is a new link, apart from any already there
+    fresh = bigraph('''
+        ctrl A = 0;
+        ctrl L = 1;
+        react link = A --> A.(L{x} | L{x});
+        big initial = A.1 | L{x}.1;
+        begin brs
+            init initial;
+            rules = [{link}];
+        end''')
+    assert simulate_native(fresh, steps=1)[-1].render() == 'L{x} | A.(L{x1} | L{x1})'
+
+
+def test_bigrapher_agreement(tmp_path, executable='bigrapher'):
+    import pytest
+    from bigraph.parse import bigraph
+
+    if shutil.which(executable) is None:
+        pytest.skip(f'{executable} not found')
+
+    hello = bigraph(HELLO)
+    hello.executable = executable
+    expected = hello.simulate(path=tmp_path, steps=6, format='json')
+    native = simulate_native(hello, steps=6, terms=False)
+    assert [State.from_term(state).canonical() for state in expected] == [
+        state.canonical()
+        for state in native]
+
+
+def benchmark_native(steps=1000, executable='bigrapher', path='out/test/benchmark'):
+    from bigraph.metabolism import Metabolism
+
+    metabolism = Metabolism().brs
+    start = time.perf_counter()
+    history = simulate_native(metabolism, steps=steps, seed=1, terms=False)
+    elapsed = time.perf_counter() - start
+    print(f'native: {len(history) - 1} steps in {elapsed:.3f}s, {(len(history) - 1) / elapsed:.0f} steps per second')
+
+    if shutil.which(executable) is None:
+        print(f'{executable} not found, skipping subprocess benchmark')
+        return
+
+    metabolism.executable = executable
+    start = time.perf_counter()
+    history = metabolism.simulate(path=path, key='metabolism', steps=steps, format='json')
+    elapsed = time.perf_counter() - start
+    print(f'bigrapher: {len(history) - 1} steps in {elapsed:.3f}s, {(len(history) - 1) / elapsed:.0f} steps per second')
+
+
+def benchmark_outcomes(sizes=(200, 2000), steps=200):
+    '''steps of the reactions of `Metabolism` within one place, from `sizes`
+    full compartments of five nodes each, so the larger state has about
+    10^4 nodes'''
+    from bigraph.bigraph import BigraphicalReactiveSystem, System, Rules, RuleGroup
+    from bigraph.metabolism import Metabolism
+    from bigraph.incremental import compartments
+
+    metabolism = Metabolism().brs
+    local = BigraphicalReactiveSystem(
+        controls=metabolism.controls,
+        reactions=metabolism.reactions,
+        system=System(rules=Rules(rule_groups=[
+            RuleGroup(
+                deterministic=False,
+                rules=['b', 'phi', 'degrade_F', 'degrade_Phi'])])))
+
+    for size in sizes:
+        state = State.from_term(compartments(size), controls=metabolism.controls)
+        simulator = Simulator(local, seed=1, state=state)
+        start = time.perf_counter()
+        for step in range(steps):
+            simulator.step()
+        elapsed = time.perf_counter() - start
+        occurrences = len(simulator.candidates(range(len(simulator.rules))))
+        outcomes = len(simulator.outcomes(range(len(simulator.rules))))
+        print(f'{len(simulator.state)} nodes, {occurrences} occurrences, {outcomes} outcomes: {elapsed / steps * 1e6:.0f} microseconds per step')
+
+
+if __name__ == '__main__':
+    import fire
+    fire.Fire(benchmark_native)
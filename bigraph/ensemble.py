@@ -0,0 +1,354 @@
+import time
+
+from bigraph.compartment import CountsSimulator, compile_system, kolmogorov_smirnov
+from bigraph.history import read_histories, write_histories
+
+
+# the reactions of `Metabolism` the ensemble reproduces, by family
+METABOLISM_REACTIONS = ('b', 'phi', 'degrade_F', 'degrade_Phi', 'fB_', 'fF_', 'fPhi_', 'degrade_B_', 'divide_')
+
+
+class Ensemble():
+    '''advance many independent replicas of `Metabolism` in lock step.
+
+    every replica has the same fixed topology: place 0 is the root region
+    and places `1..compartments` are slots for compartments directly inside
+    it, so the state of the whole ensemble is an array of atom counts of
+    shape (replicas, places, species) together with the control of the node
+    holding each slot, or -1 for a free slot.
+
+    each step chooses, for every live replica at once, one outcome of the
+    reactions uniformly among the distinct outcomes, with empty atoms of one
+    control in one place interchangeable as in `CountsSimulator`. division
+    takes priority as in `Metabolism`, and fills the first free slot.
+    moving a compartment into another compartment would nest them, which
+    this topology cannot hold, so only atoms move inwards. replicas with no
+    outcome left are masked out, and one that needs more slots than there
+    are stops and is marked as `overflow`. it needs the `ensemble` extra,
+    numpy'''
+
+    def __init__(self, brs, replicas=1024, compartments=8, seed=None, record=True):
+        import numpy as np
+
+        system = compile_system(brs)
+        for family in METABOLISM_REACTIONS:
+            if not any(reaction.symbol.startswith(family) for reaction in system.reactions):
+                raise Exception(f'ensemble needs the Metabolism reaction {family}')
+
+        self.species = system.species
+        self.B = self.species.index('B')
+        self.F = self.species.index('F')
+        self.Phi = self.species.index('Phi')
+        self.size = len(self.species)
+        self.replicas = replicas
+        self.compartments = compartments
+        self.places = compartments + 1
+        self.random = np.random.default_rng(seed)
+        self.record = record
+
+        initial = system.initial
+        if len(initial.children) > compartments:
+            raise Exception(f'initial state has {len(initial.children)} compartments but the ensemble has {compartments} slots')
+        counts = np.zeros((self.places, self.size), dtype=np.int32)
+        kind = np.full(self.places, -1, dtype=np.int32)
+        counts[0] = initial.counts
+        for slot, child in enumerate(initial.children, start=1):
+            if child.children:
+                raise Exception('the ensemble only holds compartments of atoms inside the root')
+            counts[slot] = child.counts
+            kind[slot] = child.control
+
+        self.counts = np.repeat(counts[None], replicas, axis=0)
+        self.kind = np.repeat(kind[None], replicas, axis=0)
+        self.alive = np.ones(replicas, dtype=bool)
+        self.overflow = np.zeros(replicas, dtype=bool)
+        self.lifetimes = np.ones(replicas, dtype=np.int64)
+        self.steps = 0
+
+        # the channels each reaction family occupies in the weight matrix
+        leaf = 4 * self.places
+        move = leaf + self.compartments * self.size
+        degrade = move + self.compartments
+        divide = degrade + self.compartments
+        self.blocks = (leaf, move, degrade, divide)
+        self.history = []
+        if record:
+            self.remember()
+
+    def remember(self):
+        import numpy as np
+
+        alive = np.flatnonzero(self.alive)
+        self.history.append((
+            alive,
+            self.counts[alive].astype(np.int16),
+            self.kind[alive].astype(np.int8)))
+
+    def weights(self, replicas):
+        '''the number of distinct outcomes of every reaction channel, in an
+        array of shape (len(replicas), channels). the channels are the atom
+        reactions b, phi, degrade_F and degrade_Phi in each place, then
+        moving an atom of each species into each slot, then degrading a B
+        out of each slot, and last dividing each slot'''
+        import numpy as np
+
+        B, F, Phi = self.B, self.F, self.Phi
+        counts = self.counts[replicas]
+        kind = self.kind[replicas]
+        rows = len(replicas)
+
+        # in the root, atoms of one species count once and each compartment once
+        present = (counts > 0).astype(np.int64)
+        present[:, 0, :] += (kind[:, 1:, None] == np.arange(self.size)).sum(axis=1)
+        occupied = kind[:, 1:] >= 0
+
+        leaf = np.stack([
+            present[:, :, B] * present[:, :, F],
+            present[:, :, Phi] * present[:, :, B],
+            present[:, :, F],
+            present[:, :, Phi]], axis=2).reshape(rows, -1)
+
+        inner = counts[:, 1:, :]
+        move = (
+            (occupied & (inner[:, :, F] > 0))[:, :, None]
+            & (counts[:, 0, None, :] > 0)).reshape(rows, -1)
+        degrade = occupied & (inner[:, :, B] > 0)
+        divide = occupied & (inner[:, :, F] >= 2) & (inner[:, :, Phi] >= 2) & (inner[:, :, B] >= 3)
+
+        weights = np.concatenate([leaf, move, degrade, divide], axis=1).astype(np.float64)
+
+        # division is in a higher priority class than everything else
+        dividing = divide.any(axis=1)
+        weights[dividing, :self.blocks[2]] = 0.0
+        return weights
+
+    def choose(self, weights):
+        ''' a channel for each row of `weights`, and whether the row had any '''
+        import numpy as np
+
+        cumulative = np.cumsum(weights, axis=1)
+        totals = cumulative[:, -1]
+        threshold = self.random.random(len(weights)) * totals
+        channels = (cumulative > threshold[:, None]).argmax(axis=1)
+        return totals > 0, channels
+
+    def convert(self, replicas, places, source, target):
+        ''' turn one node of `source` into `target` in each of `places` '''
+        import numpy as np
+
+        inside = places > 0
+        if inside.any():
+            rows = replicas[inside]
+            self.counts[rows, places[inside], source[inside]] -= 1
+            self.counts[rows, places[inside], target[inside]] += 1
+
+        root = ~inside
+        if root.any():
+            rows = replicas[root]
+            source = source[root]
+            target = target[root]
+            atoms = self.counts[rows, 0, source] > 0
+            slots = self.kind[rows, 1:] == source[:, None]
+            items = atoms + slots.sum(axis=1)
+            choice = np.floor(self.random.random(len(rows)) * items).astype(np.int64)
+
+            atom = atoms & (choice == 0)
+            self.counts[rows[atom], 0, source[atom]] -= 1
+            self.counts[rows[atom], 0, target[atom]] += 1
+
+            node = ~atom
+            if node.any():
+                rank = choice[node] - atoms[node]
+                slot = (np.cumsum(slots[node], axis=1) > rank[:, None]).argmax(axis=1) + 1
+                self.kind[rows[node], slot] = target[node]
+
+    def step(self):
+        ''' advance every live replica by one transition, returning how many are still live '''
+        import numpy as np
+
+        B, F, Phi = self.B, self.F, self.Phi
+        replicas = np.flatnonzero(self.alive)
+        live, channels = self.choose(self.weights(replicas))
+        self.alive[replicas[~live]] = False
+        replicas = replicas[live]
+        channels = channels[live]
+        leaf, move, degrade, divide = self.blocks
+
+        # b, phi, degrade_F and degrade_Phi within a place
+        chosen = channels < leaf
+        if chosen.any():
+            rows = replicas[chosen]
+            places, reaction = np.divmod(channels[chosen], 4)
+            source = np.array([F, B, F, Phi])[reaction]
+            target = np.array([Phi, F, B, F])[reaction]
+            self.convert(rows, places, source, target)
+
+        # fB_, fF_ and fPhi_ move an atom from the root into a slot
+        chosen = (channels >= leaf) & (channels < move)
+        if chosen.any():
+            rows = replicas[chosen]
+            slot, species = np.divmod(channels[chosen] - leaf, self.size)
+            self.counts[rows, 0, species] -= 1
+            self.counts[rows, slot + 1, species] += 1
+
+        # degrade_B_ moves a B out of a slot, which may leave it empty
+        chosen = (channels >= move) & (channels < degrade)
+        if chosen.any():
+            rows = replicas[chosen]
+            slot = channels[chosen] - move + 1
+            self.counts[rows, slot, B] -= 1
+            self.counts[rows, 0, B] += 1
+            empty = self.counts[rows, slot].sum(axis=1) == 0
+            rows, slot = rows[empty], slot[empty]
+            self.counts[rows, 0, self.kind[rows, slot]] += 1
+            self.kind[rows, slot] = -1
+
+        # divide_ splits F, Phi and B off into a new B in the first free slot
+        chosen = (channels >= degrade) & (channels < divide)
+        if chosen.any():
+            rows = replicas[chosen]
+            slot = channels[chosen] - degrade + 1
+            free = self.kind[rows, 1:] < 0
+            full = ~free.any(axis=1)
+            if full.any():
+                self.overflow[rows[full]] = True
+                self.alive[rows[full]] = False
+                rows, slot, free = rows[~full], slot[~full], free[~full]
+            target = free.argmax(axis=1) + 1
+            self.counts[rows, slot, F] -= 1
+            self.counts[rows, slot, Phi] -= 1
+            self.counts[rows, slot, B] -= 2
+            self.counts[rows, target] = 0
+            self.counts[rows, target, F] = 1
+            self.counts[rows, target, Phi] = 1
+            self.counts[rows, target, B] = 1
+            self.kind[rows, target] = B
+
+        self.lifetimes[self.alive] += 1
+        self.steps += 1
+        if self.record:
+            self.remember()
+        return int(self.alive.sum())
+
+    def run(self, steps=8888):
+        '''advance until every replica has stopped or `steps` transitions
+        have passed, returning the number of states in each trajectory'''
+        while self.steps < steps and self.step() > 0:
+            pass
+        return self.lifetimes
+
+    def render(self, counts, kind):
+        parts = []
+        for species, count in enumerate(counts[0]):
+            parts.extend([self.species[species]] * int(count))
+        for slot in range(1, self.places):
+            if kind[slot] < 0:
+                continue
+            inner = []
+            for species, count in enumerate(counts[slot]):
+                inner.extend([self.species[species]] * int(count))
+            inside = ' | '.join(inner)
+            if len(inner) > 1:
+                inside = f'({inside})'
+            parts.append(f'{self.species[kind[slot]]}.{inside}')
+        return ' | '.join(parts)
+
+    def trajectory(self, replica):
+        ''' the rendered states of one replica '''
+        import numpy as np
+
+        if not self.record:
+            raise Exception('the ensemble was not recording its trajectories')
+        states = []
+        for alive, counts, kind in self.history[:self.lifetimes[replica]]:
+            position = np.searchsorted(alive, replica)
+            states.append(self.render(counts[position], kind[position]))
+        return states
+
+    def dump(self, path, above=43):
+        ''' append the trajectories longer than `above` states to the histories file at `path` '''
+        import numpy as np
+
+        replicas = np.flatnonzero(self.lifetimes > above)
+        write_histories(path, [
+            self.trajectory(replica)
+            for replica in replicas])
+        return len(replicas)
+
+
+def run_ensemble(
+        path='histories/ensemble',
+        above=43,
+        steps=8888,
+        replicas=4096,
+        compartments=8,
+        seed=None):
+    '''search for long lived `Metabolism` trajectories with a lock step
+    ensemble, appending those longer than `above` states to `path`'''
+    from bigraph.metabolism import Metabolism
+
+    ensemble = Ensemble(
+        Metabolism().brs,
+        replicas=replicas,
+        compartments=compartments,
+        seed=seed)
+    lifetimes = ensemble.run(steps=steps)
+    kept = ensemble.dump(path, above=above)
+    print(f'{kept} of {replicas} trajectories above {above}, longest {lifetimes.max()}, {ensemble.overflow.sum()} overflowed')
+    return kept
+
+
+def test_ensemble(tmp_path):
+    import pytest
+    pytest.importorskip('numpy')
+
+    from bigraph.parse import bigraph
+    from bigraph.state import State
+    from bigraph.metabolism import Metabolism
+
+    metabolism = Metabolism().brs
+    ensemble = Ensemble(metabolism, replicas=600, compartments=8, seed=3)
+    assert ensemble.trajectory(0)[0] == CountsSimulator(metabolism).render()
+    lifetimes = ensemble.run()
+    assert not ensemble.alive.any()
+    assert not ensemble.overflow.any()
+
+    # atoms and compartments together always make 21 nodes
+    for alive, counts, kind in ensemble.history:
+        assert (counts.sum(axis=(1, 2)) + (kind >= 0).sum(axis=1) == 21).all()
+    for line in ensemble.trajectory(int(lifetimes.argmax()))[::5]:
+        assert len(State.from_term(bigraph(line))) == 21
+
+    # lifetimes follow those of the counts simulator
+    expected = [
+        len(CountsSimulator(metabolism, seed=seed).run(steps=8888))
+        for seed in range(400)]
+    critical = 1.63 * ((len(lifetimes) + len(expected)) / (len(lifetimes) * len(expected))) ** 0.5
+    assert kolmogorov_smirnov(list(lifetimes), expected) < critical
+
+    path = tmp_path / 'histories'
+    kept = ensemble.dump(path, above=43)
+    histories = read_histories(path)
+    assert kept == len(histories) == (lifetimes > 43).sum()
+    assert all(len(history) > 43 for history in histories)
+
+    small = Ensemble(metabolism, replicas=200, compartments=1, seed=1)
+    small.run()
+    assert small.overflow.any()
+
+
+def benchmark_ensemble(replicas=4096, steps=8888):
+    from bigraph.metabolism import Metabolism
+
+    metabolism = Metabolism().brs
+    ensemble = Ensemble(metabolism, replicas=replicas, seed=1, record=False)
+    start = time.perf_counter()
+    lifetimes = ensemble.run(steps=steps)
+    elapsed = time.perf_counter() - start
+    transitions = int((lifetimes - 1).sum())
+    print(f'ensemble: {transitions} transitions over {replicas} replicas in {elapsed:.3f}s, {transitions / elapsed:.0f} per second')
+
+
+if __name__ == '__main__':
+    import fire
+    fire.Fire(run_ensemble)
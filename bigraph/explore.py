@@ -0,0 +1,566 @@
+import os
+import time
+import pickle
+import sqlite3
+import hashlib
+import multiprocessing
+from pathlib import Path
+
+from bigraph.bigraph import Reaction
+from bigraph.engine import Simulator
+from bigraph.match import compile_reaction
+
+
+# states held in memory by each visited set and by the frontier before
+# the rest is written to disk
+MEMORY_BUDGET = 100000
+
+# frontier states sent to the workers at a time
+BATCH_SIZE = 1000
+
+
+def state_key(state):
+    '''a digest of a state that does not depend on the order of siblings or
+    the names of links other than outer names, so states that only differ
+    by how their nodes are numbered, or by the fresh names a rewrite gave
+    their links, share a key'''
+    names = state.canonical_names()
+    return hashlib.blake2b(state.canonical(names).encode('utf-8'), digest_size=16).digest()
+
+
+def key_owner(key, workers):
+    return int.from_bytes(key[:8], 'little') % workers
+
+
+def predicate_reactions(brs, predicates=None):
+    '''compile the bigraphs named by `predicates`, or by the `preds` of the
+    system when not given, into patterns that match anywhere in a state'''
+    if predicates is None:
+        system = brs.system
+        predicates = system.preds.rules.rules if system is not None and system.preds else []
+    compiled = []
+    for symbol in predicates:
+        symbol = getattr(symbol, 'symbol', symbol)
+        if symbol not in brs.bigraphs:
+            raise Exception(f'predicate {symbol} is not a defined bigraph')
+        root = brs.bigraphs[symbol].root
+        reaction = Reaction(symbol=symbol, redex=root, reactum=root)
+        compiled.append((symbol, compile_reaction(reaction, brs.controls)))
+    return compiled
+
+
+class VisitedSet():
+    '''the keys of the states seen so far, each with the id, parent key and
+    rule label it was reached by. keys are kept in memory until there are
+    more than `budget` of them, then moved to a sqlite table'''
+
+    def __init__(self, path, budget=MEMORY_BUDGET):
+        self.path = Path(path)
+        self.budget = budget
+        self.memory = {}
+        self.database = None
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def open(self):
+        if self.database is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            if self.path.exists():
+                self.path.unlink()
+            self.database = sqlite3.connect(str(self.path))
+            self.database.execute(
+                'create table visited (key blob primary key, id integer, parent blob, label text)')
+        return self.database
+
+    def get(self, key):
+        entry = self.memory.get(key)
+        if entry is None and self.database is not None:
+            row = self.database.execute(
+                'select id, parent, label from visited where key = ?',
+                (key,)).fetchone()
+            if row is not None:
+                entry = tuple(row)
+        return entry
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def add(self, key, id, parent, label):
+        self.memory[key] = (id, parent, label)
+        self.size += 1
+        if len(self.memory) > self.budget:
+            self.spill()
+
+    def spill(self):
+        database = self.open()
+        database.executemany(
+            'insert into visited values (?, ?, ?, ?)',
+            ((key, id, parent, label) for key, (id, parent, label) in self.memory.items()))
+        database.commit()
+        self.memory = {}
+
+    def close(self):
+        if self.database is not None:
+            self.database.close()
+            self.database = None
+            self.path.unlink()
+
+
+class Frontier():
+    '''the states of one level of the search, in memory up to `budget` and
+    appended to a pickle file beyond that'''
+
+    def __init__(self, path, budget=MEMORY_BUDGET):
+        self.path = Path(path)
+        self.budget = budget
+        self.memory = []
+        self.file = None
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def append(self, item):
+        self.size += 1
+        if len(self.memory) < self.budget:
+            self.memory.append(item)
+            return
+        if self.file is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self.file = open(self.path, 'wb')
+        pickle.dump(item, self.file, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def __iter__(self):
+        yield from self.memory
+        if self.file is not None:
+            self.file.close()
+            with open(self.path, 'rb') as frontier_file:
+                while True:
+                    try:
+                        yield pickle.load(frontier_file)
+                    except EOFError:
+                        break
+
+    def batches(self, size=BATCH_SIZE):
+        batch = []
+        for item in self:
+            batch.append(item)
+            if len(batch) == size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def close(self):
+        self.memory = []
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            os.remove(self.path)
+
+
+class Partition():
+    '''the states owned by one worker, those whose key falls in its share of
+    the hash space. it expands the states it owns into their successors and
+    decides which of the states sent to it have not been seen before'''
+
+    def __init__(self, brs, index=0, workers=1, path='out/explore', budget=MEMORY_BUDGET, predicates=None):
+        self.index = index
+        self.workers = workers
+        self.simulator = Simulator(brs, incremental=False)
+        self.predicates = predicate_reactions(brs, predicates)
+        self.visited = VisitedSet(Path(path) / f'visited-{index}.sqlite', budget=budget)
+
+    def reduce(self, state):
+        self.simulator.state = state
+        self.simulator.reduce()
+        return self.simulator.state
+
+    def satisfied(self, state):
+        for symbol, compiled in self.predicates:
+            if next(compiled.matches(state), None) is not None:
+                return symbol
+        return None
+
+    def initial(self):
+        state = self.reduce(self.simulator.state)
+        return state_key(state), state, self.satisfied(state)
+
+    def successors(self, state):
+        '''the states reached by applying each occurrence of the first standard
+        class with any, each followed by the reducible classes'''
+        simulator = self.simulator
+        simulator.state = state
+        for reducible, indexes in simulator.groups:
+            if reducible:
+                continue
+            found = simulator.candidates(indexes)
+            if not found:
+                continue
+            successors = []
+            for index, match in found:
+                rule = simulator.rules[index]
+                successor = state.copy()
+                rule.rewrite(successor, match)
+                successors.append((rule.label(), self.reduce(successor)))
+                simulator.state = state
+            return successors
+        return []
+
+    def expand(self, items):
+        ''' the successors of each `(key, state)`, with their keys and the predicate they satisfy '''
+        candidates = []
+        for parent, state in items:
+            seen = set()
+            for label, successor in self.successors(state):
+                key = state_key(successor)
+                if key in seen:
+                    continue
+                seen.add(key)
+                candidates.append((key, successor, parent, label, self.satisfied(successor)))
+        return candidates
+
+    def admit(self, candidates):
+        '''record the candidates not seen before, returning `(id, new)` for
+        every candidate, with the new ones assigned the next id this
+        partition owns'''
+        admitted = []
+        for key, state, parent, label, satisfied in candidates:
+            entry = self.visited.get(key)
+            if entry is None:
+                id = self.index + self.workers * len(self.visited)
+                self.visited.add(key, id, parent, label)
+                admitted.append((id, True))
+            else:
+                admitted.append((entry[0], False))
+        return admitted
+
+    def lookup(self, key):
+        return self.visited.get(key)
+
+    def close(self):
+        self.visited.close()
+
+
+def serve(connection, data, index, workers, path, budget, predicates):
+    from bigraph import binary
+
+    partition = Partition(
+        binary.loads(data),
+        index=index,
+        workers=workers,
+        path=path,
+        budget=budget,
+        predicates=predicates)
+    while True:
+        method, args = connection.recv()
+        if method == 'close':
+            partition.close()
+            connection.send(None)
+            break
+        connection.send(getattr(partition, method)(*args))
+
+
+class LocalWorker():
+    def __init__(self, partition):
+        self.partition = partition
+        self.pending = None
+
+    def submit(self, method, *args):
+        self.pending = getattr(self.partition, method)(*args)
+
+    def result(self):
+        return self.pending
+
+    def close(self):
+        self.partition.close()
+
+
+class RemoteWorker():
+    def __init__(self, data, index, workers, path, budget, predicates):
+        context = multiprocessing.get_context()
+        self.connection, remote = context.Pipe()
+        self.process = context.Process(
+            target=serve,
+            args=(remote, data, index, workers, path, budget, predicates),
+            daemon=True)
+        self.process.start()
+
+    def submit(self, method, *args):
+        self.connection.send((method, args))
+
+    def result(self):
+        return self.connection.recv()
+
+    def close(self):
+        self.submit('close')
+        self.result()
+        self.process.join()
+
+
+class Exploration():
+    '''the outcome of an exploration. when a predicate was satisfied,
+    `satisfied` names it, `witness` is the first state found satisfying it
+    and `trace` the labels of the rules leading there from the initial
+    state'''
+
+    def __init__(self, states, transitions, depth, satisfied=None, witness=None, trace=None, graph=None):
+        self.states = states
+        self.transitions = transitions
+        self.depth = depth
+        self.satisfied = satisfied
+        self.witness = witness
+        self.trace = trace
+        self.graph = graph
+
+    def __repr__(self):
+        found = f', {self.satisfied} after {self.trace}' if self.satisfied else ''
+        return f'Exploration({self.states} states, {self.transitions} transitions, depth {self.depth}{found})'
+
+
+def explore(
+        brs,
+        steps=None,
+        states=None,
+        workers=1,
+        predicates=None,
+        path='out/explore',
+        budget=MEMORY_BUDGET,
+        batch=BATCH_SIZE,
+        record=False):
+    '''explore the states reachable from the initial state of `brs` in
+    process, one level at a time, stopping after `steps` levels, after
+    `states` states, or as soon as a state matches one of the `preds` of the
+    system (or the bigraphs named in `predicates`).
+
+    states are deduplicated by `state_key`. with several `workers` each
+    worker process owns the states whose key hashes to it, so it alone
+    expands them and remembers whether they were seen. the visited sets and
+    the frontier keep up to `budget` states in memory and spill the rest to
+    files under `path`. with `record` the transitions are returned as a
+    `graph.TransitionGraph`'''
+
+    path = Path(path)
+    if workers > 1:
+        from bigraph import binary
+        data = binary.dumps(brs)
+        pool = [
+            RemoteWorker(data, index, workers, path, budget, predicates)
+            for index in range(workers)]
+    else:
+        pool = [LocalWorker(Partition(brs, path=path, budget=budget, predicates=predicates))]
+
+    sources = []
+    targets = []
+    transitions = 0
+    frontier = None
+    try:
+        start = Partition(brs, predicates=predicates, budget=budget, path=path / 'initial') if workers > 1 else pool[0].partition
+        key, state, satisfied = start.initial()
+        initial = key
+        owner = pool[key_owner(key, workers)]
+        owner.submit('admit', [(key, state, None, None, satisfied)])
+        owner.result()
+        found = (key, state, satisfied) if satisfied else None
+        count = 1
+
+        depth = 0
+        frontier = Frontier(path / f'frontier-{depth}.pickle', budget=budget)
+        frontier.append((key, state))
+        while found is None and len(frontier) > 0:
+            if steps is not None and depth >= steps:
+                break
+            if states is not None and count >= states:
+                break
+            depth += 1
+            following = Frontier(path / f'frontier-{depth}.pickle', budget=budget)
+            for items in frontier.batches(batch):
+                owned = [[] for _ in pool]
+                for item in items:
+                    owned[key_owner(item[0], workers)].append(item)
+                for worker, share in zip(pool, owned):
+                    worker.submit('expand', share)
+                candidates = []
+                for worker in pool:
+                    candidates.extend(worker.result())
+
+                routed = [[] for _ in pool]
+                for candidate in candidates:
+                    routed[key_owner(candidate[0], workers)].append(candidate)
+                for worker, share in zip(pool, routed):
+                    worker.submit('admit', share)
+                for worker, share in zip(pool, routed):
+                    for candidate, (id, new) in zip(share, worker.result()):
+                        key, state, parent, label, satisfied = candidate
+                        transitions += 1
+                        if record:
+                            sources.append(parent)
+                            targets.append(key)
+                        if not new:
+                            continue
+                        count += 1
+                        following.append((key, state))
+                        if satisfied and found is None:
+                            found = (key, state, satisfied)
+                if found is not None or (states is not None and count >= states):
+                    break
+            frontier.close()
+            frontier = following
+
+        trace = None
+        witness = None
+        satisfied = None
+        if found is not None:
+            key, witness, satisfied = found
+            trace = []
+            while True:
+                owner = pool[key_owner(key, workers)]
+                owner.submit('lookup', key)
+                id, parent, label = owner.result()
+                if parent is None:
+                    break
+                trace.append(label)
+                key = parent
+            trace.reverse()
+
+        graph = None
+        if record:
+            graph = recorded_graph(pool, workers, initial, sources, targets)
+        if workers > 1:
+            start.close()
+    finally:
+        if frontier is not None:
+            frontier.close()
+        for worker in pool:
+            worker.close()
+
+    return Exploration(count, transitions, depth, satisfied=satisfied, witness=witness, trace=trace, graph=graph)
+
+
+def recorded_graph(pool, workers, initial, sources, targets):
+    from bigraph.graph import TransitionGraph
+
+    ids = {}
+
+    def id_of(key):
+        if key not in ids:
+            owner = pool[key_owner(key, workers)]
+            owner.submit('lookup', key)
+            ids[key] = owner.result()[0]
+        return ids[key]
+
+    return TransitionGraph.from_transitions(
+        ({'source': id_of(source), 'target': id_of(target)}
+         for source, target in zip(sources, targets)),
+        initial=id_of(initial))
+
+
+RING = '''
+ctrl A = 0;
+ctrl B = 0;
+ctrl C = 0;
+
+react ab =
+    A
+    -->
+    B;
+
+react bc =
+    B
+    -->
+    C;
+
+react ca =
+    C
+    -->
+    A;
+
+big initial = A.1 | A.1;
+big both = C.1 | C.1;
+
+begin brs
+    init initial;
+    rules = [
+        {ab, bc, ca}
+    ];
+    preds = {both};
+end
+'''
+
+PAIRS = '''
+ctrl A = 0;
+ctrl L = 1;
+
+react link =
+    A
+    -->
+    L{x} | L{x};
+
+react unlink =
+    L{y} | L{y}
+    -->
+    A;
+
+big initial = A.1 | A.1;
+
+begin brs
+    init initial;
+    rules = [
+        {link, unlink}
+    ];
+end
+'''
+
+
+def test_explore(tmp_path):
+    from bigraph.parse import bigraph
+
+    path = tmp_path
+
+    ring = bigraph(RING)
+
+    # two tokens on a ring of three have six distinct configurations
+    everything = explore(ring, predicates=[], path=path, record=True)
+    assert everything.states == 6
+    assert everything.satisfied is None
+    assert len(everything.graph) == 6
+    assert everything.graph.transition_count() == everything.transitions == 9
+
+    # both tokens reach C after two moves each
+    found = explore(ring, path=path)
+    assert found.satisfied == 'both'
+    assert sorted(found.trace) == ['ab', 'ab', 'bc', 'bc']
+    assert found.witness.canonical() == 'C | C'
+
+    assert explore(ring, steps=3, path=path).satisfied is None
+    assert explore(ring, steps=1, predicates=[], path=path).states == 2
+
+    # spilling to disk and partitioning between processes change nothing
+    spilled = explore(ring, predicates=[], path=path, budget=1, batch=2)
+    assert spilled.states == 6 and spilled.transitions == 9
+    parallel = explore(ring, workers=2, path=path, budget=2)
+    assert parallel.satisfied == 'both' and len(parallel.trace) == 4
+    assert not list(Path(path).glob('*.sqlite')) and not list(Path(path).glob('*.pickle'))
+
+    # pairs linked under whichever fresh name was free are the same state
+    pairs = explore(bigraph(PAIRS), predicates=[], path=path)
+    assert pairs.states == 3 and pairs.transitions == 4
+
+
+def benchmark_explore(sizes=(4, 6, 8), workers=(1, 2)):
+    from bigraph.parse import bigraph
+
+    for size in sizes:
+        ring = bigraph(RING.replace('A.1 | A.1', ' | '.join(['A.1'] * size)))
+        for count in workers:
+            start = time.perf_counter()
+            result = explore(ring, predicates=[], workers=count)
+            elapsed = time.perf_counter() - start
+            print(f'{size} tokens, {count} workers: {result} in {elapsed:.3f}s')
+
+
+if __name__ == '__main__':
+    import fire
+    fire.Fire(benchmark_explore)
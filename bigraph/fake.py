@@ -0,0 +1,123 @@
+import os
+import sys
+import stat
+import contextlib
+from pathlib import Path
+
+
+# a stand in for the bigrapher executable. it takes the same arguments as
+# `BigraphicalReactiveSystem.execute` passes, and writes a chain of states
+# `Step(0) -> Step(1) -> ...` with one json (and txt or svg) per state next to the
+# transitions file. when FAKE_BIGRAPHER_LOG is set, each call appends its
+# arguments there, FAKE_BIGRAPHER_DELAY makes each call take that many
+# seconds to start and FAKE_BIGRAPHER_STEP that many for each state
+FAKE_BIGRAPHER = '''
+import os
+import sys
+import json
+import time
+
+arguments = sys.argv[1:]
+subcommand = arguments[0]
+
+def option(flag, default=None):
+    if flag in arguments:
+        return arguments[arguments.index(flag) + 1]
+    return default
+
+transitions = option('-t')
+steps = int(option('-S', option('-M', '3')))
+formats = option('-f', 'json').split(',')
+model = arguments[-1]
+
+log = os.environ.get('FAKE_BIGRAPHER_LOG')
+if log:
+    with open(log, 'a') as log_file:
+        log_file.write(' '.join(arguments) + '\\n')
+
+time.sleep(float(os.environ.get('FAKE_BIGRAPHER_DELAY', '0')))
+
+if not os.path.exists(model):
+    sys.stderr.write(f'no model at {model}\\n')
+    sys.exit(1)
+
+if subcommand == 'validate' or transitions is None:
+    sys.exit(0)
+
+directory = os.path.dirname(transitions)
+for index in range(steps + 1):
+    if index > 0:
+        time.sleep(float(os.environ.get('FAKE_BIGRAPHER_STEP', '0')))
+    state = {
+        'nodes': [{'node_id': 0, 'control': {'ctrl_name': 'Step', 'ctrl_arity': 0, 'ctrl_params': [{'a': index}]}}],
+        'place_graph': {'num_regions': 1, 'num_nodes': 1, 'num_sites': 0, 'rn': [{'source': 0, 'target': 0}], 'nn': [], 'ns': []},
+        'link_graph': []}
+    if 'json' in formats:
+        with open(os.path.join(directory, f'{index}.json'), 'w') as state_file:
+            json.dump(state, state_file)
+    if 'txt' in formats:
+        with open(os.path.join(directory, f'{index}.txt'), 'w') as text_file:
+            text_file.write(f'{{(0, Step({index}):0)}}\\n1 1 0\\n1\\n0\\n')
+    if 'svg' in formats:
+        with open(os.path.join(directory, f'{index}.svg'), 'w') as svg_file:
+            svg_file.write('<svg xmlns="http://www.w3.org/2000/svg"/>')
+
+with open(f'{transitions}.json', 'w') as transitions_file:
+    json.dump({'brs': [
+        {'source': index, 'target': index + 1}
+        for index in range(steps)]}, transitions_file)
+'''
+
+FAKE_SYSTEM = '''
+ctrl A = 0;
+fun ctrl Step(a) = 0;
+
+big initial = A.1;
+
+begin brs
+    init initial;
+    rules = [];
+end
+'''
+
+
+def fake_bigrapher(path='out/test/fake'):
+    ''' write the fake bigrapher to `{path}/bigrapher` and return its path '''
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    executable = path / 'bigrapher'
+    with open(executable, 'w') as script:
+        script.write(f'#!{sys.executable}\n')
+        script.write(FAKE_BIGRAPHER)
+    mode = os.stat(executable).st_mode
+    os.chmod(executable, mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    return str(executable.resolve())
+
+
+def fake_system(path='out/test/fake', source=FAKE_SYSTEM):
+    ''' a reactive system that runs the fake bigrapher written to `path` '''
+    from bigraph.parse import bigraph
+
+    brs = bigraph(source)
+    brs.executable = fake_bigrapher(path)
+    return brs
+
+
+@contextlib.contextmanager
+def fake_environment(**values):
+    ''' set `FAKE_BIGRAPHER_{NAME}` variables for the duration of a block '''
+    names = {
+        f'FAKE_BIGRAPHER_{name.upper()}': str(value)
+        for name, value in values.items()}
+    previous = {
+        name: os.environ.get(name)
+        for name in names}
+    os.environ.update(names)
+    try:
+        yield
+    finally:
+        for name, value in previous.items():
+            if value is None:
+                del os.environ[name]
+            else:
+                os.environ[name] = value
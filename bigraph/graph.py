@@ -0,0 +1,352 @@
+import json
+from array import array
+from collections import OrderedDict
+from pathlib import Path
+
+
+# the key of the transitions in bigrapher's json, and the field holding
+# the weight of each transition
+TRANSITION_FIELDS = {
+    'brs': None,
+    'pbrs': 'probability',
+    'sbrs': 'rate'}
+
+# fields naming the reaction behind a transition, where bigrapher writes one
+REACTION_FIELDS = ['reaction', 'action']
+
+CHUNK_SIZE = 1 << 16
+
+
+def stream_transitions(transitions_file, chunk_size=CHUNK_SIZE):
+    '''yield the kind of system and then each transition in a bigrapher
+    transitions file, decoding one transition at a time so the whole list
+    is never held in memory'''
+
+    decoder = json.JSONDecoder()
+    buffer = ''
+    kind = None
+    position = 0
+
+    def more():
+        chunk = transitions_file.read(chunk_size)
+        return chunk, not chunk
+
+    # find the key of the transition list and its opening bracket
+    while kind is None:
+        chunk, end = more()
+        buffer += chunk
+        for candidate in TRANSITION_FIELDS:
+            token = f'"{candidate}"'
+            found = buffer.find(token)
+            if found >= 0:
+                bracket = buffer.find('[', found + len(token))
+                if bracket >= 0:
+                    kind = candidate
+                    position = bracket + 1
+                    break
+        if kind is None and end:
+            raise Exception(f'no transitions found, expected one of {list(TRANSITION_FIELDS)}')
+
+    yield kind
+
+    while True:
+        while position < len(buffer) and buffer[position] in ' \t\r\n,':
+            position += 1
+        if position < len(buffer) and buffer[position] == ']':
+            break
+        try:
+            transition, position = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            chunk, end = more()
+            if end:
+                raise Exception('transitions file ended in the middle of a transition')
+            buffer = buffer[position:] + chunk
+            position = 0
+            continue
+        yield transition
+        if position > chunk_size:
+            buffer = buffer[position:]
+            position = 0
+
+
+def compress(size, sources, targets, weights=None, reactions=None):
+    '''counting sort of parallel `sources` and `targets` arrays into the row
+    pointers and columns of a compressed sparse row graph, carrying the
+    `weights` and `reactions` of each transition along'''
+    indptr = array('l', [0]) * (size + 1)
+    for source in sources:
+        indptr[source + 1] += 1
+    for position in range(size):
+        indptr[position + 1] += indptr[position]
+
+    fill = array('l', indptr[:size])
+    ordered = array('l', [0]) * len(targets)
+    ordered_weights = array('d', [0.0]) * len(targets) if weights is not None else None
+    ordered_reactions = [None] * len(targets) if reactions is not None else None
+    for edge, source in enumerate(sources):
+        slot = fill[source]
+        ordered[slot] = targets[edge]
+        if weights is not None:
+            ordered_weights[slot] = weights[edge]
+        if reactions is not None:
+            ordered_reactions[slot] = reactions[edge]
+        fill[source] = slot + 1
+    return indptr, ordered, ordered_weights, ordered_reactions
+
+
+class TransitionGraph():
+    '''the transition system of a bigraphical reactive system as a compressed
+    sparse row graph over integer states `0..n-1`, where `0` is the initial
+    state. `labels` holds the bigrapher id of each state, and `weights` the
+    probability or rate of each transition for `pbrs` and `sbrs` systems.
+    `reactions` holds the reaction behind each transition when bigrapher
+    names it, and `None` otherwise.
+
+    states are only read from their json when asked for, and the most
+    recently used ones are kept in a small cache'''
+
+    def __init__(self, indptr, targets, labels, weights=None, reactions=None, kind='brs', path=None, cache_size=64):
+        self.indptr = indptr
+        self.targets = targets
+        self.labels = labels
+        self.weights = weights
+        self.reactions = reactions if reactions is not None else [None] * len(targets)
+        self.kind = kind
+        self.path = Path(path) if path is not None else None
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.reverse = None
+
+    @classmethod
+    def from_transitions(cls, transitions, kind='brs', initial='0', path=None):
+        field = TRANSITION_FIELDS[kind]
+        index = {}
+        labels = []
+
+        def state(label):
+            label = str(label)
+            if label not in index:
+                index[label] = len(labels)
+                labels.append(label)
+            return index[label]
+
+        state(initial)
+        sources = array('l')
+        targets = array('l')
+        weights = array('d') if field else None
+        reactions = []
+        for transition in transitions:
+            sources.append(state(transition['source']))
+            targets.append(state(transition['target']))
+            if field:
+                weights.append(float(transition[field]))
+            reactions.append(next((
+                transition[name]
+                for name in REACTION_FIELDS
+                if name in transition), None))
+
+        indptr, ordered, ordered_weights, ordered_reactions = compress(len(labels), sources, targets, weights, reactions)
+        return cls(indptr, ordered, labels, weights=ordered_weights, reactions=ordered_reactions, kind=kind, path=path)
+
+    @classmethod
+    def load(cls, path, key='system', initial='0'):
+        ''' stream the transitions bigrapher wrote to `{path}/{key}.json` '''
+        path = Path(path)
+        with open(path / f'{key}.json', 'r') as system_file:
+            stream = stream_transitions(system_file)
+            kind = next(stream)
+            return cls.from_transitions(stream, kind=kind, initial=initial, path=path)
+
+    def __len__(self):
+        return len(self.labels)
+
+    def transition_count(self):
+        return len(self.targets)
+
+    def successors(self, state):
+        return self.targets[self.indptr[state]:self.indptr[state + 1]]
+
+    def transition_weights(self, state):
+        if self.weights is None:
+            return None
+        return self.weights[self.indptr[state]:self.indptr[state + 1]]
+
+    def transition_reactions(self, state):
+        return self.reactions[self.indptr[state]:self.indptr[state + 1]]
+
+    def sources(self):
+        ''' the source of each transition, parallel to `targets` '''
+        sources = array('l')
+        for state in range(len(self.labels)):
+            sources.extend([state] * (self.indptr[state + 1] - self.indptr[state]))
+        return sources
+
+    def predecessors(self, state):
+        if self.reverse is None:
+            self.reverse = compress(len(self.labels), self.targets, self.sources())
+        indptr, sources, _, _ = self.reverse
+        return sources[indptr[state]:indptr[state + 1]]
+
+    def edges(self):
+        for source in range(len(self.labels)):
+            for target in self.successors(source):
+                yield source, target
+
+    def terminal(self, state):
+        return self.indptr[state] == self.indptr[state + 1]
+
+    def branching(self):
+        ''' whether any state has more than one transition, as an exploration run has and a simulation does not '''
+        return any(
+            self.indptr[state + 1] - self.indptr[state] > 1
+            for state in range(len(self.labels)))
+
+    def trajectory(self):
+        '''the states of a simulation run in the order they were reached,
+        following the one transition out of each state from the initial
+        state. stops where the run ends or returns to a state already seen'''
+        path = [0]
+        seen = {0}
+        state = 0
+        while not self.terminal(state):
+            if self.indptr[state + 1] - self.indptr[state] > 1:
+                raise Exception(f'state {self.labels[state]} has {self.indptr[state + 1] - self.indptr[state]} transitions, so the run has no single trajectory')
+            state = self.targets[self.indptr[state]]
+            if state in seen:
+                break
+            seen.add(state)
+            path.append(state)
+        return path
+
+    def generations(self):
+        ''' the states reachable from the initial state, in breadth first layers '''
+        layer = [0]
+        seen = {0}
+        generations = []
+        while layer:
+            generations.append(layer)
+            following = []
+            for state in layer:
+                for target in self.successors(state):
+                    if target not in seen:
+                        seen.add(target)
+                        following.append(target)
+            layer = following
+        return generations
+
+    def order(self):
+        ''' the trajectory of a simulation, or every reachable state layer by layer when the run branches '''
+        if self.branching():
+            return [
+                state
+                for generation in self.generations()
+                for state in generation]
+        return self.trajectory()
+
+    def state_path(self, state, format='json'):
+        if self.path is None:
+            raise Exception('transition graph was not loaded from a path, so it has no states')
+        return self.path / f'{self.labels[state]}.{format}'
+
+    def state(self, state):
+        ''' the bigraph of a state, read from its json the first time it is asked for '''
+        from bigraph.bigraph import Base
+
+        if state in self.cache:
+            self.cache.move_to_end(state)
+            return self.cache[state]
+        with open(self.state_path(state), 'r') as state_file:
+            root = Base.from_spec(json.load(state_file))
+        self.cache[state] = root
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return root
+
+    def transition_system(self):
+        ''' this graph as a `markov.TransitionSystem` for probabilistic analysis '''
+        from bigraph.markov import TransitionSystem
+
+        weights = self.weights if self.weights is not None else [1.0] * len(self.targets)
+        return TransitionSystem(self.sources(), self.targets, weights, self.labels, kind=self.kind)
+
+
+def write_states(path, states):
+    Path(path).mkdir(parents=True, exist_ok=True)
+    for label, spec in states.items():
+        with open(Path(path) / f'{label}.json', 'w') as state_file:
+            json.dump(spec, state_file)
+
+
+def test_transition_graph(tmp_path):
+    path = tmp_path
+    atom = {
+        'nodes': [{'node_id': 0, 'control': {'ctrl_name': 'A', 'ctrl_arity': 0, 'ctrl_params': []}}],
+        'place_graph': {'num_regions': 1, 'num_nodes': 1, 'num_sites': 0, 'rn': [{'source': 0, 'target': 0}], 'nn': [], 'ns': []},
+        'link_graph': []}
+
+    # a cycle 0 -> 3 -> 0 and a branch 0 -> 1, 0 -> 2
+    with open(Path(path) / 'system.json', 'w') as system_file:
+        json.dump({'brs': [
+            {'source': 0, 'target': 3},
+            {'source': 3, 'target': 0},
+            {'source': 0, 'target': 1},
+            {'source': 0, 'target': 2}]}, system_file)
+    write_states(path, {label: atom for label in range(4)})
+
+    graph = TransitionGraph.load(path)
+    assert len(graph) == 4
+    assert graph.transition_count() == 4
+    assert graph.labels == ['0', '3', '1', '2']
+    assert list(graph.successors(0)) == [1, 2, 3]
+    assert list(graph.successors(1)) == [0]
+    assert graph.terminal(2) and graph.terminal(3)
+    assert sorted(graph.predecessors(0)) == [1]
+    assert sorted(graph.predecessors(3)) == [0]
+    assert not graph.cache
+    assert graph.state(1).render() == graph.state(2).render()
+    assert len(graph.cache) == 2
+
+    # transitions straddling chunk boundaries decode the same
+    with open(Path(path) / 'system.json', 'r') as system_file:
+        stream = stream_transitions(system_file, chunk_size=7)
+        assert next(stream) == 'brs'
+        assert [transition['target'] for transition in stream] == [3, 0, 1, 2]
+
+    with open(Path(path) / 'rates.json', 'w') as system_file:
+        json.dump({'sbrs': [
+            {'source': 0, 'target': 1, 'rate': 3.0},
+            {'source': 1, 'target': 0, 'rate': 1.0}]}, system_file)
+    rates = TransitionGraph.load(path, key='rates')
+    assert rates.kind == 'sbrs'
+    assert list(rates.transition_weights(0)) == [3.0]
+
+    # a branching run has no single trajectory, only its layers
+    assert graph.branching()
+    assert graph.generations() == [[0], [1, 2, 3]]
+    assert [graph.labels[state] for state in graph.order()] == ['0', '3', '1', '2']
+    try:
+        graph.trajectory()
+        assert False
+    except Exception as error:
+        assert 'no single trajectory' in str(error)
+
+    # a simulation is a path, named reactions included
+    with open(Path(path) / 'run.json', 'w') as system_file:
+        json.dump({'brs': [
+            {'source': 0, 'target': 1, 'reaction': 'grow'},
+            {'source': 2, 'target': 3, 'reaction': 'shrink'},
+            {'source': 1, 'target': 2, 'reaction': 'grow'}]}, system_file)
+    run = TransitionGraph.load(path, key='run')
+    assert not run.branching()
+    assert [run.labels[state] for state in run.trajectory()] == ['0', '1', '2', '3']
+    assert [run.transition_reactions(state)[0] for state in run.trajectory()[:-1]] == ['grow', 'grow', 'shrink']
+    assert list(graph.transition_reactions(0)) == [None, None, None]
+
+    # analysing the graph as a markov chain takes the analysis extra
+    import pytest
+    pytest.importorskip('numpy')
+    pytest.importorskip('scipy')
+    graph = TransitionGraph.load(path)
+    system = graph.transition_system()
+    assert system.size == 4
+    assert abs(system.reachability([2])[0] - 0.5) < 1e-9
@@ -1,9 +1,9 @@
-import fire
 from pathlib import Path
 
 from bigraph.parse import bigraph
 
-def read_histories(path):
+def read_histories(path, table=None):
+    ''' the histories in the file at `path`, with lines of equal states, in any order of siblings, shared through `table`, an `intern.StateTable`, if given '''
     path = Path(path)
     if not path.exists():
         return []
@@ -16,12 +16,24 @@ def read_histories(path):
                 if history:
                     histories.append(history)
                     history = []
+            elif table is not None:
+                history.append(table.intern_line(line))
             else:
                 history.append(line)
 
     return histories
 
 
+def write_histories(path, histories):
+    ''' append `histories`, each a list of rendered states, to the file at `path` '''
+    with open(path, 'a') as file:
+        for history in histories:
+            file.write('\n')
+            for state in history:
+                file.write(f'{state}\n')
+            file.write('\n')
+
+
 def test_history(path='histories/metabolism'):
     histories = read_histories(path)
     if len(histories) == 0:
@@ -36,4 +48,5 @@ def test_history(path='histories/metabolism'):
 
 
 if __name__ == '__main__':
+    import fire
     fire.Fire(test_history)
@@ -0,0 +1,405 @@
+import time
+import hashlib
+
+
+def node_digest(state, id, digests):
+    '''a digest of the subtree at `id` that does not depend on the order of
+    siblings, remembered in `digests` until the subtree changes'''
+    digest = digests.get(id)
+    if digest is None:
+        children = sorted(
+            node_digest(state, child, digests)
+            for child in state.children[id])
+        label = f'{state.control[id]}{state.params[id]}{state.ports[id]}'.encode('utf-8')
+        digest = hashlib.blake2b(
+            len(label).to_bytes(4, 'little') + label + b''.join(children),
+            digest_size=16).digest()
+        digests[id] = digest
+    return digest
+
+
+def place_class(state, place, digests):
+    '''the digests of `place` and each place above it up to its region. a
+    place of the same class is the same up to swapping equal subtrees'''
+    classes = []
+    while place >= 0:
+        classes.append(node_digest(state, place, digests))
+        place = state.parent[place]
+    classes.append(place)
+    return tuple(classes)
+
+
+def outcome_key(state, match, digests):
+    '''occurrences with equal keys rewrite `state` to the same state up to
+    isomorphism: they take places of the same class, subtrees equal up to
+    the order of siblings and the same contents for each site inside them.
+    the contents of the one site of a region are the rest of its place, so
+    they follow. the places of several regions are kept apart, as their
+    classes alone do not say whether one swap takes them all'''
+    pattern = match.pattern
+    if len(match.places) == 1:
+        places = place_class(state, match.places[0], digests)
+    else:
+        places = tuple(match.places)
+    roots = []
+    following = set()
+    for region in pattern.regions:
+        roots.append(tuple(sorted(
+            node_digest(state, match.nodes[part.index], digests)
+            for part in region.parts)))
+        if len(region.sites) == 1:
+            following.update(region.sites)
+    sites = tuple(
+        None if site in following else tuple(sorted(
+            node_digest(state, root, digests)
+            for root in contents))
+        for site, contents in enumerate(match.params))
+    return (
+        places,
+        tuple(roots),
+        sites,
+        tuple(sorted(match.links.items())),
+        tuple(sorted(match.bindings.items())))
+
+
+class IndexedMatches():
+    ''' the current occurrences of one rule, with constant time insert,
+    removal and uniform choice '''
+
+    def __init__(self):
+        self.keys = []
+        self.matches = []
+        self.positions = {}
+
+    def __len__(self):
+        return len(self.matches)
+
+    def __contains__(self, key):
+        return key in self.positions
+
+    def __iter__(self):
+        return iter(self.matches)
+
+    def add(self, key, match):
+        self.positions[key] = len(self.matches)
+        self.keys.append(key)
+        self.matches.append(match)
+
+    def remove(self, key):
+        position = self.positions.pop(key)
+        last_key = self.keys.pop()
+        last_match = self.matches.pop()
+        if position < len(self.matches):
+            self.keys[position] = last_key
+            self.matches[position] = last_match
+            self.positions[last_key] = position
+        return last_match if position == len(self.matches) else None
+
+    def get(self, key):
+        position = self.positions.get(key)
+        return None if position is None else self.matches[position]
+
+    def at(self, position):
+        return self.matches[position]
+
+    def first(self):
+        return self.matches[0] if self.matches else None
+
+
+class MatchStore():
+    '''keep the current occurrences of a set of rules in a `State` as it is
+    rewritten.
+
+    after each rewrite, `update` drops the occurrences that used a removed or
+    changed node, then searches again only around the changed nodes, by
+    pinning each changed node to every pattern node with the same control
+    and matching from the place that many levels above it. rules with
+    conditions or several regions depend on the whole state and are searched
+    in full instead.
+
+    with `outcomes` the occurrences of each rule are also grouped in
+    `groups` by their `outcome_key`, each group holding the keys of
+    occurrences that lead to the same state. a rewrite only groups again
+    the occurrences using a node whose subtree changed'''
+
+    def __init__(self, state, rules, outcomes=False):
+        self.state = state
+        self.rules = list(rules)
+        self.matches = [
+            IndexedMatches()
+            for _ in self.rules]
+        self.outcomes = outcomes
+        self.groups = [
+            IndexedMatches()
+            for _ in self.rules]
+        self.outcome_keys = {}
+        self.digests = {}
+        self.by_node = {}
+        self.by_place = {}
+        # the rules whose occurrences changed since the caller last cleared it
+        self.changed = set()
+
+        self.global_rules = []
+        self.anchors = []
+        for index, rule in enumerate(self.rules):
+            redex = rule.compiled.redex
+            if rule.compiled.conditions or len(redex.regions) != 1:
+                self.global_rules.append(index)
+            anchors = {}
+            for pattern in redex.nodes:
+                anchors.setdefault(pattern.control, []).append(pattern)
+            self.anchors.append(anchors)
+
+        self.refresh(range(len(self.rules)))
+
+    def count(self, index):
+        return len(self.matches[index])
+
+    def total(self):
+        return sum(len(matches) for matches in self.matches)
+
+    def add(self, index, match):
+        key = match.key()
+        matches = self.matches[index]
+        if key in matches:
+            return
+        matches.add(key, match)
+        self.changed.add(index)
+        entry = (index, key)
+        for node in match.nodes:
+            if node in self.by_node:
+                self.by_node[node].add(entry)
+            else:
+                self.by_node[node] = {entry}
+        for place in match.places:
+            if place in self.by_place:
+                self.by_place[place].add(entry)
+            else:
+                self.by_place[place] = {entry}
+        if self.outcomes:
+            self.group(entry, match)
+
+    def group(self, entry, match):
+        index, key = entry
+        outcome = outcome_key(self.state, match, self.digests)
+        self.outcome_keys[entry] = outcome
+        members = self.groups[index].get(outcome)
+        if members is None:
+            members = {}
+            self.groups[index].add(outcome, members)
+        members[key] = None
+
+    def ungroup(self, entry):
+        outcome = self.outcome_keys.pop(entry, None)
+        if outcome is None:
+            return
+        index, key = entry
+        members = self.groups[index].get(outcome)
+        del members[key]
+        if not members:
+            self.groups[index].remove(outcome)
+
+    def discard(self, entry):
+        index, key = entry
+        match = self.matches[index].get(key)
+        if match is None:
+            return
+        self.matches[index].remove(key)
+        self.ungroup(entry)
+        self.changed.add(index)
+        for node in match.nodes:
+            entries = self.by_node.get(node)
+            if entries is not None:
+                entries.discard(entry)
+                if not entries:
+                    del self.by_node[node]
+        for place in match.places:
+            entries = self.by_place.get(place)
+            if entries is not None:
+                entries.discard(entry)
+                if not entries:
+                    del self.by_place[place]
+
+    def refresh(self, indexes):
+        for index in indexes:
+            for entry in [(index, key) for key in self.matches[index].keys]:
+                self.discard(entry)
+            for match in self.rules[index].matches(self.state):
+                self.add(index, match)
+
+    def update(self, change):
+        state = self.state
+        removed = change.removed
+        touched = change.touched
+
+        for node in removed:
+            for entry in list(self.by_node.get(node, ())):
+                self.discard(entry)
+            for entry in list(self.by_place.get(node, ())):
+                self.discard(entry)
+        for node in touched:
+            for entry in list(self.by_node.get(node, ())):
+                self.discard(entry)
+
+        # the subtrees of the touched nodes and their ancestors changed, so
+        # the occurrences still using them, or a place inside them, may lead
+        # to other states now
+        if self.outcomes:
+            changed = set()
+            for node in touched:
+                while node is not None and node >= 0 and node in state.control and node not in changed:
+                    changed.add(node)
+                    node = state.parent[node]
+            for node in removed:
+                self.digests.pop(node, None)
+            for node in changed:
+                self.digests.pop(node, None)
+            stale = set()
+            for node in changed:
+                stale.update(self.by_node.get(node, ()))
+            pending = [
+                node
+                for node in changed
+                if state.parent[node] < 0]
+            while pending:
+                node = pending.pop()
+                stale.update(self.by_place.get(node, ()))
+                pending.extend(state.children[node])
+            for entry in stale:
+                self.ungroup(entry)
+                self.group(entry, self.matches[entry[0]].get(entry[1]))
+
+        # group the anchors by rule and place, so a place with several
+        # changed nodes is searched once rather than once for each
+        global_rules = set(self.global_rules)
+        searches = {}
+        for node in touched:
+            if node < 0 or node not in state.control:
+                continue
+            symbol = state.control[node]
+            for index in range(len(self.rules)):
+                if index in global_rules:
+                    continue
+                for pattern in self.anchors[index].get(symbol, ()):
+                    place = node
+                    for _ in range(pattern.depth):
+                        if place is None or place < 0:
+                            place = None
+                            break
+                        place = state.parent[place]
+                    if place is None:
+                        continue
+                    key = (index, place)
+                    if key in searches:
+                        searches[key].append((pattern.index, node))
+                    else:
+                        searches[key] = [(pattern.index, node)]
+
+        for (index, place), anchors in searches.items():
+            rule = self.rules[index]
+            if len(anchors) == 1:
+                anchor, node = anchors[0]
+                found = rule.matches(state, places=(place,), anchors={anchor: node})
+            else:
+                found = rule.matches(state, places=(place,))
+            for match in found:
+                self.add(index, match)
+
+        if self.global_rules:
+            self.refresh(self.global_rules)
+
+
+def compartments(count, contents='F | Phi | B | B'):
+    from bigraph.parse import bigraph
+    from bigraph.bigraph import Merge
+
+    return Merge([
+        bigraph(f'B.({contents})')
+        for _ in range(count)])
+
+
+def test_match_store():
+    from bigraph.state import State
+    from bigraph.engine import Rule
+    from bigraph.metabolism import Metabolism
+    import random
+
+    metabolism = Metabolism()
+    controls = metabolism.brs.controls
+    rules = [
+        Rule(reaction, controls=controls)
+        for reaction in metabolism.reactions.values()]
+
+    state = State.from_term(metabolism.bigraphs['initial'], controls=controls)
+    store = MatchStore(state, rules, outcomes=True)
+    chooser = random.Random(3)
+    for step in range(300):
+        available = [
+            index
+            for index in range(len(rules))
+            if store.count(index)]
+        if not available:
+            break
+        index = chooser.choice(available)
+        match = store.matches[index].at(chooser.randrange(store.count(index)))
+        change = rules[index].rewrite(state, match)
+        store.update(change)
+
+        expected = [
+            {match.key() for match in rule.matches(state)}
+            for rule in rules]
+        found = [
+            set(matches.keys)
+            for matches in store.matches]
+        assert expected == found, f'step {step}'
+
+        # the outcomes are grouped as they would be from scratch
+        digests = {}
+        expected = [
+            {outcome_key(state, match, digests) for match in matches}
+            for matches in store.matches]
+        found = [
+            set(groups.keys)
+            for groups in store.groups]
+        assert expected == found, f'step {step}'
+
+
+def benchmark_match_store(sizes=(250, 2500), steps=200):
+    from bigraph.state import State
+    from bigraph.engine import Rule
+    from bigraph.metabolism import Metabolism
+    import random
+
+    metabolism = Metabolism()
+    controls = metabolism.brs.controls
+    local = ['b', 'phi', 'degrade_F', 'degrade_Phi']
+    rules = [
+        Rule(metabolism.reactions[symbol], controls=controls)
+        for symbol in local]
+
+    for size in sizes:
+        for incremental in (True, False):
+            state = State.from_term(compartments(size), controls=controls)
+            store = MatchStore(state, rules)
+            chooser = random.Random(1)
+            start = time.perf_counter()
+            for step in range(steps):
+                available = [
+                    index
+                    for index in range(len(rules))
+                    if store.count(index)]
+                index = chooser.choice(available)
+                match = store.matches[index].at(chooser.randrange(store.count(index)))
+                change = rules[index].rewrite(state, match)
+                if incremental:
+                    store.update(change)
+                else:
+                    store.refresh(range(len(rules)))
+            elapsed = time.perf_counter() - start
+            mode = 'incremental' if incremental else 'full search'
+            print(f'{len(state)} nodes, {mode}: {elapsed / steps * 1e6:.0f} microseconds per step')
+
+
+if __name__ == '__main__':
+    import fire
+    fire.Fire(benchmark_match_store)
@@ -0,0 +1,275 @@
+import time
+import weakref
+import hashlib
+from collections import OrderedDict
+
+
+# states kept alive by a table when nothing else refers to them
+TABLE_SIZE = 4096
+
+# raw encodings remembered for each state kept, as one state can be
+# written in several ways
+ALIASES = 4
+
+
+def canonical_key(state):
+    ''' the digest of a bigraph's canonical rendering, which is the same for states that only differ by the order of siblings '''
+    from bigraph.state import State
+    return hashlib.blake2b(State.from_term(state).canonical().encode('utf-8'), digest_size=16).digest()
+
+
+def raw_key(raw):
+    if isinstance(raw, str):
+        raw = raw.encode('utf-8')
+    return hashlib.blake2b(raw, digest_size=16).digest()
+
+
+def refuse_change(self, *arguments, **keywords):
+    raise Exception(f'an interned {type(self).__name__} is shared and cannot change, build a `State` from it to rewrite it')
+
+
+class FrozenList(list):
+    ''' the lists inside a frozen state, which raise on any change '''
+
+    append = extend = insert = pop = remove = clear = sort = reverse = refuse_change
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = refuse_change
+
+    def __reduce_ex__(self, protocol):
+        return list, (list(self),)
+
+
+def thaw(cls):
+    return cls.__new__(cls)
+
+
+def thawed(self, protocol):
+    ''' pickle a frozen term as the term it was frozen from '''
+    return thaw, (type(self).__bases__[0],), dict(self.__dict__)
+
+
+frozen_classes = {}
+
+
+def frozen_class(cls):
+    frozen = frozen_classes.get(cls)
+    if frozen is None:
+        frozen = type(cls.__name__, (cls,), {
+            '__setattr__': refuse_change,
+            '__delattr__': refuse_change,
+            '__reduce_ex__': thawed})
+        frozen_classes[cls] = frozen
+    return frozen
+
+
+def freeze(term):
+    '''make the bigraph `term` raise on any change in place, by switching
+    each of its terms to a frozen subclass and each of their lists to a
+    `FrozenList`. controls are shared beyond one state, so they are left be'''
+    from bigraph.bigraph import Base, Control
+
+    stack = [term]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, (list, tuple)):
+            stack.extend(item)
+        elif isinstance(item, Base) and not isinstance(item, Control) and type(item) not in frozen_classes.values():
+            for name, value in item.__dict__.items():
+                if name == 'supernode':
+                    continue
+                if type(value) is list:
+                    value = item.__dict__[name] = FrozenList(value)
+                stack.append(value)
+            item.__class__ = frozen_class(type(item))
+    return term
+
+
+class StateTable():
+    '''one shared object for each distinct state, across trajectories and runs.
+
+    states are keyed by `canonical_key`. the table holds them weakly, so a
+    state stays shared for as long as anything refers to it and goes when
+    the last reference does, as counted by python itself. the `size` most
+    recently used states are also held strongly, so states that come and go
+    between runs are not decoded again. `aliases` maps the digest of the
+    bytes a state was read from to its key, letting a repeated file skip
+    decoding altogether. rendered states from histories files are shared
+    in `lines` by the `canonical_key` of the bigraph they parse to, holding
+    the `size` most recent, with `spellings` keeping the key of each text.
+
+    interned states are shared, so they are frozen by `freeze` and raise if
+    changed in place: build a `State` from one to rewrite it'''
+
+    def __init__(self, size=TABLE_SIZE):
+        self.size = size
+        self.shared = weakref.WeakValueDictionary()
+        self.recent = OrderedDict()
+        self.aliases = OrderedDict()
+        self.lines = OrderedDict()
+        self.spellings = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.shared)
+
+    def __contains__(self, key):
+        return key in self.shared
+
+    def touch(self, key, state):
+        self.recent[key] = state
+        self.recent.move_to_end(key)
+        if len(self.recent) > self.size:
+            self.recent.popitem(last=False)
+
+    def alias(self, raw, key):
+        digest = raw_key(raw)
+        self.aliases[digest] = key
+        self.aliases.move_to_end(digest)
+        if len(self.aliases) > self.size * ALIASES:
+            self.aliases.popitem(last=False)
+
+    def lookup(self, raw):
+        ''' the shared state last read from exactly these bytes, or `None` '''
+        key = self.aliases.get(raw_key(raw))
+        if key is None:
+            return None
+        state = self.shared.get(key)
+        if state is None:
+            return None
+        self.hits += 1
+        self.touch(key, state)
+        return state
+
+    def intern(self, state, raw=None):
+        ''' the shared state equal to `state`, which becomes the shared one if there is none yet '''
+        key = canonical_key(state)
+        shared = self.shared.get(key)
+        if shared is None:
+            self.misses += 1
+            self.shared[key] = freeze(state)
+            shared = state
+        else:
+            self.hits += 1
+        self.touch(key, shared)
+        if raw is not None:
+            self.alias(raw, key)
+        return shared
+
+    def line_key(self, line):
+        ''' the `canonical_key` of a rendered state, only parsed if its text was not seen before '''
+        key = self.spellings.get(line)
+        if key is None:
+            from bigraph.parse import bigraph
+            key = canonical_key(bigraph(line.strip()))
+            self.spellings[line] = key
+            if len(self.spellings) > self.size * ALIASES:
+                self.spellings.popitem(last=False)
+        else:
+            self.spellings.move_to_end(line)
+        return key
+
+    def intern_line(self, line):
+        '''the shared copy of a rendered state, as read from a histories
+        file, which is the first text read of the same bigraph'''
+        key = self.line_key(line)
+        shared = self.lines.get(key)
+        if shared is None:
+            self.misses += 1
+            self.lines[key] = line
+            if len(self.lines) > self.size:
+                self.lines.popitem(last=False)
+            return line
+        self.hits += 1
+        self.lines.move_to_end(key)
+        return shared
+
+    def stats(self):
+        return {
+            'distinct': len(self.shared),
+            'recent': len(self.recent),
+            'hits': self.hits,
+            'misses': self.misses}
+
+
+def test_state_table(tmp_path):
+    import gc
+    from pathlib import Path
+    from bigraph.parse import bigraph
+    from bigraph.fake import fake_system
+
+    table = StateTable(size=2)
+    first = table.intern(bigraph('A.(B | C)'))
+    again = table.intern(bigraph('A.(C | B)'))
+    other = table.intern(bigraph('A.B'))
+    assert first is again and first is not other
+    assert table.stats()['distinct'] == 2 and table.hits == 1
+
+    # a shared state cannot be changed in place, but reads and pickles as before
+    import pickle
+    for change in (lambda: first.nest(bigraph('D')), lambda: first.ground(), lambda: first.subnodes.parts.append(other)):
+        try:
+            change()
+            assert False
+        except Exception as error:
+            assert 'cannot change' in str(error)
+    assert first.render() == 'A.(B | C)'
+    copied = pickle.loads(pickle.dumps(first))
+    assert copied.nest(bigraph('D')).render() == 'A.(B | C | D)'
+
+    # only the most recent states outlive their last reference
+    table.intern(bigraph('C'))
+    del first, again, other
+    gc.collect()
+    assert table.stats()['distinct'] == 2
+
+    # equal states read back in two runs are one object
+    path = tmp_path
+    system = fake_system(path)
+    system.path = Path(path) / 'system'
+    table = StateTable()
+    system.simulate(steps=5, format='json')
+    one = system.read(intern=table)[:]
+    system.simulate(steps=8, format='json')
+    two = system.read(intern=table)
+    assert all(one[step] is two[step] for step in range(6))
+    assert two[7] is not one[-1]
+    assert len(table) == 7
+    assert table.lookup(open(system.path / '3.json', 'rb').read()) is one[3]
+    assert all(a is b for a, b in zip(two.load(workers=2), one))
+
+    # and so are the lines of histories rendering one bigraph, in any order
+    from bigraph.history import write_histories, read_histories
+    histories = Path(path) / 'histories'
+    write_histories(histories, [['A.(' + 'B' * 30 + ' | C)', 'C'], ['A.(C | ' + 'B' * 30 + ')']])
+    read = read_histories(histories, table=table)
+    assert read[0][0] is read[1][0] and read[0][1] is not read[0][0]
+
+
+def benchmark_state_table(runs=20, steps=500, path='out/test/intern/benchmark'):
+    import shutil
+    import tracemalloc
+    from pathlib import Path
+    from bigraph.fake import fake_system
+
+    shutil.rmtree(path, ignore_errors=True)
+    system = fake_system(path)
+    system.path = Path(path) / 'system'
+    system.simulate(steps=steps, format='json')
+
+    for table in (None, StateTable()):
+        tracemalloc.start()
+        start = time.perf_counter()
+        ensemble = [
+            system.read(intern=table).load(workers=1)
+            for run in range(runs)]
+        elapsed = time.perf_counter() - start
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        name = 'interned' if table else 'plain'
+        print(f'{name}: {runs} runs of {steps} steps in {elapsed:.3f}s, {memory / 1e6:.1f}MB held')
+        del ensemble
+
+
+if __name__ == '__main__':
+    import fire
+    fire.Fire(benchmark_state_table)
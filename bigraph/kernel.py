@@ -0,0 +1,1189 @@
+import random
+import importlib.util
+
+from bigraph.engine import MAXIMUM_REDUCTIONS
+
+
+# the kernel of `compartment.CountsSimulator`, compiled by numba when it is
+# installed, the `counts` extra. without numba the same functions run as
+# python over lists.
+#
+# a system is compiled to one integer array, `program`, and a state is
+# another, `memory`: a few counters, the total outcomes of each reaction, a
+# record for each place, the free and the live places and room to work in. a
+# place is known by where its record starts, and the record holds its
+# links, the species whose counts changed since its outcomes were counted,
+# where it is among the live places, its signature, how many atoms,
+# compartments and distinct compartments of each species it holds and the
+# outcomes of each reaction in it. children are a doubly linked list, kept
+# in the order they were added.
+#
+# compartments with the same signature hold the same, so like bigrapher the
+# kernel counts what they lead to once: of the children of a place with one
+# signature, only the first is counted in the outcomes of the place, and
+# only its outcomes and those of the places inside it in the totals
+NUMBA = importlib.util.find_spec('numba') is not None
+
+# the counters at the start of `memory`. TOTALS, PLACES, AVAILABLE, LIVING
+# and SCRATCH are where those regions start
+FREE, LIVE, SPECIES, REACTIONS, SITES, CAPACITY, APPLIED, CREATED, STRIDE, TOTALS, PLACES, AVAILABLE, LIVING, SCRATCH = range(14)
+META = 14
+
+# the fields of a place record, which go on with its counts. SIGNATURE is a
+# hash of its control, atoms and children, CONTENT the sum of the mixed
+# signatures of its children, SAME how many of its siblings share its
+# signature when it is the first of them and otherwise 0, and REPRESENTS
+# whether its outcomes are in the totals, as it and each place above it is
+# the first of its signature
+ALIVE, CONTROL, PARENT, FIRST, LAST, NEXT, PREV, CHANGED, SLOT, SIGNATURE, CONTENT, SAME, REPRESENTS = range(13)
+COUNTS = 13
+
+# the header of each reaction in `program`. READS and INNER_READS are the
+# species it reads in a place and inside its compartment, as `species_bit`
+# masks. OUTER, INNER, INSTANTIATION and REACTUM are where those sections
+# start. the slot groups of OUTER and INNER are GROUP apart, each the
+# species, how many slots it fills and where the sites of those slots are
+PART, PART_SITE, REDEX_SITES, FRESH, DUPLICATES, READS, INNER_READS, OUTER, INNER, INSTANTIATION, REACTUM = range(11)
+HEADER = 11
+GROUP = 3
+
+# species share the bits of a mask past this many, which only costs
+# recounting more often
+MASK_BITS = 62
+
+# what the kernel returns in place of a reaction
+DONE = 0
+TERMINAL = -1
+GROW = -2
+DIVERGED = -3
+INCONSISTENT = -4
+
+MASK = (1 << 32) - 1
+RANGE31 = 1 << 31
+RANGE32 = 1 << 32
+RANGE62 = 1 << 62
+LOW30 = (1 << 30) - 1
+
+# signatures are 61 bits, so that the products of mixing them are the same
+# wrapped in int64 as in python
+HASH = (1 << 61) - 1
+MIX1 = 0x3C79AC492BA7B653
+MIX2 = 0x1C69B3F74AC4AE35
+
+# places allocated at first, beyond those of the initial state
+CAPACITY_MARGIN = 64
+
+
+def jit(function):
+    if not NUMBA:
+        return function
+    from numba import njit
+    # nothing in the kernel allocates, so it runs without numba's
+    # reference counting
+    return njit(cache=True, _nrt=False)(function)
+
+
+def inline(function):
+    ''' `jit` for the small functions a step calls many times, which are compiled into each caller, as passing the arrays to a call costs more than their work '''
+    if not NUMBA:
+        return function
+    from numba import njit
+    return njit(cache=True, _nrt=False, inline='always')(function)
+
+
+def flat(values):
+    ''' an array for the kernel, int64 for numba and otherwise a list '''
+    if NUMBA:
+        import numpy as np
+        return np.array(values, dtype=np.int64)
+    return list(values)
+
+
+def pascal(rows):
+    ''' the binomial coefficients of `rows` rows, a row apart '''
+    table = [0] * (rows * rows)
+    for n in range(rows):
+        table[n * rows] = 1
+        for k in range(1, n + 1):
+            table[n * rows + k] = table[(n - 1) * rows + k - 1] + table[(n - 1) * rows + k]
+    return flat(table)
+
+
+# counting outcomes takes many binomial coefficients, which numba freezes
+# into the compiled kernel from this table rather than dividing for each
+BINOMIAL_ROWS = 62
+BINOMIALS = pascal(BINOMIAL_ROWS)
+
+
+def seed_state(seed=None):
+    ''' the state of the kernel's xoshiro128** generator for `seed` '''
+    chooser = random.Random(seed)
+    words = [chooser.getrandbits(32) for word in range(4)]
+    if not any(words):
+        words[0] = 1
+    return flat(words)
+
+
+@inline
+def species_bit(species):
+    return 1 << (species % MASK_BITS)
+
+
+@inline
+def rotate(value, shift):
+    return ((value << shift) | (value >> (32 - shift))) & MASK
+
+
+@inline
+def next32(rng):
+    result = (rotate((rng[1] * 5) & MASK, 7) * 9) & MASK
+    shifted = (rng[1] << 9) & MASK
+    rng[2] ^= rng[0]
+    rng[3] ^= rng[1]
+    rng[1] ^= rng[2]
+    rng[0] ^= rng[3]
+    rng[2] ^= shifted
+    rng[3] = rotate(rng[3], 11)
+    return result
+
+
+@inline
+def below(rng, n):
+    '''a uniform integer in `[0, n)`. below 2**31 it is the high word of a
+    random word times `n`, which only divides to reject the few biased
+    products, as division is slow next to everything else in a step'''
+    if n < RANGE31:
+        product = next32(rng) * n
+        if (product & MASK) < n:
+            threshold = (RANGE32 - n) % n
+            while (product & MASK) < threshold:
+                product = next32(rng) * n
+        return product >> 32
+    limit = RANGE62 - RANGE62 % n
+    value = ((next32(rng) & LOW30) << 32) | next32(rng)
+    while value >= limit:
+        value = ((next32(rng) & LOW30) << 32) | next32(rng)
+    return value % n
+
+
+@inline
+def mix(value):
+    value &= HASH
+    value = ((value ^ (value >> 29)) * MIX1) & HASH
+    value = ((value ^ (value >> 32)) * MIX2) & HASH
+    return value ^ (value >> 29)
+
+
+@inline
+def signature(memory, place):
+    ''' the hash of the control and atoms of `place` and the signatures of its children, never 0 '''
+    value = mix(memory[place + CONTROL] + 2)
+    for species in range(memory[SPECIES]):
+        value = mix(value + memory[place + COUNTS + species])
+    return mix(value + memory[place + CONTENT]) | 1
+
+
+@inline
+def falling(n, k):
+    result = 1
+    for i in range(k):
+        result *= n - i
+    return result
+
+
+@inline
+def choose_k(n, k):
+    if k < 0 or k > n:
+        return 0
+    if n < BINOMIAL_ROWS:
+        return BINOMIALS[n * BINOMIAL_ROWS + k]
+    result = 1
+    for i in range(k):
+        result = result * (n - i) // (i + 1)
+    return result
+
+
+@inline
+def distinct(atoms, kinds, needed):
+    '''the number of ways to fill `needed` ordered slots from `atoms`
+    interchangeable atoms and `kinds` distinct compartments'''
+    total = 0
+    for used in range(min(atoms, needed) + 1):
+        total += choose_k(needed, used) * falling(kinds, needed - used)
+    return total
+
+
+@inline
+def repeats(memory, place, species, option, excluded):
+    ''' how many slots the atoms of `species`, for an `option` of -1, or the compartments like the child `option` can fill '''
+    if option < 0:
+        return memory[place + COUNTS + species]
+    return memory[option + SAME] - (1 if option == excluded else 0)
+
+
+@jit
+def repeated(memory, place, species, needed, excluded):
+    '''`distinct` when some of the compartments are the same: the number of
+    ways to fill `needed` ordered slots with the atoms and compartments of
+    each signature, each at most as many times as there are of them'''
+    table = memory[SCRATCH] + 3 * memory[SITES] + 4 * memory[CAPACITY]
+    memory[table] = 1
+    for filled in range(1, needed + 1):
+        memory[table + filled] = 0
+    option = -1
+    child = memory[place + FIRST]
+    while True:
+        most = repeats(memory, place, species, option, excluded)
+        for filled in range(needed, -1, -1):
+            total = 0
+            for used in range(min(most, filled) + 1):
+                total += choose_k(filled, used) * memory[table + filled - used]
+            memory[table + filled] = total
+        while child >= 0 and (memory[child + CONTROL] != species or memory[child + SAME] == 0):
+            child = memory[child + NEXT]
+        if child < 0:
+            return memory[table + needed]
+        option = child
+        child = memory[child + NEXT]
+
+
+@inline
+def outcomes(memory, place, species, needed, excluded):
+    ''' the distinct ways to fill `needed` slots of `species` in `place`, leaving out its child `excluded` '''
+    kinds = memory[place + COUNTS + memory[SPECIES] + species]
+    classes = memory[place + COUNTS + 2 * memory[SPECIES] + species]
+    if excluded >= 0 and memory[excluded + CONTROL] == species:
+        kinds -= 1
+        if memory[excluded + SAME] == 1:
+            classes -= 1
+    atoms = memory[place + COUNTS + species]
+    if needed == 1:
+        return (1 if atoms > 0 else 0) + classes
+    if classes < kinds:
+        return repeated(memory, place, species, needed, excluded)
+    return distinct(atoms, kinds, needed)
+
+
+@inline
+def group_outcomes(program, at, memory, place, excluded):
+    ''' the product of the outcomes of the slot groups at `at` '''
+    total = 1
+    for group in range(at + 1, at + 1 + GROUP * program[at], GROUP):
+        total *= outcomes(memory, place, program[group], program[group + 1], excluded)
+        if total == 0:
+            return 0
+    return total
+
+
+@inline
+def part_outcomes(program, start, memory, place, child):
+    ''' the outcomes of the reaction at `start` with its compartment matched to `child` of `place` '''
+    inner = group_outcomes(program, program[start + INNER], memory, child, -1)
+    if inner == 0:
+        return 0
+    return inner * group_outcomes(program, program[start + OUTER], memory, place, child)
+
+
+@inline
+def count(program, start, memory, place):
+    ''' the distinct outcomes of the reaction at `start` directly inside `place` '''
+    part = program[start + PART]
+    if part < 0:
+        return group_outcomes(program, program[start + OUTER], memory, place, -1)
+    total = 0
+    child = memory[place + FIRST]
+    while child >= 0:
+        if memory[child + CONTROL] == part and memory[child + SAME] > 0:
+            total += part_outcomes(program, start, memory, place, child)
+        child = memory[child + NEXT]
+    return total
+
+
+@inline
+def recount(program, memory, place, reaction):
+    occurrences = place + COUNTS + 3 * memory[SPECIES] + reaction
+    counted = count(program, program[2 + reaction], memory, place)
+    if memory[place + REPRESENTS]:
+        memory[memory[TOTALS] + reaction] += counted - memory[occurrences]
+    memory[occurrences] = counted
+
+
+@jit
+def recount_all(program, memory, place):
+    for reaction in range(memory[REACTIONS]):
+        recount(program, memory, place, reaction)
+    memory[place + CHANGED] = 0
+
+
+@jit
+def recount_changed(program, memory, place):
+    '''recount the outcomes in `place` of the reactions that read a species
+    whose counts changed in it, and in its parent of those whose compartment
+    it could be'''
+    changed = memory[place + CHANGED]
+    if changed == 0:
+        return
+    parent = memory[place + PARENT]
+    control = memory[place + CONTROL]
+    for reaction in range(memory[REACTIONS]):
+        start = program[2 + reaction]
+        if program[start + READS] & changed:
+            recount(program, memory, place, reaction)
+        if parent >= 0 and program[start + PART] == control and program[start + INNER_READS] & changed:
+            recount(program, memory, parent, reaction)
+    memory[place + CHANGED] = 0
+
+
+@inline
+def link(memory, parent, child):
+    memory[parent + CONTENT] = (memory[parent + CONTENT] + mix(memory[child + SIGNATURE])) & HASH
+    last = memory[parent + LAST]
+    memory[child + PARENT] = parent
+    memory[child + PREV] = last
+    memory[child + NEXT] = -1
+    if last >= 0:
+        memory[last + NEXT] = child
+    else:
+        memory[parent + FIRST] = child
+    memory[parent + LAST] = child
+
+
+@inline
+def unlink(memory, child):
+    parent = memory[child + PARENT]
+    memory[parent + CONTENT] = (memory[parent + CONTENT] - mix(memory[child + SIGNATURE])) & HASH
+    previous = memory[child + PREV]
+    following = memory[child + NEXT]
+    if previous >= 0:
+        memory[previous + NEXT] = following
+    else:
+        memory[parent + FIRST] = following
+    if following >= 0:
+        memory[following + PREV] = previous
+    else:
+        memory[parent + LAST] = previous
+    memory[child + PARENT] = -1
+    memory[child + PREV] = -1
+    memory[child + NEXT] = -1
+
+
+@jit
+def represent(memory, top, value):
+    '''count the outcomes of `top` in the totals when `value` is 1 and not
+    when it is 0, and those of the places inside it that are the first of
+    their signature along with it'''
+    if memory[top + REPRESENTS] == value:
+        return
+    stack = memory[SCRATCH] + 3 * memory[SITES] + 2 * memory[CAPACITY]
+    totals = memory[TOTALS]
+    memory[top + REPRESENTS] = value
+    memory[stack] = top
+    depth = 1
+    while depth:
+        depth -= 1
+        place = memory[stack + depth]
+        value = memory[place + REPRESENTS]
+        occurrences = place + COUNTS + 3 * memory[SPECIES]
+        for reaction in range(memory[REACTIONS]):
+            if value:
+                memory[totals + reaction] += memory[occurrences + reaction]
+            else:
+                memory[totals + reaction] -= memory[occurrences + reaction]
+        child = memory[place + FIRST]
+        while child >= 0:
+            wanted = 1 if value and memory[child + SAME] > 0 else 0
+            if memory[child + REPRESENTS] != wanted:
+                memory[child + REPRESENTS] = wanted
+                memory[stack + depth] = child
+                depth += 1
+            child = memory[child + NEXT]
+
+
+@jit
+def settle(memory, parent, value):
+    '''give the children of `parent` signed `value` their SAME, marking the
+    species of those that changed as changed in `parent`, and count their
+    outcomes in the totals if they are to be'''
+    first = -1
+    same = 0
+    child = memory[parent + FIRST]
+    while child >= 0:
+        if memory[child + SIGNATURE] == value:
+            if first < 0:
+                first = child
+            same += 1
+        child = memory[child + NEXT]
+    classes = parent + COUNTS + 2 * memory[SPECIES]
+    child = first
+    while child >= 0:
+        if memory[child + SIGNATURE] == value:
+            wanted = same if child == first else 0
+            previous = memory[child + SAME]
+            if previous != wanted:
+                control = memory[child + CONTROL]
+                memory[classes + control] += (1 if wanted else 0) - (1 if previous else 0)
+                memory[parent + CHANGED] |= species_bit(control)
+                memory[child + SAME] = wanted
+            represent(memory, child, 1 if memory[parent + REPRESENTS] and wanted else 0)
+        child = memory[child + NEXT]
+
+
+@jit
+def resign(memory, place):
+    ''' sign `place` again, and each place above it whose signature changes with it '''
+    while place >= 0:
+        previous = memory[place + SIGNATURE]
+        value = signature(memory, place)
+        if value == previous:
+            return
+        memory[place + SIGNATURE] = value
+        parent = memory[place + PARENT]
+        if parent < 0:
+            return
+        memory[parent + CONTENT] = (memory[parent + CONTENT] - mix(previous) + mix(value)) & HASH
+        settle(memory, parent, previous)
+        settle(memory, parent, value)
+        place = parent
+
+
+@jit
+def allocate(memory, control):
+    ''' a free place holding nothing, so with no outcomes, recorded as created '''
+    memory[FREE] -= 1
+    place = memory[memory[AVAILABLE] + memory[FREE]]
+    memory[memory[LIVING] + memory[LIVE]] = place
+    memory[place + SLOT] = memory[LIVE]
+    memory[LIVE] += 1
+    memory[memory[SCRATCH] + 3 * memory[SITES] + memory[CAPACITY] + memory[CREATED]] = place
+    memory[CREATED] += 1
+    memory[place + ALIVE] = 1
+    memory[place + CONTROL] = control
+    memory[place + PARENT] = -1
+    memory[place + FIRST] = -1
+    memory[place + LAST] = -1
+    memory[place + NEXT] = -1
+    memory[place + PREV] = -1
+    memory[place + CHANGED] = 0
+    memory[place + SIGNATURE] = 0
+    memory[place + CONTENT] = 0
+    memory[place + SAME] = 0
+    memory[place + REPRESENTS] = 0
+    for species in range(3 * memory[SPECIES]):
+        memory[place + COUNTS + species] = 0
+    return place
+
+
+@jit
+def release(memory, place):
+    ''' free `place`, taking its outcomes out of the totals '''
+    totals = memory[TOTALS]
+    occurrences = place + COUNTS + 3 * memory[SPECIES]
+    for reaction in range(memory[REACTIONS]):
+        if memory[place + REPRESENTS]:
+            memory[totals + reaction] -= memory[occurrences + reaction]
+        memory[occurrences + reaction] = 0
+    memory[place + REPRESENTS] = 0
+    memory[place + ALIVE] = 0
+    memory[memory[AVAILABLE] + memory[FREE]] = place
+    memory[FREE] += 1
+    memory[LIVE] -= 1
+    last = memory[memory[LIVING] + memory[LIVE]]
+    memory[memory[LIVING] + memory[place + SLOT]] = last
+    memory[last + SLOT] = memory[place + SLOT]
+
+
+@jit
+def release_tree(memory, top):
+    stack = memory[SCRATCH] + 3 * memory[SITES] + 2 * memory[CAPACITY]
+    memory[stack] = top
+    depth = 1
+    while depth:
+        depth -= 1
+        place = memory[stack + depth]
+        child = memory[place + FIRST]
+        while child >= 0:
+            memory[stack + depth] = child
+            depth += 1
+            child = memory[child + NEXT]
+        release(memory, place)
+
+
+@jit
+def copy_counts(memory, source, target):
+    memory[target + SIGNATURE] = memory[source + SIGNATURE]
+    for species in range(3 * memory[SPECIES]):
+        memory[target + COUNTS + species] = memory[source + COUNTS + species]
+
+
+@jit
+def copy_tree(memory, origin):
+    '''a copy of the compartment `origin` and everything in it, where each
+    copy inside has the signature and SAME of what it copies'''
+    stack = memory[SCRATCH] + 3 * memory[SITES] + 2 * memory[CAPACITY]
+    top = allocate(memory, memory[origin + CONTROL])
+    copy_counts(memory, origin, top)
+    memory[stack] = origin
+    memory[stack + 1] = top
+    depth = 1
+    while depth:
+        depth -= 1
+        source = memory[stack + 2 * depth]
+        target = memory[stack + 2 * depth + 1]
+        child = memory[source + FIRST]
+        while child >= 0:
+            copy = allocate(memory, memory[child + CONTROL])
+            copy_counts(memory, child, copy)
+            memory[copy + SAME] = memory[child + SAME]
+            link(memory, target, copy)
+            memory[stack + 2 * depth] = child
+            memory[stack + 2 * depth + 1] = copy
+            depth += 1
+            child = memory[child + NEXT]
+    return top
+
+
+@inline
+def empty(memory, place):
+    if memory[place + FIRST] >= 0:
+        return False
+    for species in range(memory[SPECIES]):
+        if memory[place + COUNTS + species]:
+            return False
+    return True
+
+
+@inline
+def add(memory, place, species, content):
+    '''put `content` in `place` as a node of `species`: an empty or missing
+    content is only counted, otherwise it is linked as a compartment'''
+    memory[place + CHANGED] |= species_bit(species)
+    if content < 0 or empty(memory, content):
+        memory[place + COUNTS + species] += 1
+        if content >= 0:
+            release(memory, content)
+    else:
+        memory[content + CONTROL] = species
+        link(memory, place, content)
+        memory[place + COUNTS + memory[SPECIES] + species] += 1
+        settle(memory, place, memory[content + SIGNATURE])
+
+
+@inline
+def remove(memory, place, species, child):
+    memory[place + CHANGED] |= species_bit(species)
+    if child < 0:
+        memory[place + COUNTS + species] -= 1
+    else:
+        memory[place + COUNTS + memory[SPECIES] + species] -= 1
+        unlink(memory, child)
+        if memory[child + SAME]:
+            memory[place + COUNTS + 2 * memory[SPECIES] + species] -= 1
+            memory[child + SAME] = 0
+        settle(memory, place, memory[child + SIGNATURE])
+
+
+@jit
+def content(program, start, memory, site):
+    ''' what the reactum site `site` holds: a matched node, a copy of one, or nothing '''
+    contents = memory[SCRATCH] + memory[SITES]
+    used = contents + memory[SITES]
+    at = program[start + INSTANTIATION]
+    if site >= program[at]:
+        return -1
+    source = program[at + 1 + site]
+    if source < 0 or source >= program[start + REDEX_SITES]:
+        return -1
+    matched = memory[contents + source]
+    if memory[used + source]:
+        if matched < 0:
+            return -1
+        return copy_tree(memory, matched)
+    memory[used + source] = 1
+    return matched
+
+
+@jit
+def draw_repeated(program, at, memory, rng, place, species, needed, excluded):
+    '''`draw` when some of the compartments are the same. row `option + 1`
+    of the table counts the ways to fill each number of slots from the
+    atoms, the first option, and the compartments like each option up to
+    `option`. going back over the options, each takes the number of slots
+    it has in a uniform way and then that many slots at random, filled by
+    the first compartments like it'''
+    slots = memory[SCRATCH]
+    contents = slots + memory[SITES]
+    options = contents + 2 * memory[SITES]
+    table = memory[SCRATCH] + 3 * memory[SITES] + 4 * memory[CAPACITY]
+    width = needed + 1
+
+    memory[options] = -1
+    available = 1
+    child = memory[place + FIRST]
+    while child >= 0:
+        if memory[child + CONTROL] == species and repeats(memory, place, species, child, excluded) > 0:
+            memory[options + available] = child
+            available += 1
+        child = memory[child + NEXT]
+
+    memory[table] = 1
+    for filled in range(1, width):
+        memory[table + filled] = 0
+    for option in range(available):
+        row = table + option * width
+        most = repeats(memory, place, species, memory[options + option], excluded)
+        for filled in range(width):
+            total = 0
+            for used in range(min(most, filled) + 1):
+                total += choose_k(filled, used) * memory[row + filled - used]
+            memory[row + width + filled] = total
+
+    for slot in range(needed):
+        memory[slots + slot] = slot
+    remaining = needed
+    for option in range(available - 1, -1, -1):
+        row = table + option * width
+        first = memory[options + option]
+        most = min(repeats(memory, place, species, first, excluded), remaining)
+        choice = below(rng, memory[row + width + remaining])
+        taking = most
+        for used in range(most + 1):
+            weight = choose_k(remaining, used) * memory[row + remaining - used]
+            if choice < weight:
+                taking = used
+                break
+            choice -= weight
+
+        # the last `taking` of the remaining slots are the ones it fills
+        for taken in range(taking):
+            last = remaining - 1 - taken
+            other = below(rng, last + 1)
+            memory[slots + other], memory[slots + last] = memory[slots + last], memory[slots + other]
+        member = first
+        for taken in range(taking):
+            site = program[at + memory[slots + remaining - 1 - taken]]
+            if first < 0:
+                memory[contents + site] = -1
+            else:
+                while member == excluded or memory[member + SIGNATURE] != memory[first + SIGNATURE]:
+                    member = memory[member + NEXT]
+                memory[contents + site] = member
+                member = memory[member + NEXT]
+        remaining -= taking
+
+
+@jit
+def draw(program, at, memory, rng, place, species, needed, excluded):
+    '''fill the `needed` slots of `species` whose sites are at `at` with
+    atoms or children of `place`, uniformly among the distinct ways'''
+    kinds = memory[place + COUNTS + memory[SPECIES] + species]
+    classes = memory[place + COUNTS + 2 * memory[SPECIES] + species]
+    if excluded >= 0 and memory[excluded + CONTROL] == species:
+        kinds -= 1
+        if memory[excluded + SAME] == 1:
+            classes -= 1
+    if classes < kinds:
+        draw_repeated(program, at, memory, rng, place, species, needed, excluded)
+        return
+
+    slots = memory[SCRATCH]
+    contents = slots + memory[SITES]
+    options = contents + 2 * memory[SITES]
+    available = 0
+    child = memory[place + FIRST]
+    while child >= 0:
+        if memory[child + CONTROL] == species and child != excluded:
+            memory[options + available] = child
+            available += 1
+        child = memory[child + NEXT]
+
+    most = min(memory[place + COUNTS + species], needed)
+    total = 0
+    for used in range(most + 1):
+        total += choose_k(needed, used) * falling(available, needed - used)
+    choice = below(rng, total)
+    atoms = most
+    for used in range(most + 1):
+        weight = choose_k(needed, used) * falling(available, needed - used)
+        if choice < weight:
+            atoms = used
+            break
+        choice -= weight
+
+    # shuffle the slots, the first `atoms` of which take atoms
+    for slot in range(needed):
+        memory[slots + slot] = slot
+    for slot in range(needed):
+        other = slot + below(rng, needed - slot)
+        memory[slots + slot], memory[slots + other] = memory[slots + other], memory[slots + slot]
+    for position in range(needed):
+        site = program[at + memory[slots + position]]
+        if position < atoms:
+            memory[contents + site] = -1
+        else:
+            taken = position - atoms
+            other = taken + below(rng, available - taken)
+            memory[options + taken], memory[options + other] = memory[options + other], memory[options + taken]
+            memory[contents + site] = memory[options + taken]
+
+
+@jit
+def draw_groups(program, at, memory, rng, place, excluded):
+    for group in range(at + 1, at + 1 + GROUP * program[at], GROUP):
+        draw(program, program[group + 2], memory, rng, place, program[group], program[group + 1], excluded)
+
+
+@jit
+def remove_groups(program, at, memory, place):
+    contents = memory[SCRATCH] + memory[SITES]
+    for group in range(at + 1, at + 1 + GROUP * program[at], GROUP):
+        sites = program[group + 2]
+        for slot in range(program[group + 1]):
+            remove(memory, place, program[group], memory[contents + program[sites + slot]])
+
+
+@jit
+def apply(program, memory, rng, reaction, place):
+    ''' rewrite an outcome of `reaction` in `place` chosen uniformly, and update the outcomes it changed '''
+    start = program[2 + reaction]
+    part = program[start + PART]
+    contents = memory[SCRATCH] + memory[SITES]
+    used = contents + memory[SITES]
+    memory[CREATED] = 0
+
+    compartment = -1
+    if part >= 0:
+        choice = below(rng, memory[place + COUNTS + 3 * memory[SPECIES] + reaction])
+        child = memory[place + FIRST]
+        while child >= 0:
+            if memory[child + CONTROL] == part and memory[child + SAME] > 0:
+                weight = part_outcomes(program, start, memory, place, child)
+                if choice < weight:
+                    compartment = child
+                    break
+                choice -= weight
+            child = memory[child + NEXT]
+
+    # choose every slot before anything moves
+    draw_groups(program, program[start + OUTER], memory, rng, place, compartment)
+    if compartment >= 0:
+        draw_groups(program, program[start + INNER], memory, rng, compartment, -1)
+    remove_groups(program, program[start + OUTER], memory, place)
+    if compartment >= 0:
+        remove_groups(program, program[start + INNER], memory, compartment)
+        remove(memory, place, part, compartment)
+        memory[contents + program[start + PART_SITE]] = compartment
+
+    redex_sites = program[start + REDEX_SITES]
+    for source in range(redex_sites):
+        memory[used + source] = 0
+
+    at = program[start + REACTUM]
+    parts = program[at]
+    at += 1
+    for index in range(parts):
+        nested = program[at]
+        species = program[at + 1]
+        site = program[at + 2]
+        leaves = program[at + 3]
+        at += 4
+        built = content(program, start, memory, site)
+        if nested:
+            if built < 0:
+                built = allocate(memory, species)
+            for leaf in range(leaves):
+                add(memory, built, program[at], content(program, start, memory, program[at + 1]))
+                at += 2
+        add(memory, place, species, built)
+
+    # whatever the reactum left out goes, with everything inside it
+    for source in range(redex_sites):
+        if not memory[used + source] and memory[contents + source] >= 0:
+            release_tree(memory, memory[contents + source])
+
+    # the places that changed are signed again, which tells which of them
+    # are the same as a sibling
+    listed = memory[SCRATCH] + 3 * memory[SITES] + memory[CAPACITY]
+    for index in range(memory[CREATED]):
+        child = memory[listed + index]
+        if memory[child + ALIVE]:
+            resign(memory, child)
+    for source in range(redex_sites):
+        matched = memory[contents + source]
+        if matched >= 0 and memory[matched + ALIVE]:
+            resign(memory, matched)
+    resign(memory, place)
+
+    # new places are counted afresh, and the matched compartments, this
+    # place and those above it only for what changed in them
+    for index in range(memory[CREATED]):
+        child = memory[listed + index]
+        if memory[child + ALIVE]:
+            recount_all(program, memory, child)
+    for source in range(redex_sites):
+        matched = memory[contents + source]
+        if matched >= 0 and memory[matched + ALIVE]:
+            recount_changed(program, memory, matched)
+    while place >= 0:
+        recount_changed(program, memory, place)
+        place = memory[place + PARENT]
+
+
+@jit
+def pick(program, at, memory, rng):
+    '''a reaction of the class at `at` and a place to apply it, chosen
+    uniformly among all their outcomes, as `(reaction, place)`, from the
+    places whose outcomes are in the totals. the reaction is -1 when there
+    are none'''
+    size = program[at + 1]
+    totals = memory[TOTALS]
+    total = 0
+    for index in range(size):
+        total += memory[totals + program[at + 2 + index]]
+    if total == 0:
+        return -1, -1
+    choice = below(rng, total)
+    reaction = program[at + 2]
+    for index in range(size):
+        reaction = program[at + 2 + index]
+        if choice < memory[totals + reaction]:
+            break
+        choice -= memory[totals + reaction]
+    occurrences = COUNTS + 3 * memory[SPECIES] + reaction
+    living = memory[LIVING]
+    for slot in range(memory[LIVE]):
+        place = memory[living + slot]
+        if not memory[place + REPRESENTS]:
+            continue
+        outcomes = memory[place + occurrences]
+        if choice < outcomes:
+            return reaction, place
+        choice -= outcomes
+    return reaction, -1
+
+
+@jit
+def room(program, start, memory):
+    ''' whether there are enough free places for any rewrite of the reaction at `start` '''
+    return memory[FREE] >= program[start + FRESH] + program[start + DUPLICATES] * memory[LIVE]
+
+
+@jit
+def fire(program, memory, rng, reducible):
+    '''apply one reaction of the first reducible or standard class that has
+    any outcome, returning it or why there was none'''
+    at = program[1]
+    for group in range(program[at - 1]):
+        if program[at] == reducible:
+            reaction, place = pick(program, at, memory, rng)
+            if reaction >= 0:
+                if place < 0:
+                    return INCONSISTENT
+                if not room(program, program[2 + reaction], memory):
+                    return GROW
+                apply(program, memory, rng, reaction, place)
+                return reaction
+        at += 2 + program[at + 1]
+    return TERMINAL
+
+
+@jit
+def reduce(program, memory, rng):
+    ''' apply reducible reactions while any match, returning DONE or why it stopped '''
+    for reduction in range(MAXIMUM_REDUCTIONS):
+        status = fire(program, memory, rng, 1)
+        if status == TERMINAL:
+            return DONE
+        if status < 0:
+            return status
+    return DIVERGED
+
+
+@jit
+def advance(program, memory, rng, steps):
+    '''take up to `steps` transitions, or until none apply when `steps` is
+    negative, reducing before and after each. returns the transitions taken
+    and DONE, TERMINAL or why it stopped short. a stop for GROW loses
+    nothing: with more places the same call carries on'''
+    taken = 0
+    while steps < 0 or taken < steps:
+        status = reduce(program, memory, rng)
+        if status != DONE:
+            return taken, status
+        status = fire(program, memory, rng, 0)
+        if status < 0:
+            return taken, status
+        memory[APPLIED] = status
+        taken += 1
+    return taken, reduce(program, memory, rng)
+
+
+def compile_groups(slots, at):
+    '''the section of the slot groups `slots`, whose sites are laid out from
+    `at`, and those sites'''
+    section = [len(slots)]
+    sites = []
+    for species, group in slots.items():
+        section.extend([species, len(group), at + len(sites)])
+        sites.extend(group)
+    return section, sites
+
+
+def compile_reaction(reaction, at=0):
+    '''the code of a `compartment.CountsReaction` placed at `at` in a
+    program: the header, the outer and inner slot groups, the
+    instantiation, the reactum parts as `nested, species, site, leaves,
+    (species, site)...` and then the sites of the slot groups'''
+    from bigraph.compartment import PatternLeaf
+
+    part = reaction.redex_part
+    sources = [
+        source
+        for source in reaction.instantiation
+        if source < reaction.redex_sites]
+    duplicates = len(sources) - len(set(sources))
+    fresh = sum(1 for built in reaction.reactum if not isinstance(built, PatternLeaf))
+
+    instantiation = [len(reaction.instantiation)] + list(reaction.instantiation)
+    reactum = [len(reaction.reactum)]
+    for built in reaction.reactum:
+        if isinstance(built, PatternLeaf):
+            reactum.extend([0, built.species, built.site, 0])
+        else:
+            reactum.extend([1, built.species, built.site, len(built.leaves)])
+            for leaf in built.leaves:
+                reactum.extend([leaf.species, leaf.site])
+
+    # the groups come first and their sites last, so where those sites go
+    # is known before the groups are compiled
+    inner_at = at + HEADER + 1 + GROUP * len(reaction.slots)
+    instantiation_at = inner_at + 1 + GROUP * len(reaction.inner_slots)
+    reactum_at = instantiation_at + len(instantiation)
+    sites_at = reactum_at + len(reactum)
+    outer, outer_sites = compile_groups(reaction.slots, sites_at)
+    inner, inner_sites = compile_groups(reaction.inner_slots, sites_at + len(outer_sites))
+    sections = [at + HEADER, inner_at, instantiation_at, reactum_at]
+
+    reads = 0
+    for species in list(reaction.slots) + ([part.species] if part else []):
+        reads |= species_bit(species)
+    inner_reads = 0
+    for species in reaction.inner_slots:
+        inner_reads |= species_bit(species)
+
+    header = [
+        part.species if part else -1,
+        part.site if part else -1,
+        reaction.redex_sites,
+        fresh,
+        duplicates,
+        reads,
+        inner_reads]
+    return header + sections + outer + inner + instantiation + reactum + outer_sites + inner_sites
+
+
+def sites_needed(reaction):
+    return max([reaction.redex_sites, reaction.sites, len(reaction.instantiation), 1])
+
+
+class Kernel():
+    '''a `compartment.CountsSystem` compiled for the kernel. `program` holds
+    the number of reactions, where the classes start, where each reaction
+    starts, the number of classes and each as `reducible, size,
+    reactions...`, and then the code of each reaction. `initial` is the
+    memory of the initial state'''
+
+    def __init__(self, system):
+        self.species = system.species
+        self.reactions = system.reactions
+        self.sites = max([sites_needed(reaction) for reaction in system.reactions] + [1])
+        self.stride = COUNTS + 3 * len(self.species) + len(self.reactions)
+
+        program = [len(system.reactions), 0] + [0] * len(system.reactions) + [len(system.classes)]
+        program[1] = len(program)
+        for reducible, indexes in system.classes:
+            program.extend([1 if reducible else 0, len(indexes)] + indexes)
+        for index, reaction in enumerate(system.reactions):
+            program[2 + index] = len(program)
+            program.extend(compile_reaction(reaction, at=len(program)))
+        self.program = flat(program)
+        self.initial = self.load(system.initial)
+
+    def layout(self, capacity):
+        ''' the counters of a memory with room for `capacity` places '''
+        meta = [0] * META
+        meta[SPECIES] = len(self.species)
+        meta[REACTIONS] = len(self.reactions)
+        meta[SITES] = self.sites
+        meta[CAPACITY] = capacity
+        meta[STRIDE] = self.stride
+        meta[TOTALS] = META
+        meta[PLACES] = META + len(self.reactions)
+        meta[AVAILABLE] = meta[PLACES] + capacity * self.stride
+        meta[LIVING] = meta[AVAILABLE] + capacity
+        meta[SCRATCH] = meta[LIVING] + capacity
+        return meta
+
+    def records(self, meta, first, last):
+        ''' empty records for the places `first` up to `last`, and the stack of them free, first on top '''
+        record = [0, -1, -1, -1, -1, -1, -1, 0, 0, 0, 0, 0, 0] + [0] * (self.stride - COUNTS)
+        places = [meta[PLACES] + place * self.stride for place in range(last - 1, first - 1, -1)]
+        return record * (last - first), places
+
+    def scratch(self, capacity):
+        ''' the room to work in of a memory with room for `capacity` places, the last of it the table of `draw_repeated` '''
+        return 3 * self.sites + 4 * capacity + (capacity + 2) * (self.sites + 1)
+
+    def empty_memory(self, capacity):
+        meta = self.layout(capacity)
+        records, free = self.records(meta, 0, capacity)
+        meta[FREE] = capacity
+        return flat(
+            meta
+            + [0] * len(self.reactions)
+            + records
+            + free
+            + [0] * capacity
+            + [0] * self.scratch(capacity))
+
+    def load(self, root):
+        ''' the memory holding the `compartment.Compartment` tree `root`, with its outcomes counted '''
+        size = 0
+        pending = [root]
+        while pending:
+            compartment = pending.pop()
+            size += 1
+            pending.extend(compartment.children)
+
+        memory = self.empty_memory(size + CAPACITY_MARGIN)
+        species = len(self.species)
+        loaded = []
+        pending = [(root, -1)]
+        while pending:
+            compartment, parent = pending.pop(0)
+            place = allocate(memory, -1 if compartment.control is None else compartment.control)
+            for index in range(species):
+                memory[place + COUNTS + index] = compartment.counts[index]
+                memory[place + COUNTS + species + index] = compartment.kinds[index]
+            if parent >= 0:
+                link(memory, parent, place)
+            loaded.append(place)
+            pending.extend((child, place) for child in compartment.children)
+
+        # sign the places from the bottom up, and then find which are the
+        # first of their signature from the top down
+        for place in reversed(loaded):
+            content = 0
+            for child in self.children(memory, place):
+                content = (content + mix(memory[child + SIGNATURE])) & HASH
+            memory[place + CONTENT] = content
+            memory[place + SIGNATURE] = signature(memory, place)
+        memory[loaded[0] + REPRESENTS] = 1
+        for place in loaded:
+            first = {}
+            for child in self.children(memory, place):
+                value = int(memory[child + SIGNATURE])
+                if value not in first:
+                    first[value] = child
+                    memory[place + COUNTS + 2 * species + memory[child + CONTROL]] += 1
+                memory[first[value] + SAME] += 1
+            for child in self.children(memory, place):
+                memory[child + REPRESENTS] = 1 if memory[place + REPRESENTS] and memory[child + SAME] else 0
+        for place in loaded:
+            recount_all(self.program, memory, place)
+        return memory
+
+    def children(self, memory, place):
+        child = int(memory[place + FIRST])
+        while child >= 0:
+            yield child
+            child = int(memory[child + NEXT])
+
+    def grow(self, memory):
+        ''' `memory` with room for twice as many places, all of them where they were '''
+        memory = [int(value) for value in memory]
+        capacity = memory[CAPACITY]
+        meta = self.layout(2 * capacity)
+        for counter in (LIVE, APPLIED):
+            meta[counter] = memory[counter]
+        records, added = self.records(meta, capacity, 2 * capacity)
+        free = memory[memory[AVAILABLE]:memory[AVAILABLE] + memory[FREE]]
+        living = memory[memory[LIVING]:memory[LIVING] + memory[LIVE]]
+        meta[FREE] = len(added) + len(free)
+        return flat(
+            meta
+            + memory[META:memory[AVAILABLE]]
+            + records
+            + added
+            + free
+            + [0] * (capacity - len(free))
+            + living
+            + [0] * (2 * capacity - len(living))
+            + [0] * self.scratch(2 * capacity))
+
+    def render(self, memory, place=None):
+        ''' the contents of `place`, by default the root, written as a bigraph '''
+        if place is None:
+            place = int(memory[PLACES])
+        species = len(self.species)
+        parts = []
+        for index in range(species):
+            parts.extend([self.species[index]] * int(memory[place + COUNTS + index]))
+        child = int(memory[place + FIRST])
+        while child >= 0:
+            inner = self.render(memory, child)
+            if sum(int(memory[child + COUNTS + index]) for index in range(2 * species)) > 1:
+                inner = f'({inner})'
+            parts.append(f'{self.species[int(memory[child + CONTROL])]}.{inner}')
+            child = int(memory[child + NEXT])
+        return ' | '.join(parts)
+
+
+def test_kernel_outcomes():
+    '''the kernel counts as many outcomes of each class as
+    `engine.Simulator` finds, in states where compartments, and places
+    inside them, hold the same'''
+    from bigraph.parse import bigraph
+    from bigraph.state import State
+    from bigraph.bigraph import BigraphicalReactiveSystem
+    from bigraph.engine import Simulator
+    from bigraph.metabolism import Metabolism
+    from bigraph.compartment import CountsSimulator
+
+    metabolism = Metabolism()
+    full = 'F | F | Phi | Phi | B | B | B'
+    initials = [
+        'B.(F | B) | B.(B | F)',
+        f'B.(F | Phi | B) | B.(Phi | F | B) | B.({full}) | B.({full}) | F.(F | B) | F.(B | F) | F | B',
+        f'B.(B.({full}) | B.({full}) | F) | B.(B.({full}) | B.({full}) | F) | F.(F.B | F.B | F | F) | F.(F | F.B | F.B | F) | B']
+
+    for initial in initials:
+        brs = BigraphicalReactiveSystem(
+            controls=metabolism.controls,
+            bigraphs={'initial': bigraph(f'big initial = {initial}')},
+            reactions=metabolism.reactions,
+            system=metabolism.system)
+        for seed in range(3):
+            simulator = CountsSimulator(brs, seed=seed)
+            simulator.advance(0)
+            for step in range(30):
+                memory = simulator.memory
+                state = State.from_term(bigraph(simulator.render()), controls=brs.controls)
+                native = Simulator(brs, state=state)
+                start = 0
+                for reducible, indexes in simulator.classes:
+                    counted = sum(int(memory[memory[TOTALS] + index]) for index in indexes)
+                    found = len(native.outcomes(range(start, start + len(indexes))))
+                    assert counted == found, f'{simulator.render()}: {counted} outcomes, not {found}'
+                    start += len(indexes)
+                if simulator.step() is None:
+                    break
+
+    # both occurrences of degrade_F lead to the same state
+    brs = BigraphicalReactiveSystem(
+        controls=metabolism.controls,
+        bigraphs={'initial': bigraph('big initial = B.(F | B) | B.(F | B)')},
+        reactions=metabolism.reactions,
+        system=metabolism.system)
+    simulator = CountsSimulator(brs)
+    degrade = [reaction.symbol for reaction in simulator.reactions].index('degrade_F')
+    assert simulator.memory[simulator.memory[TOTALS] + degrade] == 1
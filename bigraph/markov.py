@@ -0,0 +1,375 @@
+import json
+import time
+from pathlib import Path
+
+from bigraph.graph import TRANSITION_FIELDS
+
+
+def solve(matrix, vector, tolerance=1e-8):
+    '''solve a sparse linear system with GMRES, preconditioned by an
+    incomplete LU factorization, falling back to a direct solve when the
+    iteration does not converge'''
+    import numpy as np
+    import scipy.sparse as sparse
+    import scipy.sparse.linalg as linalg
+
+    matrix = sparse.csc_matrix(matrix)
+    if matrix.shape[0] == 0:
+        return np.zeros(0)
+    try:
+        factor = linalg.spilu(matrix, drop_tol=1e-6, fill_factor=20)
+        preconditioner = linalg.LinearOperator(matrix.shape, factor.solve)
+        solution, info = linalg.gmres(
+            matrix,
+            vector,
+            M=preconditioner,
+            rtol=tolerance,
+            atol=0.0,
+            restart=50,
+            maxiter=5)
+        if info == 0:
+            return solution
+    except RuntimeError:
+        pass
+    return linalg.spsolve(matrix, vector)
+
+
+class TransitionSystem():
+    '''the transitions bigrapher explored from a `brs`, `pbrs` or `sbrs`
+    system, as a sparse matrix over states `0..n-1`. `labels` holds the
+    bigrapher id of each state.
+
+    a `brs` or `pbrs` system is a discrete time chain, where the successors
+    of a `brs` state are equally likely, and an `sbrs` system is a
+    continuous time chain. states without transitions are absorbing. the
+    analysis needs numpy and scipy, the `analysis` extra'''
+
+    def __init__(self, sources, targets, weights, labels, kind='brs', initial=0):
+        import numpy as np
+        import scipy.sparse as sparse
+
+        if kind not in TRANSITION_FIELDS:
+            raise Exception(f'transition system kind {kind} not supported. Available kinds are {list(TRANSITION_FIELDS)}')
+        self.kind = kind
+        self.labels = list(labels)
+        self.size = len(self.labels)
+        self.initial = initial
+        self.weights = sparse.csr_matrix(
+            (np.asarray(weights, dtype=np.float64), (sources, targets)),
+            shape=(self.size, self.size))
+
+    @classmethod
+    def from_transitions(cls, transitions, kind='brs', initial=None):
+        field = TRANSITION_FIELDS.get(kind)
+        index = {}
+
+        def state(label):
+            label = str(label)
+            if label not in index:
+                index[label] = len(index)
+            return index[label]
+
+        if initial is not None:
+            state(initial)
+        sources = []
+        targets = []
+        weights = []
+        for transition in transitions:
+            sources.append(state(transition['source']))
+            targets.append(state(transition['target']))
+            weights.append(float(transition.get(field, 1.0)) if field else 1.0)
+        if not index:
+            state(initial if initial is not None else 0)
+
+        labels = sorted(index, key=index.get)
+        return cls(sources, targets, weights, labels, kind=kind, initial=0)
+
+    @classmethod
+    def from_json(cls, data, initial='0'):
+        for kind in TRANSITION_FIELDS:
+            if kind in data:
+                return cls.from_transitions(data[kind], kind=kind, initial=initial)
+        raise Exception(f'no transitions found, expected one of {list(TRANSITION_FIELDS)}')
+
+    @classmethod
+    def load(cls, path, key='system', initial='0'):
+        ''' stream the transitions bigrapher wrote to `{path}/{key}.json` through a `graph.TransitionGraph` '''
+        from bigraph.graph import TransitionGraph
+
+        return TransitionGraph.load(path, key=key, initial=initial).transition_system()
+
+    def continuous(self):
+        return self.kind == 'sbrs'
+
+    def exits(self):
+        import numpy as np
+
+        return np.asarray(self.weights.sum(axis=1)).ravel()
+
+    def transition_matrix(self):
+        '''the row stochastic matrix of the chain, or of its embedded jump
+        chain for an `sbrs` system. absorbing states loop to themselves'''
+        import numpy as np
+        import scipy.sparse as sparse
+
+        exits = self.exits()
+        absorbing = exits == 0
+        scale = np.zeros(self.size)
+        scale[~absorbing] = 1.0 / exits[~absorbing]
+        matrix = sparse.diags(scale) @ self.weights
+        loops = sparse.diags(absorbing.astype(np.float64))
+        return sparse.csr_matrix(matrix + loops)
+
+    def generator(self):
+        ''' the infinitesimal generator `Q` of an `sbrs` system '''
+        import scipy.sparse as sparse
+
+        if not self.continuous():
+            raise Exception(f'a {self.kind} system has no generator, only sbrs systems do')
+        return sparse.csr_matrix(self.weights - sparse.diags(self.exits()))
+
+    def bottom_components(self):
+        '''the strongly connected components with no transitions leaving
+        them, as a list of arrays of states'''
+        import numpy as np
+        from scipy.sparse.csgraph import connected_components
+
+        count, component = connected_components(self.weights, directed=True, connection='strong')
+        matrix = self.weights.tocoo()
+        leaving = np.zeros(count, dtype=bool)
+        crossing = component[matrix.row] != component[matrix.col]
+        leaving[component[matrix.row[crossing]]] = True
+        order = np.argsort(component, kind='stable')
+        bounds = np.searchsorted(component[order], np.arange(count + 1))
+        return [
+            order[bounds[index]:bounds[index + 1]]
+            for index in range(count)
+            if not leaving[index]]
+
+    def reaching(self, targets):
+        ''' the states from which some state in `targets` can be reached '''
+        import numpy as np
+        import scipy.sparse as sparse
+        from scipy.sparse.csgraph import breadth_first_order
+
+        # search backwards from an extra state with an edge to every target
+        targets = np.asarray(targets, dtype=np.int64)
+        source = sparse.csr_matrix(
+            (np.ones(len(targets)), (np.zeros(len(targets), dtype=np.int64), targets)),
+            shape=(1, self.size))
+        graph = sparse.bmat([
+            [self.weights.T, sparse.csr_matrix((self.size, 1))],
+            [source, sparse.csr_matrix((1, 1))]], format='csr')
+        order = breadth_first_order(graph, self.size, directed=True, return_predecessors=False)
+        reached = np.zeros(self.size + 1, dtype=bool)
+        reached[order] = True
+        return reached[:self.size]
+
+    def target_mask(self, targets):
+        import numpy as np
+
+        if isinstance(targets, np.ndarray) and targets.dtype == bool:
+            return targets
+        mask = np.zeros(self.size, dtype=bool)
+        if callable(targets):
+            targets = [
+                state
+                for state, label in enumerate(self.labels)
+                if targets(label)]
+        mask[np.asarray(targets, dtype=np.int64)] = True
+        return mask
+
+    def reachability(self, targets):
+        '''the probability of ever reaching a state in `targets`, from each
+        state. `targets` is a list of state indexes or a predicate on
+        labels'''
+        import numpy as np
+        import scipy.sparse as sparse
+
+        target = self.target_mask(targets)
+        probability = np.zeros(self.size)
+        probability[target] = 1.0
+        unknown = self.reaching(np.flatnonzero(target)) & ~target
+        if not unknown.any():
+            return probability
+
+        matrix = self.transition_matrix()
+        inner = matrix[unknown][:, unknown]
+        into = np.asarray(matrix[unknown][:, target].sum(axis=1)).ravel()
+        system = sparse.identity(int(unknown.sum()), format='csr') - inner
+        probability[unknown] = np.clip(solve(system, into), 0.0, 1.0)
+        return probability
+
+    def hitting_times(self, targets):
+        '''the expected number of steps, or expected time for an `sbrs`
+        system, to first reach `targets` from each state. states that may
+        never reach `targets` have infinite hitting time'''
+        import numpy as np
+        import scipy.sparse as sparse
+
+        target = self.target_mask(targets)
+        times = np.full(self.size, np.inf)
+        times[target] = 0.0
+        certain = self.reachability(target) > 1.0 - 1e-9
+        unknown = certain & ~target
+        if not unknown.any():
+            return times
+
+        if self.continuous():
+            system = -self.generator()[unknown][:, unknown]
+        else:
+            matrix = self.transition_matrix()
+            system = sparse.identity(int(unknown.sum()), format='csr') - matrix[unknown][:, unknown]
+        times[unknown] = solve(system, np.ones(int(unknown.sum())))
+        return times
+
+    def component_steady_state(self, states):
+        ''' the stationary distribution of the chain restricted to one closed class '''
+        import numpy as np
+        import scipy.sparse as sparse
+
+        if len(states) == 1:
+            return np.ones(1)
+        if self.continuous():
+            matrix = self.generator()[states][:, states]
+        else:
+            matrix = self.transition_matrix()[states][:, states] - sparse.identity(len(states), format='csr')
+
+        # fix the weight of the first state and solve the balance equations of the rest
+        balance = sparse.csr_matrix(matrix.T)
+        rest = balance[1:][:, 1:]
+        first = -np.asarray(balance[1:][:, 0].todense()).ravel()
+        distribution = np.concatenate([[1.0], solve(rest, first)])
+        distribution = np.clip(distribution, 0.0, None)
+        return distribution / distribution.sum()
+
+    def absorption(self, components, initial=None):
+        '''the probability of ending up in each of the closed classes
+        `components` from `initial`. the states outside them are transient,
+        so one solve of the transposed system gives the expected visits to
+        each from `initial`, and those visits times the chance of stepping
+        into each class give every probability at once'''
+        import numpy as np
+        import scipy.sparse as sparse
+
+        initial = self.initial if initial is None else initial
+        closed = np.full(self.size, -1, dtype=np.int64)
+        for index, states in enumerate(components):
+            closed[states] = index
+        entering = np.zeros(len(components))
+        if closed[initial] >= 0:
+            entering[closed[initial]] = 1.0
+            return entering
+
+        transient = closed < 0
+        members = np.flatnonzero(~transient)
+        classes = sparse.csr_matrix(
+            (np.ones(len(members)), (members, closed[members])),
+            shape=(self.size, len(components)))
+        matrix = self.transition_matrix()[transient]
+        system = sparse.identity(int(transient.sum()), format='csr') - matrix[:, transient]
+        start = np.zeros(int(transient.sum()))
+        start[np.count_nonzero(transient[:initial])] = 1.0
+        visits = solve(sparse.csr_matrix(system.T), start)
+        entering = (matrix @ classes).T @ visits
+        return np.clip(entering, 0.0, 1.0)
+
+    def steady_state(self, initial=None):
+        '''the long run distribution over states starting from `initial`.
+        each closed class the chain can end up in contributes its own
+        stationary distribution, weighted by the probability of entering it'''
+        import numpy as np
+
+        components = self.bottom_components()
+        entering = self.absorption(components, initial)
+        distribution = np.zeros(self.size)
+        for states, probability in zip(components, entering):
+            if probability > 0.0:
+                distribution[states] += probability * self.component_steady_state(states)
+        return distribution
+
+
+def birth_death(size, birth=1.0, death=2.0, kind='sbrs'):
+    ''' the transitions of a birth death chain on `size` states, as bigrapher would write them '''
+    field = TRANSITION_FIELDS[kind]
+    transitions = []
+    for state in range(size):
+        if state + 1 < size:
+            transitions.append({'source': state, 'target': state + 1, field: birth})
+        if state > 0:
+            transitions.append({'source': state, 'target': state - 1, field: death})
+    return {kind: transitions}
+
+
+def test_transition_system(tmp_path):
+    import pytest
+    np = pytest.importorskip('numpy')
+    pytest.importorskip('scipy')
+
+    flip = TransitionSystem.from_json({
+        'sbrs': [
+            {'source': 0, 'target': 1, 'rate': 3.0},
+            {'source': 1, 'target': 0, 'rate': 1.0}]})
+    assert np.allclose(flip.steady_state(), [0.25, 0.75])
+    assert np.allclose(flip.hitting_times([1]), [1 / 3.0, 0.0])
+
+    # gambler's ruin between 0 and 4 with fair coin flips
+    ruin = TransitionSystem.from_json({
+        'pbrs': [
+            transition
+            for state in range(1, 4)
+            for transition in [
+                {'source': state, 'target': state + 1, 'probability': 0.5},
+                {'source': state, 'target': state - 1, 'probability': 0.5}]]},
+        initial='2')
+    win = ruin.reachability(lambda label: label == '4')
+    states = [ruin.labels.index(str(state)) for state in range(5)]
+    assert np.allclose(win[states], [0.0, 0.25, 0.5, 0.75, 1.0])
+    both = [ruin.labels.index('0'), ruin.labels.index('4')]
+    assert np.allclose(ruin.hitting_times(both)[states], [0.0, 3.0, 4.0, 3.0, 0.0])
+    assert np.allclose(ruin.steady_state()[both], [0.5, 0.5])
+    assert np.isinf(ruin.hitting_times([ruin.labels.index('4')])[ruin.labels.index('2')])
+
+    # the chance of ending in each closed class is the chance of reaching it
+    components = ruin.bottom_components()
+    entering = ruin.absorption(components)
+    assert np.allclose(entering, [ruin.reachability(states)[ruin.initial] for states in components])
+    assert np.allclose(ruin.absorption(components, initial=ruin.labels.index('0')), [
+        1.0 if ruin.labels.index('0') in states else 0.0
+        for states in components])
+
+    # a brs has equally likely successors, and reads from bigrapher's output
+    path = tmp_path
+    with open(Path(path) / 'system.json', 'w') as system_file:
+        json.dump({'brs': [
+            {'source': 0, 'target': 1},
+            {'source': 0, 'target': 2},
+            {'source': 0, 'target': 3},
+            {'source': 3, 'target': 0}]}, system_file)
+    branching = TransitionSystem.load(path)
+    assert np.allclose(branching.steady_state()[[1, 2]], [0.5, 0.5])
+    assert np.allclose(branching.reachability([1])[0], 0.5)
+
+    chain = TransitionSystem.from_json(birth_death(1000))
+    steady = chain.steady_state()
+    expected = 0.5 ** np.arange(1000)
+    assert np.allclose(steady, expected / expected.sum())
+
+
+def benchmark_markov(size=1000000):
+    start = time.perf_counter()
+    chain = TransitionSystem.from_json(birth_death(size))
+    print(f'{size} states loaded in {time.perf_counter() - start:.3f}s')
+
+    start = time.perf_counter()
+    steady = chain.steady_state()
+    print(f'steady state in {time.perf_counter() - start:.3f}s, mass at 0: {steady[0]:.4f}')
+
+    start = time.perf_counter()
+    times = chain.hitting_times([0])
+    print(f'hitting times in {time.perf_counter() - start:.3f}s, from {size // 1000}: {times[size // 1000]:.1f}')
+
+
+if __name__ == '__main__':
+    import fire
+    fire.Fire(benchmark_markov)
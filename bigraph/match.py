@@ -0,0 +1,599 @@
+import time
+import shutil
+import itertools
+import weakref
+
+from bigraph.bigraph import Control, Node, Merge, Parallel, Edge, EdgeGroup
+from bigraph.state import State, is_site, is_one, term_root
+
+
+class PatternNode():
+    def __init__(self, index, control, params, ports, atomic, depth=1, region=0):
+        self.index = index
+        self.depth = depth
+        self.region = region
+        self.control = control
+        self.params = params
+        self.ports = ports
+        self.atomic = atomic
+        self.children = []
+        self.sites = []
+        self.signature = None
+
+
+class PatternRegion():
+    def __init__(self):
+        self.parts = []
+        self.sites = []
+        self.names = []
+
+
+class Pattern():
+    '''a redex (or condition, or reactum) compiled into regions of pattern
+    nodes. as in bigrapher, a leaf with a non-atomic control is an ion
+    holding an implicit site, while `A.1` is an empty `A`. sites are
+    numbered in order of appearance'''
+
+    def __init__(self, term, variables=(), atomic=(), ordered=False):
+        self.variables = set(variables)
+        self.atomic = set(atomic)
+        self.ordered = ordered
+        self.nodes = []
+        self.regions = []
+        self.sites = 0
+
+        term = term_root(term)
+        if isinstance(term, Parallel):
+            parts = term.parallel
+        else:
+            parts = [term]
+
+        for part in parts:
+            region = PatternRegion()
+            self.regions.append(region)
+            region.parts, region.sites = self.compile_place(part, region)
+
+    def compile_place(self, term, region, depth=1):
+        nodes = []
+        sites = []
+        for part in self.flatten(term):
+            if is_site(part):
+                sites.append(self.sites)
+                self.sites += 1
+            elif isinstance(part, Node):
+                nodes.append(self.compile_node(part, region, depth))
+            elif isinstance(part, (EdgeGroup, Edge)) and region is not None:
+                edges = part.edges if isinstance(part, EdgeGroup) else [part]
+                region.names.extend([edge.symbol for edge in edges])
+        if not self.ordered:
+            # nodes with children constrain the search most, so try them first
+            nodes.sort(key=lambda node: (not node.children, node.signature or ''))
+        return nodes, sites
+
+    def flatten(self, term):
+        if is_one(term):
+            return []
+        elif isinstance(term, Merge):
+            parts = []
+            for part in term.parts:
+                parts.extend(self.flatten(part))
+            return parts
+        return [term]
+
+    def compile_node(self, term, region, depth):
+        symbol = term.control.symbol
+        node = PatternNode(
+            index=len(self.nodes),
+            control=symbol,
+            params=tuple(term.params),
+            ports=tuple(edge.symbol for edge in term.ports.edges),
+            atomic=term.control.atomic or symbol in self.atomic,
+            depth=depth,
+            region=len(self.regions) - 1)
+        self.nodes.append(node)
+
+        if not node.atomic:
+            if term.subnodes is None:
+                node.sites = [self.sites]
+                self.sites += 1
+            else:
+                node.children, node.sites = self.compile_place(term.subnodes, None, depth + 1)
+
+        # identical sibling patterns with no sites, names or variables are
+        # interchangeable, so the matcher only tries them in increasing order
+        if not node.sites and not node.ports and not any(
+                param in self.variables
+                for param in node.params
+                if isinstance(param, str)):
+            children = [child.signature for child in node.children]
+            if all(children):
+                node.signature = f'{node.control}{node.params}({",".join(children)})'
+
+        return node
+
+
+def param_value(value):
+    if isinstance(value, str):
+        if len(value) > 1 and value[0] == '"' and value[-1] == '"':
+            return value[1:-1]
+        try:
+            return int(value)
+        except ValueError:
+            try:
+                return float(value)
+            except ValueError:
+                return value
+    return value
+
+
+class Match():
+    def __init__(self, reaction, pattern, nodes, places, params, links, bindings):
+        self.reaction = reaction
+        self.pattern = pattern
+        self.nodes = nodes
+        self.places = places
+        self.params = params
+        self.links = links
+        self.bindings = bindings
+
+    def image(self):
+        return set(self.nodes)
+
+    def key(self):
+        return (
+            frozenset(self.nodes),
+            tuple(self.params),
+            tuple(sorted(self.links.items())))
+
+    def __repr__(self):
+        symbol = self.reaction.symbol if self.reaction else None
+        return f'Match({symbol}, nodes={self.nodes}, params={self.params})'
+
+
+class Matcher():
+    '''enumerate embeddings of a `Pattern` in a `State` by backtracking,
+    seeding each region from the control index of the state. `places`
+    restricts where the regions may sit, and `anchors` pins pattern nodes
+    (by index) to particular state nodes'''
+
+    def __init__(self, state, pattern, bindings=None, allowed=None, places=None, anchors=None):
+        self.state = state
+        self.pattern = pattern
+        self.allowed = allowed
+        self.seed_places = places
+        self.anchors = anchors or {}
+        self.nodes = [None] * len(pattern.nodes)
+        self.params = [()] * pattern.sites
+        self.places = [None] * len(pattern.regions)
+        self.links = {}
+        self.bindings = dict(bindings or {})
+        self.used = set()
+
+    def candidate_places(self, region):
+        if self.seed_places is not None:
+            return self.seed_places
+        state = self.state
+        if not region.parts:
+            return list(state.regions) + list(state.control)
+        rarest = min(
+            region.parts,
+            key=lambda part: len(state.nodes_with(part.control)))
+        places = {}
+        for id in state.nodes_with(rarest.control):
+            places[state.parent[id]] = None
+        return places
+
+    def bind_params(self, pattern, id, added):
+        values = self.state.params[id]
+        if len(values) != len(pattern.params):
+            return False
+        for expected, value in zip(pattern.params, values):
+            if isinstance(expected, str) and expected in self.pattern.variables:
+                if expected in self.bindings:
+                    if param_value(self.bindings[expected]) != param_value(value):
+                        return False
+                else:
+                    self.bindings[expected] = value
+                    added.append(expected)
+            elif param_value(expected) != param_value(value):
+                return False
+        return True
+
+    def bind_links(self, pattern, id, added):
+        names = self.state.ports[id]
+        if len(names) != len(pattern.ports):
+            return False
+        for name, target in zip(pattern.ports, names):
+            bound = self.links.get(name)
+            if bound is None:
+                self.links[name] = target
+                added.append(name)
+            elif bound != target:
+                return False
+        return True
+
+    def match_node(self, pattern, id):
+        added_links = []
+        added_bindings = []
+        state = self.state
+        if (pattern.ports or state.ports[id]) and not self.bind_links(pattern, id, added_links):
+            pass
+        elif (pattern.params or state.params[id]) and not self.bind_params(pattern, id, added_bindings):
+            pass
+        else:
+            self.nodes[pattern.index] = id
+            self.used.add(id)
+            if pattern.atomic:
+                yield
+            else:
+                yield from self.match_place(
+                    pattern.children,
+                    pattern.sites,
+                    id,
+                    False)
+            self.used.discard(id)
+            self.nodes[pattern.index] = None
+        for name in added_links:
+            del self.links[name]
+        for name in added_bindings:
+            del self.bindings[name]
+
+    def match_place(self, patterns, sites, place, root):
+        children = self.state.children[place]
+        if len(children) < len(patterns):
+            return
+        if not root and not sites and len(children) != len(patterns):
+            return
+        groups = self.state.grouped[place]
+        for pattern in patterns:
+            if pattern.control not in groups:
+                return
+        yield from self.assign(patterns, 0, sites, place, groups, root, set(), [])
+
+    def assign(self, patterns, index, sites, place, groups, root, taken, chosen):
+        if index == len(patterns):
+            if root:
+                yield from self.distribute(sites, (), root)
+            else:
+                remaining = [
+                    child
+                    for child in self.state.children[place]
+                    if child not in taken]
+                yield from self.distribute(sites, remaining, root)
+            return
+
+        pattern = patterns[index]
+        floor = -1
+        if index > 0 and pattern.signature is not None and pattern.signature == patterns[index - 1].signature:
+            floor = chosen[-1]
+
+        candidates = groups[pattern.control]
+        anchor = self.anchors.get(pattern.index)
+        if anchor is not None:
+            candidates = (anchor,) if anchor in candidates else ()
+
+        allowed = self.allowed
+        used = self.used
+        for candidate in candidates:
+            if candidate <= floor or candidate in taken or candidate in used:
+                continue
+            if allowed is not None and not allowed(candidate):
+                continue
+            taken.add(candidate)
+            chosen.append(candidate)
+            for _ in self.match_node(pattern, candidate):
+                yield from self.assign(patterns, index + 1, sites, place, groups, root, taken, chosen)
+            chosen.pop()
+            taken.discard(candidate)
+
+    def distribute(self, sites, remaining, root):
+        if root:
+            # siblings of the redex at region level stay in the context
+            yield
+        elif not sites:
+            if not remaining:
+                yield
+        elif len(sites) == 1:
+            self.params[sites[0]] = tuple(remaining)
+            yield
+            self.params[sites[0]] = ()
+        else:
+            for assignment in itertools.product(range(len(sites)), repeat=len(remaining)):
+                for site in sites:
+                    self.params[site] = tuple(
+                        candidate
+                        for candidate, target in zip(remaining, assignment)
+                        if sites[target] == site)
+                yield
+            for site in sites:
+                self.params[site] = ()
+
+    def match_regions(self, index):
+        if index == len(self.pattern.regions):
+            if self.disjoint():
+                yield
+            return
+
+        region = self.pattern.regions[index]
+        for place in self.candidate_places(region):
+            self.places[index] = place
+            for _ in self.match_place(region.parts, region.sites, place, True):
+                yield from self.match_regions(index + 1)
+        self.places[index] = None
+
+    def disjoint(self):
+        if len(self.places) < 2:
+            return True
+        for place in self.places:
+            if place in self.used:
+                return False
+            for ancestor in self.state.ancestors(place):
+                if ancestor in self.used:
+                    return False
+        return True
+
+    def matches(self):
+        for _ in self.match_regions(0):
+            yield self.snapshot()
+
+    def snapshot(self, reaction=None):
+        return Match(
+            reaction=reaction,
+            pattern=self.pattern,
+            nodes=list(self.nodes),
+            places=list(self.places),
+            params=list(self.params),
+            links=dict(self.links),
+            bindings=dict(self.bindings))
+
+
+class CompiledReaction():
+    def __init__(self, reaction, atomic=()):
+        self.reaction = reaction
+        self.atomic = frozenset(atomic)
+        self.redex = Pattern(
+            reaction.redex,
+            variables=reaction.params,
+            atomic=self.atomic)
+        self.conditions = []
+        if reaction.condition:
+            for group in reaction.condition.groups:
+                self.conditions.append((
+                    group,
+                    Pattern(
+                        group.control,
+                        variables=reaction.params,
+                        atomic=self.atomic)))
+
+    def parameter_nodes(self, state, match):
+        nodes = set()
+        for roots in match.params:
+            for root in roots:
+                nodes.add(root)
+                nodes.update(state.descendants(root))
+        return nodes
+
+    def check(self, state, match):
+        if not self.conditions:
+            return True
+
+        parameters = self.parameter_nodes(state, match)
+        image = match.image()
+        for group, pattern in self.conditions:
+            if group.target == 'param':
+                allowed = parameters.__contains__
+            else:
+                def allowed(id):
+                    return id not in image and id not in parameters
+            matcher = Matcher(
+                state,
+                pattern,
+                bindings=match.bindings,
+                allowed=allowed)
+            occurs = next(matcher.matches(), None) is not None
+            if occurs == group.negate:
+                return False
+        return True
+
+    def matches(self, state, bindings=None, places=None, anchors=None):
+        matcher = Matcher(
+            state,
+            self.redex,
+            bindings=bindings,
+            places=places,
+            anchors=anchors)
+        for _ in matcher.match_regions(0):
+            match = matcher.snapshot(self.reaction)
+            if self.check(state, match):
+                yield match
+
+
+compiled_reactions = weakref.WeakKeyDictionary()
+
+
+def atomic_controls(controls):
+    return frozenset(
+        symbol
+        for symbol, control in (controls or {}).items()
+        if control.atomic)
+
+
+def compile_reaction(reaction, controls=None):
+    ''' compile a reaction once, using `controls` to know which are atomic '''
+    if isinstance(reaction, CompiledReaction):
+        return reaction
+    atomic = atomic_controls(controls)
+    compiled = compiled_reactions.get(reaction)
+    if compiled is None or compiled.atomic != atomic:
+        compiled = CompiledReaction(reaction, atomic=atomic)
+        compiled_reactions[reaction] = compiled
+    return compiled
+
+
+def as_state(state):
+    if isinstance(state, State):
+        return state
+    return State.from_term(state)
+
+
+def find_matches(reaction, state, bindings=None):
+    '''enumerate every occurrence of the redex of `reaction` in `state`.
+
+    Args:
+        reaction: a `Reaction` (or one already compiled by `compile_reaction`)
+        state: a `State`, `Bigraph`, `Big` or ground bigraph term
+        bindings: values for the parameters of a `fun react`. parameters
+            left unbound match any value
+
+    Returns:
+        a list of `Match`, giving the state node matched by each redex node,
+        the state nodes in each site and the state names for each redex name
+    '''
+
+    state = as_state(state)
+    compiled = compile_reaction(reaction, state.controls)
+    return list(compiled.matches(state, bindings=bindings))
+
+
+def test_find_matches():
+    from bigraph.parse import bigraph
+    from bigraph.metabolism import Metabolism
+
+    controls = {'M': Control(symbol='M', arity=2, atomic=True)}
+    state = State.from_term(
+        bigraph('A{a}.Snd.(M{a, v_a} | Ready.Fun.1) | A{b}.Snd.M{a, v_b} | Mail.1'),
+        controls=controls)
+    snd = bigraph('react snd = A{a0}.Snd.(M{a1, v} | id) | Mail --> A{a0} | Mail.(M{a1, v} | id)')
+    matches = find_matches(snd, state)
+    assert len(matches) == 2
+    assert sorted(len(match.params[0]) for match in matches) == [0, 1]
+    assert {match.links['a0'] for match in matches} == {'a', 'b'}
+
+    ready = bigraph('react ready = A{a}.Ready | Mail.(M{a, v} | id) --> A{a} | Mail | {v}')
+    assert find_matches(ready, state) == []
+
+    delivered = State.from_term(
+        bigraph('A{a}.Ready.1 | A{b} | Mail.(M{a, v_a} | M{a, v_b})'),
+        controls=controls)
+    matches = find_matches(ready, delivered)
+    assert len(matches) == 2
+    assert {match.links['v'] for match in matches} == {'v_a', 'v_b'}
+
+    regions = bigraph('react two = A || Mail --> A || Mail')
+    assert len(find_matches(regions, bigraph('A | A | Mail'))) == 2
+    assert len(find_matches(regions, bigraph('Mail.A'))) == 0
+
+    atomic = bigraph('react at = M{x, y} --> M{x, y}')
+    assert find_matches(atomic, delivered)[0].pattern.sites == 0
+    assert find_matches(atomic, bigraph('M{a, b}'))[0].pattern.sites == 1
+
+    fun = bigraph('fun react check(m) = Box.(B(m) | id) --> Box.id')
+    boxes = bigraph('Box.(B(1) | C) | Box.B(2)')
+    assert len(find_matches(fun, boxes)) == 2
+    assert len(find_matches(fun, boxes, bindings={'m': 2})) == 1
+
+    condition = bigraph('react cond = Box.id --> Box if !C in param')
+    assert len(find_matches(condition, boxes)) == 1
+    context = bigraph('react ctx = B(1) --> B(1) if C in ctx')
+    assert len(find_matches(context, boxes)) == 1
+    assert len(find_matches(context, bigraph('Box.B(1)'))) == 0
+
+    metabolism = Metabolism()
+    initial = State.from_term(metabolism.bigraphs['initial'])
+    reactions = metabolism.reactions
+    counts = {
+        symbol: len(find_matches(reaction, initial))
+        for symbol, reaction in reactions.items()}
+    assert counts['fB_B'] == 17
+    assert counts['fF_B'] == 0
+    assert counts['b'] == 1
+    assert counts['phi'] == 1
+    assert counts['degrade_F'] == 1
+    assert counts['degrade_Phi'] == 1
+    assert counts['degrade_B_B'] == 1
+    assert counts['divide_B'] == 0
+
+    start = time.perf_counter()
+    total = 0
+    for _ in range(100):
+        for reaction in reactions.values():
+            total += len(find_matches(reaction, initial))
+    elapsed = time.perf_counter() - start
+    print(f'{elapsed / total * 1e6:.1f} microseconds per match over {total} matches')
+
+
+def native_counts(reaction, state, controls=None):
+    ''' the occurrences of `reaction` in `state` and the distinct states they lead to '''
+    from bigraph.engine import Rule
+
+    state = as_state(state)
+    rule = Rule(reaction, controls=controls or state.controls)
+    successors = set()
+    matches = list(rule.matches(state))
+    for match in matches:
+        successor = state.copy()
+        rule.rewrite(successor, match)
+        successors.add(successor.canonical())
+    return len(matches), len(successors)
+
+
+def bigrapher_counts(reaction, state, controls, executable='bigrapher', path='out/test/agreement'):
+    '''the occurrences of `reaction` in the ground term `state` and the
+    distinct states they lead to, as bigrapher finds them: a `full`
+    exploration stopped after the first state, whose statistics give the
+    occurrences and whose transitions give the successors'''
+    import re
+    from pathlib import Path
+    from bigraph.bigraph import BigraphicalReactiveSystem, Big, System, Init, Rules, RuleGroup
+    from bigraph.graph import TransitionGraph
+
+    brs = BigraphicalReactiveSystem(
+        controls=dict(controls),
+        bigraphs={'initial': Big(symbol='initial', root=state)},
+        reactions={reaction.symbol: reaction},
+        system=System(
+            init=Init(symbol='initial'),
+            rules=Rules(rule_groups=[
+                RuleGroup(
+                    deterministic=False,
+                    rules=[reaction.symbol])])),
+        executable=executable,
+        path=path)
+    brs.write(path=Path(path))
+    output = brs.execute(path=Path(path), subcommand='full', steps=1)
+    occurrences = re.search(rb'Occurrences\D*(\d+)', output)
+    if occurrences is None:
+        raise Exception(f'no occurrences in the output of {executable}:\n{output.decode()}')
+    graph = TransitionGraph.load(path)
+    return int(occurrences.group(1)), len(set(graph.successors(0)))
+
+
+def test_bigrapher_agreement(tmp_path, executable='bigrapher'):
+    '''the occurrences and distinct successors of each reaction in the
+    initial state of the examples and of `Metabolism` are those bigrapher
+    finds'''
+    import glob
+    import pytest
+    from bigraph.parse import parse_big
+    from bigraph.metabolism import Metabolism
+
+    if shutil.which(executable) is None:
+        pytest.skip(f'{executable} not found')
+
+    systems = [
+        parse_big(example)
+        for example in sorted(glob.glob('examples/big/*.big'))]
+    systems.append(Metabolism().brs)
+    for brs in systems:
+        initial = brs.bigraphs[brs.system.init.symbol].root
+        for symbol, reaction in brs.reactions.items():
+            # a `fun react` has no single rule to explore
+            if reaction.params:
+                continue
+            native = native_counts(reaction, State.from_term(initial, controls=brs.controls))
+            assert native == bigrapher_counts(reaction, initial, brs.controls, executable=executable, path=tmp_path), symbol
+
+
+if __name__ == '__main__':
+    import fire
+    fire.Fire(test_find_matches)
@@ -1,5 +1,4 @@
 import itertools
-import fire
 
 from bigraph.bigraph import Base, Bigraph, Merge, BigraphicalReactiveSystem, react, apply_reactions
 from bigraph.parse import bigraph
@@ -12,7 +11,7 @@ def partition(items, predicate=bool):
 
 
 class Metabolism(Base):
-    def __init__(self, path='.'):
+    def __init__(self, path='.', size=21):
         self.controls = {
             # 'A': bigraph('ctrl A = 0'),
             'B': bigraph('ctrl B = 0'),
@@ -91,7 +90,7 @@ class Metabolism(Base):
 
         self.bigraphs = {
             'initial': bigraph(f"""
-                big initial = {initial_state(21)}""")}
+                big initial = {initial_state(size)}""")}
 
         reaction_keys, divide_keys = partition(
             self.reactions.keys(),
@@ -115,11 +114,11 @@ class Metabolism(Base):
             path=path)
 
 
-def test_metabolism():
+def test_metabolism(tmp_path):
     metabolism = Metabolism()
     results = metabolism.brs.simulate(
         key='metabolism',
-        path='out/test/metabolism',
+        path=tmp_path,
         # console=True,
         steps=987)
 
@@ -131,8 +130,16 @@ def test_metabolism():
 
 def run_metabolism(
         above=43,
-        steps=8888):
-    metabolism = Metabolism()
+        steps=8888,
+        path='histories/replicas',
+        replicas=100,
+        sizes=(21,),
+        cores=None):
+    '''simulate `Metabolism` with bigrapher across a process pool, appending
+    every run longer than `above` states to `path`. the default keeps new
+    runs apart from the reference histories in `histories/metabolism`. see
+    `replicas.run_replicas`'''
+    from bigraph.replicas import run_replicas
 
     # script = [
     #     F, B, Phi, F, B, Phi, F, Phi, F, F, F,
@@ -145,24 +152,17 @@ def run_metabolism(
     # for result in results:
     #     print(result)
 
-    running = True
-    while running:
-        results = metabolism.brs.simulate(
-            key='metabolism',
-            path='out/test/metabolism',
-            # console=True,
-            steps=steps)
-
-        if len(results) > above:
-            print('\n')
-            for result in results:
-                print(result)
-
-        # print(f'steps: {len(results)}')
-        # running = False
+    return run_replicas(
+        path=path,
+        above=above,
+        sizes=sizes,
+        steps=(steps,),
+        replicas=replicas,
+        cores=cores)
         
 
 if __name__ == '__main__':
+    import fire
     fire.Fire(run_metabolism)
 
 
@@ -1,4 +1,3 @@
-import fire
 from parsimonious.grammar import Grammar
 from parsimonious.nodes import NodeVisitor
 
@@ -44,8 +43,7 @@ examples = {
     'reactive-system': 'begin pbrs\n\n   int m = [1:1:2];           int dcap = 20;\n\n  end  #### here we go\n#ffffffffff'}
 
 
-big_grammar = Grammar(
-    """
+BIG_GRAMMAR = """
     big_source = (cws big_expression semicolon? cws)*
     big_expression = control_declare / bigraph_expression / react_expression / reactive_system / expression
 
@@ -154,7 +152,17 @@ big_grammar = Grammar(
     not_newline = ~r"[^\\n\\r]"*
     newline = ~"[\\n\\r]+"
     ws = ~"\s*"
-    """)
+    """
+
+
+grammars = {}
+
+
+def big_grammar():
+    ''' the grammar of the bigrapher language, compiled the first time it is needed '''
+    if 'big' not in grammars:
+        grammars['big'] = Grammar(BIG_GRAMMAR)
+    return grammars['big']
 
 
 class BigVisitor(NodeVisitor):
@@ -526,7 +534,7 @@ class BigVisitor(NodeVisitor):
 
 
 def bigraph(expression):
-    parse = big_grammar.parse(expression)
+    parse = big_grammar().parse(expression)
     visitor = BigVisitor()
     bigraphs = visitor.visit(parse)
 
@@ -555,4 +563,5 @@ def test_parse_bigraph():
 
 
 if __name__ == '__main__':
+    import fire
     fire.Fire(test_parse_bigraph)
@@ -0,0 +1,230 @@
+import os
+import time
+import itertools
+import threading
+import multiprocessing
+from pathlib import Path
+
+from bigraph.history import write_histories
+
+
+ENGINES = ['bigrapher', 'counts']
+
+# tasks handed to the pool ahead of their results for each core, so an open
+# ended run never queues more than this
+ROUND_SIZE = 4
+
+metabolisms = {}
+
+
+def metabolism(size):
+    ''' the `Metabolism` system starting from `size` compartments, built once per process '''
+    from bigraph.metabolism import Metabolism
+
+    if size not in metabolisms:
+        metabolisms[size] = Metabolism(size=size).brs
+    return metabolisms[size]
+
+
+def run_replica(task):
+    '''simulate one replica, returning its task and the rendered states of
+    its trajectory. bigrapher runs in a private directory of its own. the
+    counts engine seeds its random numbers with the replica index, while
+    bigrapher takes no seed, so its replicas are independent draws'''
+    engine, size, steps, replica, executable = task
+    brs = metabolism(size)
+    if engine == 'counts':
+        from bigraph.compartment import simulate_counts
+        history = simulate_counts(brs, steps=steps, seed=replica)
+    else:
+        brs.executable = executable
+        history = [
+            state.render()
+            for state in brs.simulate(steps=steps, format='json', pipe=True)]
+    return task, history
+
+
+def ledger_path(path):
+    path = Path(path)
+    return path.with_name(f'{path.name}.done')
+
+
+def read_ledger(path):
+    ''' the `(size, steps, replica)` of every replica already run into the histories at `path` '''
+    ledger = ledger_path(path)
+    if not ledger.exists():
+        return set()
+    done = set()
+    with open(ledger, 'r') as ledger_file:
+        for line in ledger_file:
+            fields = line.split()
+            if len(fields) >= 3 and line.endswith('\n'):
+                done.add((int(fields[0]), int(fields[1]), int(fields[2])))
+    return done
+
+
+def recover(path):
+    '''cut the ledger of the histories at `path` after its last whole line,
+    and the histories after the size that line records, dropping any
+    history written for a replica that was never recorded as done. a new
+    ledger starts with the size of the histories before any replica'''
+    ledger = ledger_path(path)
+    if not ledger.exists():
+        size = path.stat().st_size if path.exists() else 0
+        with open(ledger, 'w') as ledger_file:
+            ledger_file.write(f'start {size}\n')
+        return
+
+    with open(ledger, 'rb') as ledger_file:
+        lines = ledger_file.read()
+    whole = lines.rfind(b'\n') + 1
+    if whole < len(lines):
+        os.truncate(ledger, whole)
+
+    size = None
+    for line in lines[:whole].decode('utf-8').splitlines():
+        fields = line.split()
+        if fields and fields[0] == 'start':
+            size = int(fields[1])
+        elif len(fields) >= 5:
+            size = int(fields[4])
+    if size is not None and path.exists() and path.stat().st_size > size:
+        os.truncate(path, size)
+
+
+def run_replicas(
+        path='histories/replicas',
+        above=43,
+        sizes=(21,),
+        steps=(8888,),
+        replicas=100,
+        first=0,
+        cores=None,
+        engine='bigrapher',
+        executable='bigrapher'):
+    '''simulate `replicas` runs of `Metabolism` at each point of the grid of
+    initial `sizes` and `steps`, across a pool of `cores` processes. the
+    replicas of a point are numbered from `first`, and with `replicas=None`
+    they continue until interrupted. the number only tells replicas apart in
+    the ledger, and seeds the counts engine: bigrapher is not given a seed.
+
+    every trajectory longer than `above` states is appended to the histories
+    file `path` as it finishes, and every finished replica is then recorded
+    in `{path}.done` with the size of the histories after it, so running
+    again with the same arguments skips what is already done and picks up
+    where an interrupted run stopped, without a history whose replica was
+    not recorded. replicas stream through the pool, each core kept busy
+    with the next task as soon as it finishes one. returns the number of
+    replicas run and the number of histories written'''
+
+    if engine not in ENGINES:
+        raise Exception(f'engine {engine} not supported. Available engines are {ENGINES}')
+    if isinstance(sizes, int):
+        sizes = (sizes,)
+    if isinstance(steps, int):
+        steps = (steps,)
+
+    if engine == 'bigrapher':
+        from bigraph.bigraph import check_systems
+        check_systems(metabolism(size) for size in sizes)
+
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    recover(path)
+    done = read_ledger(path)
+    cores = cores or os.cpu_count() or 1
+
+    indexes = itertools.count(first) if replicas is None else range(first, first + replicas)
+    tasks = (
+        (engine, size, count, replica, executable)
+        for replica in indexes
+        for size in sizes
+        for count in steps
+        if (size, count, replica) not in done)
+
+    # the pool takes tasks from this in a thread of its own, waiting for a
+    # free slot before each, and a slot is freed as each result is handled
+    slots = threading.Semaphore(cores * ROUND_SIZE)
+    stopped = threading.Event()
+
+    def bounded(tasks):
+        for task in tasks:
+            while not slots.acquire(timeout=0.1):
+                if stopped.is_set():
+                    return
+            yield task
+
+    ran = 0
+    written = 0
+    with multiprocessing.Pool(cores) as pool, open(ledger_path(path), 'a') as ledger:
+        try:
+            for (engine, size, count, replica, executable), history in pool.imap_unordered(run_replica, bounded(tasks)):
+                if len(history) > above:
+                    write_histories(path, [history])
+                    written += 1
+                ledger.write(f'{size} {count} {replica} {len(history)} {path.stat().st_size if path.exists() else 0}\n')
+                ledger.flush()
+                ran += 1
+                slots.release()
+        finally:
+            stopped.set()
+    return ran, written
+
+
+def test_run_replicas(tmp_path):
+    from bigraph.history import read_histories
+    from bigraph.fake import fake_bigrapher
+
+    path = tmp_path / 'histories'
+
+    # two sizes of three replicas, keeping every run
+    ran, written = run_replicas(path, above=0, sizes=(13, 21), steps=(30,), replicas=3, cores=2, engine='counts')
+    assert ran == written == 6
+    histories = read_histories(path)
+    assert len(histories) == 6
+    assert all(len(history) <= 31 for history in histories)
+    assert len(read_ledger(path)) == 6
+
+    # a second run has nothing left to do, and more replicas only adds the new ones
+    assert run_replicas(path, above=0, sizes=(13, 21), steps=(30,), replicas=3, cores=2, engine='counts') == (0, 0)
+    assert run_replicas(path, above=0, sizes=(13, 21), steps=(30,), replicas=4, cores=2, engine='counts') == (2, 2)
+    assert len(read_histories(path)) == 8
+
+    # a history written for a replica never recorded as done is dropped, and
+    # the replica runs again
+    with open(ledger_path(path), 'r') as ledger_file:
+        lines = ledger_file.readlines()
+    with open(ledger_path(path), 'w') as ledger_file:
+        ledger_file.writelines(lines[:-1])
+        ledger_file.write('13 30')
+    assert run_replicas(path, above=0, sizes=(13, 21), steps=(30,), replicas=4, cores=2, engine='counts') == (1, 1)
+    assert len(read_histories(path)) == 8
+    assert len(read_ledger(path)) == 8
+
+    # bigrapher replicas each run in their own directory
+    fake = Path(path).parent / 'fake'
+    ran, written = run_replicas(fake / 'histories', above=2, steps=(1, 2), replicas=2, cores=2, executable=fake_bigrapher(fake))
+    assert (ran, written) == (4, 2)
+    assert all(len(history) == 3 for history in read_histories(fake / 'histories'))
+
+
+def benchmark_replicas(replicas=32, cores=(1, 2, 4), steps=200, path='out/test/replicas/benchmark'):
+    import shutil
+
+    for count in cores:
+        shutil.rmtree(Path(path).parent / f'benchmark-{count}', ignore_errors=True)
+        start = time.perf_counter()
+        ran, written = run_replicas(
+            Path(path).parent / f'benchmark-{count}' / 'histories',
+            above=0,
+            steps=(steps,),
+            replicas=replicas,
+            cores=count,
+            engine='counts')
+        elapsed = time.perf_counter() - start
+        print(f'{count} cores: {ran} replicas in {elapsed:.3f}s, {ran / elapsed:.1f} replicas per second')
+
+
+if __name__ == '__main__':
+    import fire
+    fire.Fire(run_replicas)
@@ -0,0 +1,154 @@
+import os
+import time
+import shutil
+import tempfile
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from bigraph.bigraph import ram_directory, check_systems
+
+
+class Job():
+    ''' one run of bigrapher on `system`, as `simulate` would make it '''
+
+    def __init__(self, system, steps=None, format='json', subcommand='sim', key=None, tag=None):
+        if isinstance(format, str):
+            format = (format,)
+        if 'json' not in format:
+            raise Exception(f'a scheduled job reads its states from json, but only {format} was requested')
+        self.system = system
+        self.steps = steps
+        self.format = tuple(format)
+        self.subcommand = subcommand
+        self.key = key or system.key
+        self.tag = tag
+        self.path = None
+        self.result = None
+        self.started = None
+        self.finished = None
+
+    def __repr__(self):
+        tag = f' {self.tag}' if self.tag is not None else ''
+        return f'Job({self.subcommand}{tag}, steps={self.steps})'
+
+
+class Scheduler():
+    '''run many bigrapher jobs at once, at most `cores` at a time.
+
+    each job gets its own temporary directory, so jobs on the same system
+    never share files. by default the directories are on a memory backed
+    filesystem and removed once the states are read. given a `path`, each
+    job keeps its directory under it instead, and `job.path` names it, so
+    svgs and other outputs can be used after the run. either way the states
+    are loaded into a list before the job finishes'''
+
+    def __init__(self, cores=None, path=None):
+        self.cores = cores or os.cpu_count() or 1
+        self.path = Path(path) if path is not None else None
+
+    def run_job(self, job):
+        job.started = time.perf_counter()
+        if self.path is None:
+            directory = Path(tempfile.mkdtemp(prefix='bigraph-', dir=ram_directory()))
+        else:
+            self.path.mkdir(parents=True, exist_ok=True)
+            directory = Path(tempfile.mkdtemp(prefix=f'{job.key}-', dir=self.path))
+        try:
+            system = job.system
+            system.write(path=directory, key=job.key)
+            system.execute(
+                path=directory,
+                key=job.key,
+                subcommand=job.subcommand,
+                format=job.format,
+                steps=job.steps)
+            job.result = system.read(path=directory, key=job.key).load()
+        finally:
+            if self.path is None:
+                shutil.rmtree(directory, ignore_errors=True)
+            else:
+                job.path = directory
+        job.finished = time.perf_counter()
+        return job
+
+    def run(self, jobs):
+        '''run `jobs`, yielding each as it finishes with its trajectory in
+        `job.result`. an error in a job is raised when that job is reached'''
+        jobs = [
+            job if isinstance(job, Job) else Job(*job)
+            for job in jobs]
+        check_systems(job.system for job in jobs)
+        with ThreadPoolExecutor(max_workers=self.cores) as pool:
+            futures = [
+                pool.submit(self.run_job, job)
+                for job in jobs]
+            for future in as_completed(futures):
+                yield future.result()
+
+    def map(self, jobs):
+        ''' the trajectories of `jobs`, in the order given '''
+        jobs = [
+            job if isinstance(job, Job) else Job(*job)
+            for job in jobs]
+        for _ in self.run(jobs):
+            pass
+        return [job.result for job in jobs]
+
+
+def simulate_all(systems, steps=None, format='json', cores=None):
+    ''' simulate each of `systems` concurrently, returning their trajectories in order '''
+    return Scheduler(cores=cores).map([
+        Job(system, steps=steps, format=format)
+        for system in systems])
+
+
+def test_scheduler(tmp_path):
+    from bigraph.fake import fake_system, fake_environment
+
+    path = tmp_path
+    system = fake_system(path)
+    system.path = Path(path) / 'system'
+
+    # jobs on four cores run at the same time, up to four at once
+    jobs = [
+        Job(system, steps=steps, tag=steps)
+        for steps in range(6)]
+    with fake_environment(delay=0.25):
+        finished = list(Scheduler(cores=4).run(jobs))
+    assert sorted(job.tag for job in finished) == list(range(6))
+    for job in jobs:
+        assert [state.render() for state in job.result] == [f'Step({step})' for step in range(job.steps + 1)]
+
+    def running(moment):
+        return sum(job.started <= moment < job.finished for job in jobs)
+    overlap = max(running(job.started) for job in jobs)
+    assert 1 < overlap <= 4
+    assert not system.path.exists()
+
+    # kept directories are distinct and hold every output
+    kept = Scheduler(cores=2, path=Path(path) / 'kept').map([
+        (system, 1, ('json', 'svg')),
+        (system, 2, ('json', 'svg'))])
+    assert [len(history) for history in kept] == [2, 3]
+    assert all(isinstance(history, list) for history in kept)
+    directories = list((Path(path) / 'kept').iterdir())
+    assert len(directories) == 2
+    assert all((directory / '0.svg').exists() for directory in directories)
+
+
+def benchmark_scheduler(jobs=16, cores=(1, 2, 4, 8), delay=0.2, path='out/test/scheduler'):
+    from bigraph.fake import fake_system, fake_environment
+
+    system = fake_system(path)
+    for count in cores:
+        start = time.perf_counter()
+        with fake_environment(delay=delay):
+            Scheduler(cores=count).map([
+                Job(system, steps=10)
+                for _ in range(jobs)])
+        print(f'{jobs} jobs of {delay}s on {count} cores: {time.perf_counter() - start:.3f}s')
+
+
+if __name__ == '__main__':
+    import fire
+    fire.Fire(benchmark_scheduler)
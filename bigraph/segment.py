@@ -0,0 +1,167 @@
+import os
+import json
+from pathlib import Path
+
+from bigraph.bigraph import Bigraph, Big
+
+
+class SegmentedSimulation():
+    '''simulate a `BigraphicalReactiveSystem` in chunks of `chunk` steps.
+
+    each chunk starts bigrapher from the last state of the one before, set
+    as the `init` bigraph of the system. the states of every chunk are
+    appended to `{path}/{key}.trajectory`, one rendered state per line, and
+    the position reached, with the size of the trajectory then, is saved to
+    `{path}/{key}.checkpoint` after each chunk. so only one chunk is ever
+    held in memory, and a run that stops for any reason continues from its
+    last checkpoint, dropping whatever was appended after it. asking for
+    more steps than a finished run had extends it'''
+
+    def __init__(self, brs, path=None, key=None, chunk=1000, pipe=True):
+        self.brs = brs
+        self.path = Path(path or brs.path)
+        self.key = key or brs.key
+        self.chunk = chunk
+        self.pipe = pipe
+
+    def checkpoint_path(self):
+        return self.path / f'{self.key}.checkpoint'
+
+    def trajectory_path(self):
+        return self.path / f'{self.key}.trajectory'
+
+    def checkpoint(self):
+        ''' the saved position, or `None` before the first chunk '''
+        if not self.checkpoint_path().exists():
+            return None
+        with open(self.checkpoint_path(), 'r') as checkpoint_file:
+            return json.load(checkpoint_file)
+
+    def save(self, checkpoint):
+        partial = self.checkpoint_path().with_suffix('.partial')
+        with open(partial, 'w') as checkpoint_file:
+            json.dump(checkpoint, checkpoint_file)
+        os.replace(partial, self.checkpoint_path())
+
+    def reset(self):
+        for path in (self.checkpoint_path(), self.trajectory_path()):
+            if path.exists():
+                path.unlink()
+
+    def run_chunk(self, state, steps):
+        ''' the trajectory of `steps` steps starting from `state`, or from `init` when `None` '''
+        system = self.brs.system
+        symbol = system.init.symbol
+        original = self.brs.bigraphs[symbol]
+        if state is not None:
+            from bigraph.parse import bigraph
+            root = Bigraph.unfold(bigraph(state)).roots.ground()
+            self.brs.bigraphs[symbol] = Big(symbol=symbol, root=root)
+        try:
+            return self.brs.simulate(
+                path=self.path,
+                key=self.key,
+                format='json',
+                steps=steps,
+                pipe=self.pipe)
+        finally:
+            self.brs.bigraphs[symbol] = original
+
+    def run(self, steps):
+        '''simulate until the trajectory has `steps` steps or no rule applies,
+        continuing from the checkpoint if there is one. returns the
+        checkpoint'''
+
+        self.path.mkdir(parents=True, exist_ok=True)
+        checkpoint = self.checkpoint()
+        if checkpoint is None:
+            self.reset()
+            checkpoint = {
+                'steps': 0,
+                'chunks': 0,
+                'state': None,
+                'terminal': False,
+                'size': 0}
+        elif self.trajectory_path().exists() and self.trajectory_path().stat().st_size > checkpoint['size']:
+            # a chunk was appended but its checkpoint never saved
+            os.truncate(self.trajectory_path(), checkpoint['size'])
+
+        while checkpoint['steps'] < steps and not checkpoint['terminal']:
+            size = min(self.chunk, steps - checkpoint['steps'])
+            history = self.run_chunk(checkpoint['state'], size)
+            states = [
+                state.render()
+                for state in history]
+
+            # every chunk after the first starts with the last state of the one before
+            new = states if checkpoint['state'] is None else states[1:]
+            with open(self.trajectory_path(), 'a') as trajectory_file:
+                for state in new:
+                    trajectory_file.write(f'{state}\n')
+
+            checkpoint = {
+                'steps': checkpoint['steps'] + len(states) - 1,
+                'chunks': checkpoint['chunks'] + 1,
+                'state': states[-1],
+                'terminal': len(states) - 1 < size,
+                'size': self.trajectory_path().stat().st_size}
+            self.save(checkpoint)
+
+        return checkpoint
+
+    def trajectory(self):
+        ''' the rendered states of the whole run so far, read one at a time '''
+        if not self.trajectory_path().exists():
+            return
+        with open(self.trajectory_path(), 'r') as trajectory_file:
+            for line in trajectory_file:
+                yield line.rstrip('\n')
+
+
+def simulate_segmented(brs, steps, chunk=1000, path=None, key=None):
+    ''' run `brs` for `steps` steps in chunks, resuming any earlier run, and return its rendered trajectory '''
+    segmented = SegmentedSimulation(brs, path=path, key=key, chunk=chunk)
+    segmented.run(steps)
+    return list(segmented.trajectory())
+
+
+def test_segmented_simulation(tmp_path):
+    from bigraph.fake import fake_system, fake_environment
+
+    path = tmp_path
+    brs = fake_system(path)
+    log = Path(path) / 'log'
+    initial = brs.bigraphs['initial'].render()
+
+    def runs():
+        with open(log, 'r') as log_file:
+            return [line.split() for line in log_file]
+
+    segmented = SegmentedSimulation(brs, path=Path(path) / 'run', chunk=2)
+    with fake_environment(log=log):
+        checkpoint = segmented.run(5)
+    assert checkpoint['steps'] == 5 and checkpoint['chunks'] == 3
+    assert [arguments[arguments.index('-S') + 1] for arguments in runs()] == ['2', '2', '1']
+
+    # the fake always counts from Step(0), so each chunk continues with Step(1)
+    trajectory = list(segmented.trajectory())
+    assert trajectory == ['Step(0)', 'Step(1)', 'Step(2)', 'Step(1)', 'Step(2)', 'Step(1)']
+    assert brs.bigraphs['initial'].render() == initial
+
+    # a new simulation of the same path picks up from the checkpoint,
+    # without the states of a chunk that stopped before its checkpoint
+    with open(segmented.trajectory_path(), 'a') as trajectory_file:
+        trajectory_file.write('Step(1)\nStep(2)\n')
+    resumed = SegmentedSimulation(brs, path=Path(path) / 'run', chunk=2)
+    with fake_environment(log=log):
+        checkpoint = resumed.run(8)
+    assert checkpoint['steps'] == 8 and checkpoint['chunks'] == 5
+    assert len(runs()) == 5
+    assert list(resumed.trajectory()) == trajectory + ['Step(1)', 'Step(2)', 'Step(1)']
+    assert simulate_segmented(brs, 8, chunk=2, path=Path(path) / 'run') == list(resumed.trajectory())
+    assert len(runs()) == 5
+
+
+if __name__ == '__main__':
+    import fire
+    fire.Fire(simulate_segmented)
@@ -0,0 +1,285 @@
+import time
+import random
+from pathlib import Path
+
+from bigraph.bigraph import Bigraph, Big, BigraphicalReactiveSystem, RuleGroup, Rules, System, Init
+
+
+class ReactionSession():
+    '''apply reactions one at a time to a state, as `react` does, keeping
+    one model across calls.
+
+    the controls and reactions are rendered once, and each run only writes
+    the state as `big initial` and a system allowing the one reaction to
+    apply. in `apply`, a run of the same reaction repeated `k` times in a
+    script is a single bigrapher invocation of `k` steps, as that reaction is
+    the only rule and each step applies it once. with `native` reactions are
+    applied in process by the rewriting engine instead of by bigrapher,
+    choosing among matches with a random generator seeded by `seed`.
+
+    given a `cache`, bigrapher runs are only stored under a `sample`, a label
+    as in `cache.ResultCache`, as in `apply_reactions`. without one every
+    run starts bigrapher, and with `sample=0` a session replaying a script
+    reuses the runs of the last replay'''
+
+    def __init__(
+            self,
+            path='out/test/react',
+            key='system',
+            executable='bigrapher',
+            native=False,
+            seed=None,
+            cache=None,
+            sample=None):
+
+        self.brs = BigraphicalReactiveSystem(
+            executable=executable,
+            path=path,
+            key=key)
+        self.path = Path(path)
+        self.key = key
+        self.native = native
+        self.random = random.Random(seed)
+        self.sample = sample
+        self.cache = cache
+        self.prelude = None
+        self.rules = {}
+        self.invocations = 0
+
+    def add_controls(self, controls):
+        for symbol, control in controls.items():
+            if symbol not in self.brs.controls:
+                self.brs.controls[symbol] = control
+                self.prelude = None
+
+    def add_reaction(self, reaction):
+        if self.brs.reactions.get(reaction.symbol) is reaction:
+            return
+        self.brs.reactions[reaction.symbol] = reaction
+        self.add_controls(Bigraph.unfold(reaction.redex).controls)
+        self.add_controls(Bigraph.unfold(reaction.reactum).controls)
+        self.rules.pop(reaction.symbol, None)
+        self.prelude = None
+
+    def ground(self, state):
+        bigraph = Bigraph.unfold(state)
+        self.add_controls(bigraph.controls)
+        return bigraph.roots.ground()
+
+    def render_prelude(self):
+        if self.prelude is None:
+            controls = '\n'.join([
+                f'{control.render()};'
+                for symbol, control in self.brs.controls.items()
+                if symbol != '1' and symbol != 'id'])
+            reactions = '\n'.join([
+                f'{reaction.render(indent=4)};\n'
+                for symbol, reaction in self.brs.reactions.items()])
+            self.prelude = '\n\n'.join([controls, reactions])
+        return self.prelude
+
+    def model(self, root, symbol):
+        ''' make the model `root` as `big initial` with `symbol` its only rule, and check it '''
+        self.brs.bigraphs = {
+            'initial': Big(symbol='initial', root=root)}
+        self.brs.system = System(
+            system_type='brs',
+            bindings=[],
+            init=Init(symbol='initial'),
+            rules=Rules(rule_groups=[
+                RuleGroup(
+                    deterministic=False,
+                    rules=[symbol])]))
+        self.brs.check()
+
+    def render(self):
+        return '\n\n'.join([
+            self.render_prelude(),
+            f'{self.brs.bigraphs["initial"].render()};',
+            self.brs.system.render()])
+
+    def run(self, reaction, state, steps=1):
+        ''' the `steps` states after `state` reached by applying `reaction` again and again '''
+        self.add_reaction(reaction)
+        root = self.ground(state)
+        self.model(root, reaction.symbol)
+        if self.native:
+            return self.run_native(reaction, root, steps)
+
+        source = self.render()
+
+        def invoke():
+            self.path.mkdir(parents=True, exist_ok=True)
+            with open(self.path / f'{self.key}.big', 'w') as big_file:
+                big_file.write(source)
+            self.invocations += 1
+            self.brs.execute(
+                path=self.path,
+                key=self.key,
+                subcommand='sim',
+                format='json',
+                steps=steps)
+            # the next run writes over these states
+            with self.brs.read(path=self.path, key=self.key) as trajectory:
+                return trajectory.load(workers=1)
+
+        if self.cache is None:
+            history = invoke()
+        else:
+            key = self.cache.key(source, 'sim', steps, 'json', self.sample)
+            history = self.cache.get(key)
+            if history is None:
+                start = time.perf_counter()
+                history = invoke()
+                self.cache.put(key, history, time.perf_counter() - start)
+
+        if len(history) < steps + 1:
+            raise Exception(f'reaction {reaction.symbol} applied {len(history) - 1} times, but {steps} were asked for')
+        return history[1:steps + 1]
+
+    def run_native(self, reaction, root, steps):
+        from bigraph.state import State
+        from bigraph.engine import Rule
+
+        rule = self.rules.get(reaction.symbol)
+        if rule is None:
+            rule = Rule(reaction, controls=self.brs.controls)
+            self.rules[reaction.symbol] = rule
+        state = State.from_term(root, controls=self.brs.controls)
+        history = []
+        for step in range(steps):
+            matches = list(rule.matches(state))
+            if not matches:
+                raise Exception(f'reaction {reaction.symbol} applied {step} times, but {steps} were asked for')
+            rule.rewrite(state, self.random.choice(matches))
+            history.append(state.to_term())
+        return history
+
+    def react(self, reaction, state):
+        return self.run(reaction, state, steps=1)[0]
+
+    def apply(self, reactions, initial):
+        ''' the history of applying each of `reactions` in turn, starting from `initial` '''
+        history = [initial]
+        state = initial
+        position = 0
+        while position < len(reactions):
+            reaction = reactions[position]
+            repeats = 1
+            while position + repeats < len(reactions) and reactions[position + repeats] is reaction:
+                repeats += 1
+            history.extend(self.run(reaction, state, steps=repeats))
+            state = history[-1]
+            position += repeats
+        return history
+
+
+def test_reaction_session(tmp_path):
+    from bigraph.parse import bigraph
+    from bigraph.fake import fake_bigrapher, fake_environment
+
+    path = tmp_path
+    grow = bigraph('''
+        react grow =
+            A
+            -->
+            A.B''')
+    shrink = bigraph('''
+        react shrink =
+            A.B
+            -->
+            A''')
+    initial = bigraph('A')
+
+    # in process, the script is replayed exactly
+    native = ReactionSession(native=True, seed=1)
+    history = native.apply([grow, shrink, grow], initial)
+    assert [state.render() for state in history] == ['A', 'A.B', 'A', 'A.B']
+
+    # repeats of a reaction share one invocation and the model is rendered once
+    log = Path(path) / 'log'
+    session = ReactionSession(path=Path(path) / 'run', executable=fake_bigrapher(path))
+    script = [grow, grow, grow, shrink, grow, grow]
+    with fake_environment(log=log):
+        history = session.apply(script, initial)
+    assert len(history) == len(script) + 1
+    assert session.invocations == 3
+    with open(log, 'r') as log_file:
+        steps = [
+            line.split()[line.split().index('-S') + 1]
+            for line in log_file]
+    assert steps == ['3', '1', '2']
+    with open(Path(path) / 'run' / 'system.big', 'r') as big_file:
+        source = big_file.read()
+    assert source.count('react grow') == 1 and source.count('react shrink') == 1
+    assert '{grow}' in source and '{shrink}' not in source
+
+    # a reaction bigrapher would reject fails before anything runs
+    broken = bigraph('''
+        react broken =
+            A{x}
+            -->
+            A{x,y}''')
+    for checked in (ReactionSession(native=True), ReactionSession(path=Path(path) / 'broken', executable=fake_bigrapher(path))):
+        try:
+            checked.react(broken, initial)
+            assert False
+        except Exception as error:
+            assert 'links 2 ports of A, which has arity 1' in str(error)
+        assert checked.invocations == 0
+
+    # a session given a cache only replays a script from it under a sample
+    from bigraph.cache import ResultCache
+    cache = ResultCache(Path(path) / 'cache')
+    for options, invocations in (({}, 3), ({'sample': 0}, 0)):
+        cached = ReactionSession(path=Path(path) / 'cached', executable=fake_bigrapher(path), cache=cache, **options)
+        cached.apply(script, initial)
+        cached = ReactionSession(path=Path(path) / 'cached', executable=fake_bigrapher(path), cache=cache, **options)
+        assert [state.render() for state in cached.apply(script, initial)] == [state.render() for state in history]
+        assert cached.invocations == invocations
+
+
+def benchmark_session(reactions=100, executable=None, path='out/test/session'):
+    import shutil
+    from bigraph.parse import bigraph
+    from bigraph.bigraph import apply_reactions
+    from bigraph.fake import fake_bigrapher
+
+    grow = bigraph('''
+        react grow =
+            A
+            -->
+            A.B''')
+    shrink = bigraph('''
+        react shrink =
+            A.B
+            -->
+            A''')
+    script = [grow, grow, shrink, shrink, grow] * (reactions // 5)
+    initial = bigraph('A')
+    executable = executable or shutil.which('bigrapher') or fake_bigrapher(path)
+
+    start = time.perf_counter()
+    apply_reactions(script, initial, executable=executable, path=Path(path) / 'react')
+    print(f'react: {time.perf_counter() - start:.3f}s for {len(script)} reactions')
+
+    session = ReactionSession(path=Path(path) / 'run', executable=executable)
+    start = time.perf_counter()
+    state = initial
+    for reaction in script:
+        state = session.react(reaction, state)
+    print(f'session, one reaction at a time: {time.perf_counter() - start:.3f}s in {session.invocations} invocations')
+
+    session = ReactionSession(path=Path(path) / 'run', executable=executable)
+    start = time.perf_counter()
+    session.apply(script, initial)
+    print(f'session, batched: {time.perf_counter() - start:.3f}s in {session.invocations} invocations')
+
+    start = time.perf_counter()
+    ReactionSession(native=True, seed=1).apply(script, initial)
+    print(f'native session: {time.perf_counter() - start:.3f}s')
+
+
+if __name__ == '__main__':
+    import fire
+    fire.Fire(benchmark_session)
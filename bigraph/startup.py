@@ -0,0 +1,61 @@
+import sys
+import subprocess
+
+
+# seconds `import bigraph.bigraph` may take in a fresh interpreter
+IMPORT_BUDGET = 0.25
+
+# modules only some functions need, which should not load with the package
+DEFERRED_MODULES = ['IPython', 'networkx', 'fire']
+
+MODULES = [
+    'bigraph.bigraph',
+    'bigraph.parse',
+    'bigraph.engine',
+    'bigraph.explore']
+
+
+def import_time(module):
+    '''the seconds a fresh interpreter spends importing `module`, as
+    reported by `python -X importtime`, and the modules it loaded'''
+    script = f'import sys, {module}; print(",".join(sorted(sys.modules)))'
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', script],
+        capture_output=True,
+        text=True,
+        check=True)
+
+    microseconds = None
+    for line in result.stderr.splitlines():
+        fields = line.split('|')
+        if len(fields) == 3 and fields[2].strip() == module:
+            microseconds = int(fields[1])
+    loaded = set(result.stdout.strip().split(','))
+    return microseconds / 1e6, loaded
+
+
+def test_import_time():
+    seconds, loaded = import_time('bigraph.bigraph')
+    deferred = [
+        module
+        for module in DEFERRED_MODULES
+        if module in loaded]
+    assert not deferred, f'bigraph.bigraph imports {deferred} at load'
+    assert seconds < IMPORT_BUDGET, f'import bigraph.bigraph took {seconds:.3f}s, budget is {IMPORT_BUDGET}s'
+
+    # the grammar is compiled on the first parse, not at import
+    from bigraph import parse
+    parse.grammars.clear()
+    parse.bigraph('ctrl A = 0;')
+    assert 'big' in parse.grammars
+
+
+def benchmark_import(modules=MODULES):
+    for module in modules:
+        seconds, loaded = import_time(module)
+        print(f'{module}: {seconds * 1000:.1f}ms, {len(loaded)} modules loaded')
+
+
+if __name__ == '__main__':
+    import fire
+    fire.Fire(benchmark_import)
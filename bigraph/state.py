@@ -0,0 +1,378 @@
+
+from bigraph.bigraph import Base, Bigraph, Big, Control, Node, One, Id, Edge, EdgeGroup, Parallel, Merge, PARAMETER_SYMBOLS
+
+
+def is_site(term):
+    # the parser reads `id` and `1` as ordinary controls
+    if isinstance(term, Node):
+        return term.control.symbol == 'id'
+    return isinstance(term, Id)
+
+
+def is_one(term):
+    if isinstance(term, Node):
+        return term.control.symbol == '1'
+    return term is None or isinstance(term, One)
+
+
+def term_root(value):
+    if isinstance(value, Bigraph):
+        return value.roots
+    elif isinstance(value, Big):
+        return value.root
+    return value
+
+
+class State():
+    '''a flat, mutable index over the place and link graphs of a ground
+    bigraph. nodes are integer ids, and a place is either a node id or a
+    region, which is represented by a negative id `-(region + 1)`'''
+
+    def __init__(self, controls=None):
+        self.controls = controls or {}
+        self.control = {}
+        self.params = {}
+        self.ports = {}
+        self.parent = {}
+        self.children = {}
+        self.grouped = {}
+        self.regions = []
+        self.index = {}
+        self.links = {}
+        self.names = {}
+        self.next_id = 0
+
+    @classmethod
+    def from_term(cls, term, controls=None):
+        state = cls(controls=dict(controls or {}))
+        term = term_root(term)
+        if isinstance(term, Parallel):
+            for part in term.parallel:
+                state.add_term(part, state.add_region())
+        else:
+            state.add_term(term, state.add_region())
+        return state
+
+    def copy(self):
+        state = State(controls=self.controls)
+        state.control = self.control.copy()
+        state.params = self.params.copy()
+        state.ports = self.ports.copy()
+        state.parent = self.parent.copy()
+        state.children = {
+            place: children.copy()
+            for place, children in self.children.items()}
+        state.grouped = {
+            place: {
+                symbol: ids.copy()
+                for symbol, ids in groups.items()}
+            for place, groups in self.grouped.items()}
+        state.regions = self.regions[:]
+        state.index = {
+            symbol: ids.copy()
+            for symbol, ids in self.index.items()}
+        state.links = {
+            name: ports.copy()
+            for name, ports in self.links.items()}
+        state.names = self.names.copy()
+        state.next_id = self.next_id
+        return state
+
+    def __len__(self):
+        return len(self.control)
+
+    def add_region(self):
+        place = -(len(self.regions) + 1)
+        self.regions.append(place)
+        self.children[place] = {}
+        self.grouped[place] = {}
+        return place
+
+    def add_node(self, place, symbol, params=(), ports=()):
+        id = self.next_id
+        self.next_id += 1
+        self.control[id] = symbol
+        self.params[id] = tuple(params)
+        self.ports[id] = tuple(ports)
+        self.children[id] = {}
+        self.grouped[id] = {}
+        self.attach(id, place)
+        if symbol not in self.index:
+            self.index[symbol] = {}
+        self.index[symbol][id] = None
+        for name in ports:
+            self.link(name, id)
+        return id
+
+    def fresh_name(self, name, taken=()):
+        ''' `name`, or `name` numbered, such that no node or outer name of this state uses it '''
+        fresh = name
+        count = 0
+        while fresh in self.links or fresh in self.names or fresh in taken:
+            count += 1
+            fresh = f'{name}{count}'
+        return fresh
+
+    def link(self, name, id):
+        if name not in self.links:
+            self.links[name] = {}
+        ports = self.links[name]
+        ports[id] = ports.get(id, 0) + 1
+
+    def unlink(self, name, id):
+        ports = self.links[name]
+        count = ports[id] - 1
+        if count > 0:
+            ports[id] = count
+        else:
+            del ports[id]
+            if not ports:
+                del self.links[name]
+
+    def add_term(self, term, place):
+        if is_one(term):
+            return []
+        elif is_site(term):
+            raise Exception(f'cannot add a site to a ground state: {term.render()}')
+        elif isinstance(term, Node):
+            symbol = term.control.symbol
+            if symbol not in self.controls:
+                self.controls[symbol] = term.control
+            ports = [
+                edge.symbol
+                for edge in term.ports.edges]
+            id = self.add_node(place, symbol, term.params, ports)
+            self.add_term(term.subnodes, id)
+            return [id]
+        elif isinstance(term, Merge):
+            ids = []
+            for part in term.parts:
+                ids.extend(self.add_term(part, place))
+            return ids
+        elif isinstance(term, EdgeGroup):
+            for edge in term.edges:
+                self.names[edge.symbol] = None
+            return []
+        elif isinstance(term, Edge):
+            self.names[term.symbol] = None
+            return []
+        else:
+            raise Exception(f'cannot add term {term} to a state')
+
+    def remove_node(self, id):
+        ''' remove a single node. its children must already be gone '''
+        if self.parent[id] is not None:
+            self.detach(id)
+        del self.parent[id]
+        del self.children[id]
+        del self.grouped[id]
+        symbol = self.control.pop(id)
+        del self.index[symbol][id]
+        for name in self.ports.pop(id):
+            self.unlink(name, id)
+        del self.params[id]
+
+    def remove_subtree(self, id, removed=None):
+        ''' remove a node with everything inside it, returning the removed ids '''
+        removed = [] if removed is None else removed
+        for child in list(self.children[id]):
+            self.remove_subtree(child, removed)
+        self.remove_node(id)
+        removed.append(id)
+        return removed
+
+    def move(self, id, place):
+        self.detach(id)
+        self.attach(id, place)
+
+    def detach(self, id):
+        place = self.parent[id]
+        del self.children[place][id]
+        groups = self.grouped[place]
+        symbol = self.control[id]
+        del groups[symbol][id]
+        if not groups[symbol]:
+            del groups[symbol]
+        self.parent[id] = None
+
+    def attach(self, id, place):
+        self.parent[id] = place
+        self.children[place][id] = None
+        groups = self.grouped[place]
+        symbol = self.control[id]
+        if symbol in groups:
+            groups[symbol][id] = None
+        else:
+            groups[symbol] = {id: None}
+
+    def copy_subtree(self, id, place):
+        copy = self.add_node(
+            place,
+            self.control[id],
+            self.params[id],
+            self.ports[id])
+        for child in self.children[id]:
+            self.copy_subtree(child, copy)
+        return copy
+
+    def rename(self, id, ports):
+        for name in self.ports[id]:
+            self.unlink(name, id)
+        self.ports[id] = tuple(ports)
+        for name in ports:
+            self.link(name, id)
+
+    def ancestors(self, place):
+        while place is not None and place >= 0:
+            place = self.parent[place]
+            yield place
+
+    def descendants(self, id):
+        stack = list(self.children[id])
+        while stack:
+            node = stack.pop()
+            yield node
+            stack.extend(self.children[node])
+
+    def nodes_with(self, symbol):
+        return self.index.get(symbol, {})
+
+    def node_control(self, id):
+        symbol = self.control[id]
+        original = self.controls.get(symbol)
+        params = self.params[id]
+        fun = list(original.fun) if original and original.fun else []
+        if len(fun) < len(params):
+            fun.extend(PARAMETER_SYMBOLS[len(fun):len(params)])
+        return Control(
+            symbol=symbol,
+            arity=len(self.ports[id]),
+            atomic=original.atomic if original else False,
+            fun=fun)
+
+    def node_term(self, id):
+        node = Node(
+            control=self.node_control(id),
+            params=list(self.params[id]),
+            ports=[
+                Edge(symbol=name)
+                for name in self.ports[id]])
+        children = self.children[id]
+        if children:
+            node.nest(self.place_term(children))
+        return node
+
+    def place_term(self, children):
+        parts = [
+            self.node_term(child)
+            for child in children]
+        if len(parts) == 1:
+            return parts[0]
+        elif len(parts) == 0:
+            return One()
+        return Merge(parts)
+
+    def to_term(self):
+        ''' build a tree of `Node`, `Merge` and `Parallel` from this state '''
+        regions = [
+            self.place_term(self.children[region])
+            for region in self.regions]
+        if len(regions) == 1:
+            return regions[0]
+        return Parallel(regions)
+
+    def render(self):
+        return self.to_term().render()
+
+    def canonical_place(self, place, names=None):
+        children = sorted(
+            self.canonical_node(child, names)
+            for child in self.children[place])
+        return ' | '.join(children)
+
+    def canonical_node(self, id, names=None):
+        render = self.control[id]
+        params = self.params[id]
+        if params:
+            render = f'{render}({",".join(str(param) for param in params)})'
+        ports = self.ports[id]
+        if ports:
+            if names is not None:
+                ports = [names.get(name, name) for name in ports]
+            render = f'{render}{{{",".join(ports)}}}'
+        if self.children[id]:
+            render = f'{render}.({self.canonical_place(id, names)})'
+        return render
+
+    def canonical(self, names=None):
+        ''' a rendering that does not depend on the order of siblings, with links renamed by `names` '''
+        return ' || '.join(
+            self.canonical_place(region, names)
+            for region in self.regions)
+
+    def canonical_names(self):
+        '''a new name for each link but the outer names, numbered in the
+        order the links first appear when siblings are sorted by how they
+        render without them. states equal up to renaming those links mostly
+        get the same names, and states given the same `canonical` rendering
+        by them are always equal up to renaming'''
+        keys = {}
+
+        def key(id):
+            ports = ','.join(
+                name if name in self.names else '_'
+                for name in self.ports[id])
+            children = sorted(key(child) for child in self.children[id])
+            keys[id] = f'{self.control[id]}{self.params[id]}{{{ports}}}({" | ".join(children)})'
+            return keys[id]
+
+        names = {}
+        pending = []
+        for region in reversed(self.regions):
+            pending.extend(sorted(self.children[region], key=key, reverse=True))
+        while pending:
+            id = pending.pop()
+            for name in self.ports[id]:
+                if name not in self.names and name not in names:
+                    names[name] = f'~{len(names)}'
+            pending.extend(sorted(self.children[id], key=keys.get, reverse=True))
+        return names
+
+    def __repr__(self):
+        return self.render()
+
+
+def test_state():
+    from bigraph.parse import bigraph
+
+    source = 'A{a}.Snd.(M{a, v_a} | Ready.Fun.1) | A{b}.Snd.M{a, v_b} | Mail.1'
+    state = State.from_term(bigraph(source))
+    assert len(state) == 9
+    assert len(state.nodes_with('Snd')) == 2
+    assert sum(state.links['a'].values()) == 3
+    assert state.render() == 'A{a}.Snd.(M{a,v_a} | Ready.Fun) | A{b}.Snd.M{a,v_b} | Mail'
+
+    swapped = State.from_term(bigraph('Mail.1 | A{b}.Snd.M{a, v_b} | A{a}.Snd.(Ready.Fun.1 | M{a, v_a})'))
+    assert swapped.canonical() == state.canonical()
+    assert swapped.render() != state.render()
+
+    # links named apart are the same up to renaming, but not how they are shared
+    def renamed(source):
+        linked = State.from_term(bigraph(source))
+        return linked.canonical(linked.canonical_names())
+    assert renamed('L{x} | A.(L{x1} | L{x1})') == renamed('L{y} | A.(L{x} | L{x})')
+    assert renamed('A{a} | B{a} | C{b}') == renamed('C{a} | B{b} | A{b}')
+    assert renamed('A{a} | B{a} | C{b}') != renamed('A{a} | B{b} | C{b}')
+
+    copied = state.copy()
+    mail = list(copied.nodes_with('Mail'))[0]
+    fun = list(copied.nodes_with('Fun'))[0]
+    copied.move(fun, mail)
+    copied.remove_subtree(list(copied.nodes_with('Ready'))[0])
+    assert copied.render() == 'A{a}.Snd.M{a,v_a} | A{b}.Snd.M{a,v_b} | Mail.Fun'
+    assert state.render() == 'A{a}.Snd.(M{a,v_a} | Ready.Fun) | A{b}.Snd.M{a,v_b} | Mail'
+
+
+if __name__ == '__main__':
+    import fire
+    fire.Fire(test_state)
@@ -0,0 +1,290 @@
+import time
+import shutil
+
+from bigraph.engine import Simulator
+
+
+class SumTree():
+    '''a complete binary tree of non-negative weights where each inner node
+    holds the sum of its children, so updating a weight and finding the leaf
+    a uniform draw falls in both take O(log n)'''
+
+    def __init__(self, size):
+        self.size = size
+        self.capacity = 1
+        while self.capacity < max(size, 1):
+            self.capacity *= 2
+        self.tree = [0.0] * (2 * self.capacity)
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, index):
+        return self.tree[self.capacity + index]
+
+    def update(self, index, weight):
+        position = self.capacity + index
+        self.tree[position] = weight
+        position //= 2
+        while position >= 1:
+            self.tree[position] = self.tree[2 * position] + self.tree[2 * position + 1]
+            position //= 2
+
+    def total(self):
+        return self.tree[1]
+
+    def find(self, value):
+        ''' the index of the leaf whose cumulative range contains `value` '''
+        position = 1
+        while position < self.capacity:
+            left = self.tree[2 * position]
+            if value < left or self.tree[2 * position + 1] <= 0.0:
+                position = 2 * position
+            else:
+                value -= left
+                position = 2 * position + 1
+        return position - self.capacity
+
+
+class StochasticSimulator(Simulator):
+    '''simulate an `sbrs` system in continuous time with the exact stochastic
+    simulation algorithm.
+
+    the propensity of each rule is its rate, the first parameter of its
+    arrow `-[rate]->`, times its number of occurrences. propensities are kept
+    in a `SumTree` per priority class and only the rules whose occurrences
+    changed in the last rewrite are updated. reducible classes are applied
+    instantaneously as in `Simulator`, and each step draws the waiting time
+    and the event from the first standard class with a positive total'''
+
+    def __init__(self, brs, seed=None, state=None):
+        super().__init__(brs, seed=seed, state=state, incremental=True)
+        self.rates = [
+            rule.rate()
+            for rule in self.rules]
+        for rule, rate in zip(self.rules, self.rates):
+            if rate < 0:
+                raise Exception(f'reaction {rule.label()} has negative rate {rate}')
+
+        self.trees = []
+        self.positions = {}
+        for reducible, indexes in self.groups:
+            tree = SumTree(len(indexes))
+            self.trees.append(tree)
+            for position, index in enumerate(indexes):
+                self.positions[index] = (tree, position)
+
+        self.time = 0.0
+        self.times = []
+        self.store.changed = set(range(len(self.rules)))
+        self.propensities()
+
+    def propensity(self, index):
+        return self.rates[index] * self.store.count(index)
+
+    def propensities(self):
+        for index in self.store.changed:
+            tree, position = self.positions[index]
+            tree.update(position, self.propensity(index))
+        self.store.changed.clear()
+
+    def reduce(self):
+        super().reduce()
+        self.propensities()
+
+    def next_event(self):
+        '''the waiting time and the rule index of the next event, drawn from
+        the first standard class with positive total propensity'''
+        for (reducible, indexes), tree in zip(self.groups, self.trees):
+            if reducible:
+                continue
+            total = tree.total()
+            if total > 0.0:
+                delay = self.random.expovariate(total)
+                position = tree.find(self.random.random() * total)
+                return delay, indexes[min(position, len(indexes) - 1)]
+        return None
+
+    def step(self, horizon=None):
+        ''' advance one event, returning the applied rule or `None` '''
+        self.reduce()
+        event = self.next_event()
+        if event is None:
+            return None
+        delay, index = event
+        if horizon is not None and self.time + delay > horizon:
+            self.time = horizon
+            return None
+        self.time += delay
+        count = self.store.count(index)
+        match = self.store.matches[index].at(self.random.randrange(count))
+        rule = self.apply(index, match)
+        self.reduce()
+        return rule
+
+    def run(self, steps=None, horizon=None, terms=True):
+        '''simulate up to `steps` events, until the simulated time passes
+        `horizon`, or until no rule applies. returns the trajectory as
+        `(time, state)` pairs starting at time zero'''
+
+        self.reduce()
+        history = [(self.time, self.state.to_term() if terms else self.state.copy())]
+        self.times = [self.time]
+        count = 0
+        while steps is None or count < steps:
+            rule = self.step(horizon=horizon)
+            if rule is None:
+                break
+            self.transitions.append((count, count + 1, rule.label()))
+            self.times.append(self.time)
+            history.append((self.time, self.state.to_term() if terms else self.state.copy()))
+            count += 1
+        return history
+
+
+def simulate_stochastic(brs, steps=None, horizon=None, seed=None, terms=True):
+    return StochasticSimulator(brs, seed=seed).run(steps=steps, horizon=horizon, terms=terms)
+
+
+FLIP = '''
+ctrl A = 0;
+ctrl B = 0;
+
+react ab =
+    A
+    -[3.0]->
+    B;
+
+react ba =
+    B
+    -[1.0]->
+    A;
+
+big initial = A.1;
+
+begin sbrs
+    init initial;
+    rules = [
+        {ab, ba}
+    ];
+end
+'''
+
+
+BRANCH = '''
+ctrl A = 0;
+ctrl B = 0;
+ctrl C = 0;
+
+react ab =
+    A
+    -[3.0]->
+    B;
+
+react ac =
+    A
+    -[1.0]->
+    C;
+
+big initial = A.1;
+
+begin sbrs
+    init initial;
+    rules = [
+        {ab, ac}
+    ];
+end
+'''
+
+
+def test_sum_tree():
+    tree = SumTree(5)
+    for index, weight in enumerate([1.0, 0.0, 2.0, 0.0, 1.0]):
+        tree.update(index, weight)
+    assert tree.total() == 4.0
+    assert [tree.find(value) for value in [0.0, 0.99, 1.0, 2.5, 3.0, 3.99]] == [0, 0, 2, 2, 4, 4]
+    tree.update(2, 0.0)
+    assert tree.total() == 2.0
+    assert tree.find(1.5) == 4
+
+
+def test_stochastic_simulator():
+    from bigraph.parse import bigraph
+    from bigraph.metabolism import Metabolism
+
+    # a two state chain spends a quarter of its time in A at equilibrium
+    flip = bigraph(FLIP)
+    horizon = 2000.0
+    trajectory = simulate_stochastic(flip, horizon=horizon, seed=1)
+    assert all(
+        before[0] < after[0]
+        for before, after in zip(trajectory, trajectory[1:]))
+    assert trajectory[-1][0] <= horizon
+    assert all(state.render() in ('A', 'B') for _, state in trajectory)
+
+    in_a = 0.0
+    holding = []
+    times = [time for time, _ in trajectory] + [horizon]
+    for (time, state), end in zip(trajectory, times[1:]):
+        if state.render() == 'A':
+            in_a += end - time
+            holding.append(end - time)
+    assert abs(in_a / horizon - 0.25) < 0.03
+    assert abs(sum(holding) / len(holding) - 1 / 3.0) < 0.03
+
+    branch = bigraph(BRANCH)
+    ends = [
+        simulate_stochastic(branch, seed=seed)[-1][1].render()
+        for seed in range(400)]
+    assert abs(ends.count('B') / len(ends) - 0.75) < 0.06
+
+    # every B in Metabolism can react, so time always advances
+    metabolism = Metabolism().brs
+    simulator = StochasticSimulator(metabolism, seed=2)
+    trajectory = simulator.run(steps=100, terms=False)
+    assert len(trajectory) == 101
+    assert len(simulator.transitions) == 100
+    assert simulator.times == [time for time, _ in trajectory]
+
+
+def test_bigrapher_agreement(tmp_path, executable='bigrapher', runs=1000):
+    import pytest
+    from bigraph.parse import bigraph
+    from bigraph.state import State
+
+    if shutil.which(executable) is None:
+        pytest.skip(f'{executable} not found')
+
+    # from A, ab fires three times as often as ac
+    branch = bigraph(BRANCH)
+    branch.executable = executable
+    expected = 0
+    for run in range(runs):
+        history = branch.simulate(path=tmp_path, steps=1, format='json')
+        expected += State.from_term(history[-1]).render() == 'B'
+
+    native = 0
+    for run in range(runs):
+        trajectory = simulate_stochastic(branch, steps=1, seed=run)
+        native += trajectory[-1][1].render() == 'B'
+
+    # each count is binomial, so it is within four standard deviations of
+    # three in four runs but for one test in about sixteen thousand
+    bound = 4 * (0.75 * 0.25 / runs) ** 0.5
+    assert abs(expected / runs - 0.75) < bound
+    assert abs(native / runs - 0.75) < bound
+
+
+def benchmark_stochastic(steps=1000):
+    from bigraph.metabolism import Metabolism
+
+    metabolism = Metabolism().brs
+    start = time.perf_counter()
+    trajectory = simulate_stochastic(metabolism, steps=steps, seed=1, terms=False)
+    elapsed = time.perf_counter() - start
+    print(f'{len(trajectory) - 1} events to time {trajectory[-1][0]:.3f} in {elapsed:.3f}s')
+
+
+if __name__ == '__main__':
+    import fire
+    fire.Fire(benchmark_stochastic)
@@ -0,0 +1,223 @@
+import re
+import json
+import time
+
+
+# bigrapher writes a state as text in three parts: the nodes as
+# `{(0, A:0),(1, B(3):1)}`, the place graph as a line `roots nodes sites`
+# followed by a row of 0s and 1s for each root and each node, and then a
+# line `({inner}, {outer}, {(node, ports)})` for each link
+NODE = re.compile(r'\((\d+), ([^\s:(),]+)(?:\(([^)]*)\))?:(\d+)\)')
+LINK = re.compile(r'\(\{([^}]*)\}, \{([^}]*)\}, \{(.*)\}\)')
+PORT = re.compile(r'\((\d+), (\d+)\)')
+
+
+def parse_param(param):
+    param = param.strip()
+    try:
+        return {'ctrl_int': int(param)}
+    except ValueError:
+        pass
+    try:
+        return {'ctrl_float': float(param)}
+    except ValueError:
+        return {'ctrl_string': param.strip('"')}
+
+
+def parse_names(names):
+    return [
+        {'name': name.strip()}
+        for name in names.split(',')
+        if name.strip()]
+
+
+def parse_nodes(line):
+    return [
+        {'node_id': int(node), 'control': {
+            'ctrl_name': name,
+            'ctrl_arity': int(arity),
+            'ctrl_params': [parse_param(param) for param in params.split(',')] if params else []}}
+        for node, name, params, arity in NODE.findall(line)]
+
+
+def parse_state(text):
+    '''the spec of a state in bigrapher's text output, in the shape of its
+    json output, so `Base.from_spec` reads either'''
+
+    lines = text.split('\n')
+    nodes = parse_nodes(lines[0])
+    roots, count, sites = [int(size) for size in lines[1].split()]
+
+    rn, nn, ns = [], [], []
+    for row in range(roots + count):
+        # the rows are mostly 0s, so jump from one 1 to the next
+        line = lines[2 + row]
+        column = line.find('1')
+        while column >= 0:
+            if column < count:
+                if row < roots:
+                    rn.append({'source': row, 'target': column})
+                else:
+                    nn.append({'source': row - roots, 'target': column})
+            else:
+                ns.append({'source': row - roots, 'target': column - count})
+            column = line.find('1', column + 1)
+
+    links = []
+    for line in lines[2 + roots + count:]:
+        match = LINK.match(line)
+        if match is None:
+            continue
+        inner, outer, ports = match.groups()
+        links.append({
+            'inner': parse_names(inner),
+            'outer': parse_names(outer),
+            'ports': [
+                {'node_id': int(node), 'port_arity': int(arity)}
+                for node, arity in PORT.findall(ports)]})
+
+    return {
+        'nodes': nodes,
+        'place_graph': {
+            'num_regions': roots,
+            'num_nodes': count,
+            'num_sites': sites,
+            'rn': rn,
+            'nn': nn,
+            'ns': ns},
+        'link_graph': links}
+
+
+def count_controls(text):
+    ''' how many nodes of each control a state has, read from the first line of its text alone '''
+    counts = {}
+    for node, name, params, arity in NODE.findall(text[:text.find('\n')] if '\n' in text else text):
+        counts[name] = counts.get(name, 0) + 1
+    return counts
+
+
+def count_spec(spec):
+    counts = {}
+    for node in spec['nodes']:
+        name = node['control']['ctrl_name']
+        counts[name] = counts.get(name, 0) + 1
+    return counts
+
+
+def format_param(param):
+    kind, value = list(param.items())[0]
+    if kind == 'ctrl_string':
+        return f'"{value}"'
+    return str(value)
+
+
+def format_state(spec):
+    ''' a state spec as bigrapher's text output, the inverse of `parse_state` '''
+    nodes = ','.join([
+        '({}, {}{}:{})'.format(
+            node['node_id'],
+            node['control']['ctrl_name'],
+            '({})'.format(','.join([format_param(param) for param in node['control']['ctrl_params']])) if node['control']['ctrl_params'] else '',
+            node['control']['ctrl_arity'])
+        for node in spec['nodes']])
+
+    place = spec['place_graph']
+    roots, count, sites = place['num_regions'], place['num_nodes'], place['num_sites']
+    rows = [['0'] * (count + sites) for row in range(roots + count)]
+    for edge in place['rn']:
+        rows[edge['source']][edge['target']] = '1'
+    for edge in place['nn']:
+        rows[roots + edge['source']][edge['target']] = '1'
+    for edge in place['ns']:
+        rows[roots + edge['source']][count + edge['target']] = '1'
+
+    links = [
+        '({{{}}}, {{{}}}, {{{}}})'.format(
+            ', '.join([name['name'] for name in link['inner']]),
+            ', '.join([name['name'] for name in link['outer']]),
+            ', '.join([f"({port['node_id']}, {port['port_arity']})" for port in link['ports']]))
+        for link in spec['link_graph']]
+
+    return '\n'.join(
+        ['{' + nodes + '}', f'{roots} {count} {sites}']
+        + [''.join(row) for row in rows]
+        + links) + '\n'
+
+
+def test_text():
+    from bigraph.bigraph import Base
+
+    spec = {
+        'nodes': [
+            {'node_id': 0, 'control': {'ctrl_name': 'Cell', 'ctrl_arity': 0, 'ctrl_params': []}},
+            {'node_id': 1, 'control': {'ctrl_name': 'A', 'ctrl_arity': 1, 'ctrl_params': []}},
+            {'node_id': 2, 'control': {'ctrl_name': 'B', 'ctrl_arity': 1, 'ctrl_params': [{'ctrl_int': 3}, {'ctrl_float': 0.5}]}},
+            {'node_id': 3, 'control': {'ctrl_name': 'A', 'ctrl_arity': 1, 'ctrl_params': []}}],
+        'place_graph': {
+            'num_regions': 2, 'num_nodes': 4, 'num_sites': 1,
+            'rn': [{'source': 0, 'target': 0}, {'source': 1, 'target': 3}],
+            'nn': [{'source': 0, 'target': 1}, {'source': 0, 'target': 2}],
+            'ns': [{'source': 0, 'target': 0}]},
+        'link_graph': [
+            {'inner': [], 'outer': [{'name': 'x'}], 'ports': [{'node_id': 1, 'port_arity': 1}, {'node_id': 2, 'port_arity': 1}]},
+            {'inner': [], 'outer': [{'name': 'y'}], 'ports': [{'node_id': 3, 'port_arity': 1}]}]}
+
+    text = format_state(spec)
+    assert text.split('\n')[:3] == ['{(0, Cell:0),(1, A:1),(2, B(3,0.5):1),(3, A:1)}', '2 4 1', '10000']
+    assert parse_state(text) == spec
+    assert Base.from_spec(parse_state(text)).render() == Base.from_spec(json.loads(json.dumps(spec))).render()
+    assert count_controls(text) == count_spec(spec) == {'Cell': 1, 'A': 2, 'B': 1}
+
+
+def benchmark_text(states=2000, cells=20, path='out/test/text'):
+    import os
+    import shutil
+    from pathlib import Path
+    from bigraph.trajectory import decode_states
+
+    shutil.rmtree(path, ignore_errors=True)
+    Path(path).mkdir(parents=True, exist_ok=True)
+
+    # cells holding a few linked molecules each, as in the metabolism model
+    nodes, rn, nn, links = [], [], [], []
+    for cell in range(cells):
+        container = len(nodes)
+        nodes.append({'node_id': container, 'control': {'ctrl_name': 'Cell', 'ctrl_arity': 0, 'ctrl_params': []}})
+        rn.append({'source': 0, 'target': container})
+        for molecule in range(4):
+            nodes.append({'node_id': len(nodes), 'control': {'ctrl_name': 'ABCD'[molecule], 'ctrl_arity': 1, 'ctrl_params': []}})
+            nn.append({'source': container, 'target': len(nodes) - 1})
+        links.append({'inner': [], 'outer': [{'name': f'l{cell}'}], 'ports': [
+            {'node_id': container + 1, 'port_arity': 1},
+            {'node_id': container + 2, 'port_arity': 1}]})
+    spec = {
+        'nodes': nodes,
+        'place_graph': {'num_regions': 1, 'num_nodes': len(nodes), 'num_sites': 0, 'rn': rn, 'nn': nn, 'ns': []},
+        'link_graph': links}
+
+    for state in range(states):
+        with open(Path(path) / f'{state}.json', 'w') as state_file:
+            json.dump(spec, state_file)
+        with open(Path(path) / f'{state}.txt', 'w') as state_file:
+            state_file.write(format_state(spec))
+
+    for format in ('json', 'txt'):
+        paths = [Path(path) / f'{state}.{format}' for state in range(states)]
+        size = sum(os.path.getsize(state_path) for state_path in paths)
+
+        def best(counts):
+            times = []
+            for repeat in range(3):
+                start = time.perf_counter()
+                decode_states(paths, format=format, counts=counts)
+                times.append(time.perf_counter() - start)
+            return min(times)
+
+        trees = best(False)
+        counts = best(True)
+        print(f'{format}: {size} bytes, {states} states in {trees:.3f}s as bigraphs, {counts:.3f}s as counts')
+
+
+if __name__ == '__main__':
+    import fire
+    fire.Fire(benchmark_text)
@@ -0,0 +1,267 @@
+import os
+import json
+import time
+from pathlib import Path
+from collections import OrderedDict
+from collections.abc import Sequence
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+
+# decoded states kept by a trajectory between accesses
+CACHE_SIZE = 256
+
+# states decoded by one task of a prefetch
+PREFETCH_CHUNK = 64
+
+
+def decode_bytes(raw, format='json', counts=False):
+    '''the bigraph of a state written by bigrapher as json or text, or with
+    `counts` just how many nodes of each control it has'''
+    from bigraph.bigraph import Base
+    from bigraph.text import parse_state, count_controls, count_spec
+
+    if format == 'txt':
+        text = raw.decode('utf-8')
+        if counts:
+            return count_controls(text)
+        spec = parse_state(text)
+    else:
+        spec = json.loads(raw)
+    if counts:
+        return count_spec(spec)
+    return Base.from_spec(spec)
+
+
+def decode_state(path, format='json', counts=False):
+    with open(path, 'rb') as state_file:
+        return decode_bytes(state_file.read(), format=format, counts=counts)
+
+
+def decode_states(paths, format='json', counts=False):
+    return [decode_state(path, format=format, counts=counts) for path in paths]
+
+
+def decode_raw(raws, format='json'):
+    return [decode_bytes(raw, format=format) for raw in raws]
+
+
+class Trajectory(Sequence):
+    '''the states of a bigrapher run, read from `{path}/{id}.json` only when
+    they are asked for.
+
+    the most recently used `cache_size` states are kept decoded. `prefetch`
+    decodes a range of states on a pool of threads or processes ahead of
+    use, and `load` decodes them all into a list, which is needed before the
+    files go away. slicing returns a list of decoded states. `graph` is the
+    `graph.TransitionGraph` of the run the states come from, if known. with
+    an `archive.Archive` the states are read from it instead of from files,
+    and with `counts` each state is a dict of how many nodes of each control
+    it has rather than a bigraph, and `close`, or leaving a `with` block,
+    closes the archive. given an `intern.StateTable` as `table`, equal
+    states are the one object it shares'''
+
+    def __init__(self, path, ids, format='json', cache_size=CACHE_SIZE, graph=None, archive=None, counts=False, table=None):
+        self.path = Path(path)
+        self.ids = list(ids)
+        self.graph = graph
+        self.archive = archive
+        self.counts = counts
+        self.table = table if not counts else None
+        self.format = format
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [
+                self.state(position)
+                for position in range(*index.indices(len(self.ids)))]
+        if index < 0:
+            index += len(self.ids)
+        if index < 0 or index >= len(self.ids):
+            raise IndexError(f'state {index} out of range for a trajectory of {len(self.ids)} states')
+        return self.state(index)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+
+    def close(self):
+        ''' close the archive the states are read from, if any. decoded states stay cached '''
+        if self.archive is not None:
+            self.archive.close()
+
+    def __repr__(self):
+        return f'Trajectory({str(self.path)!r}, {len(self.ids)} states)'
+
+    def state_path(self, index):
+        return self.path / f'{self.ids[index]}.{self.format}'
+
+    def task(self, indexes):
+        ''' a function and its argument decoding the states at `indexes`, to hand to a pool '''
+        if self.archive is not None:
+            from bigraph.archive import decode_archived
+            return decode_archived, (str(self.archive.path), [self.ids[index] for index in indexes], self.counts)
+        return decode_states, ([self.state_path(index) for index in indexes], self.format, self.counts)
+
+    def remember(self, index, state):
+        self.cache[index] = state
+        self.cache.move_to_end(index)
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def state(self, index):
+        if index in self.cache:
+            self.cache.move_to_end(index)
+            return self.cache[index]
+        if self.format == 'svg':
+            return self.state_path(index)
+        if self.table is not None:
+            state = self.shared(index)
+        elif self.archive is not None:
+            state = self.archive.state(self.ids[index], counts=self.counts)
+        else:
+            state = decode_state(self.state_path(index), format=self.format, counts=self.counts)
+        self.remember(index, state)
+        return state
+
+    def raw(self, index):
+        if self.archive is not None:
+            return self.archive.state_bytes(self.ids[index])
+        with open(self.state_path(index), 'rb') as state_file:
+            return state_file.read()
+
+    def shared(self, index):
+        ''' the state at `index` from the table, only decoded if its bytes were not seen before '''
+        raw = self.raw(index)
+        state = self.table.lookup(raw)
+        if state is None:
+            state = self.table.intern(decode_bytes(raw, format=self.format), raw=raw)
+        return state
+
+    def prefetch(self, start=0, stop=None, workers=None, processes=False):
+        '''decode the states from `start` up to `stop` on `workers` threads, or
+        processes with `processes`, and return them. the last `cache_size` of
+        them stay cached'''
+
+        indexes = range(*slice(start, stop).indices(len(self.ids)))
+        if self.format == 'svg':
+            return [self.state_path(index) for index in indexes]
+
+        missing = [index for index in indexes if index not in self.cache]
+        decoded = {}
+
+        # states whose bytes the table has seen need no decoding
+        raws = {}
+        if self.table is not None:
+            unseen = []
+            for index in missing:
+                raw = self.raw(index)
+                state = self.table.lookup(raw)
+                if state is None:
+                    raws[index] = raw
+                    unseen.append(index)
+                else:
+                    decoded[index] = state
+            missing = unseen
+
+        if missing:
+            chunks = [
+                missing[position:position + PREFETCH_CHUNK]
+                for position in range(0, len(missing), PREFETCH_CHUNK)]
+            workers = workers or os.cpu_count() or 1
+            Executor = ProcessPoolExecutor if processes and len(chunks) > 1 else ThreadPoolExecutor
+            with Executor(max_workers=min(workers, len(chunks))) as pool:
+                futures = []
+                for chunk in chunks:
+                    if self.table is not None:
+                        function, arguments = decode_raw, ([raws[index] for index in chunk], self.format)
+                    else:
+                        function, arguments = self.task(chunk)
+                    futures.append(pool.submit(function, *arguments))
+                for chunk, future in zip(chunks, futures):
+                    decoded.update(zip(chunk, future.result()))
+            if self.table is not None:
+                for index in missing:
+                    decoded[index] = self.table.intern(decoded[index], raw=raws[index])
+
+        states = []
+        for index in indexes:
+            state = decoded[index] if index in decoded else self.cache[index]
+            states.append(state)
+        for index in indexes[-self.cache_size:]:
+            self.remember(index, decoded[index] if index in decoded else self.cache[index])
+        return states
+
+    def load(self, workers=None, processes=False):
+        ''' every state of the trajectory, decoded '''
+        return self.prefetch(workers=workers, processes=processes)
+
+
+def test_trajectory(tmp_path):
+    from bigraph.fake import fake_system
+
+    path = tmp_path
+    system = fake_system(path)
+    system.path = Path(path) / 'system'
+
+    # simulate hands back decoded states, which a later run leaves alone
+    earlier = system.simulate(steps=2, format='json')
+    system.simulate(steps=20, format='json')
+    assert isinstance(earlier, list) and [state.render() for state in earlier] == ['Step(0)', 'Step(1)', 'Step(2)']
+
+    trajectory = system.read()
+    assert isinstance(trajectory, Trajectory) and len(trajectory) == 21
+    assert not trajectory.graph.branching()
+    assert not trajectory.cache
+    assert trajectory[-1].render() == 'Step(20)'
+    assert list(trajectory.cache) == [20]
+    assert [state.render() for state in trajectory[2:5]] == ['Step(2)', 'Step(3)', 'Step(4)']
+
+    small = system.read(cache_size=4)
+    assert [state.render() for state in small.prefetch(5, 15, workers=2)] == [f'Step({step})' for step in range(5, 15)]
+    assert list(small.cache) == [11, 12, 13, 14]
+    assert [state.render() for state in small.load(workers=2, processes=True)] == [f'Step({step})' for step in range(21)]
+
+    # every fifth state, and the last three of those
+    assert [state.render() for state in system.read(stride=5)] == ['Step(0)', 'Step(5)', 'Step(10)', 'Step(15)', 'Step(20)']
+    assert [state.render() for state in system.read(stride=5, last_n=3)] == ['Step(10)', 'Step(15)', 'Step(20)']
+    assert [state.render() for state in system.read(last_n=2)] == ['Step(19)', 'Step(20)']
+
+    # bigrapher's text output reads to the same bigraphs, or straight to counts
+    system.simulate(steps=3, format=('json', 'txt'))
+    assert [state.render() for state in system.read(format='txt')] == [state.render() for state in system.read()]
+    assert list(system.read(format='txt', counts=True)) == [{'Step': 1}] * 4
+    assert system.read(counts=True)[-1] == {'Step': 1}
+
+
+def benchmark_trajectory(steps=10000, path='out/test/trajectory/benchmark'):
+    import shutil
+    from bigraph.fake import fake_system
+
+    shutil.rmtree(path, ignore_errors=True)
+    system = fake_system(path)
+    system.path = Path(path) / 'system'
+    system.simulate(steps=steps, format='json')
+
+    start = time.perf_counter()
+    system.read()[-1]
+    print(f'last state of {steps}: {time.perf_counter() - start:.3f}s')
+
+    start = time.perf_counter()
+    system.read().load(workers=1)
+    print(f'every state, one thread: {time.perf_counter() - start:.3f}s')
+
+    start = time.perf_counter()
+    system.read().load(processes=True)
+    print(f'every state, process pool: {time.perf_counter() - start:.3f}s')
+
+
+if __name__ == '__main__':
+    import fire
+    fire.Fire(benchmark_trajectory)
@@ -22,7 +22,11 @@ setup(
         'parsimonious',
         'networkx',
     ],
-    extras_require={'plotting': ['matplotlib>=2.2.0', 'jupyter']},
+    extras_require={
+        'plotting': ['matplotlib>=2.2.0', 'jupyter'],
+        'ensemble': ['numpy'],
+        'analysis': ['numpy', 'scipy'],
+        'counts': ['numpy', 'numba']},
     setup_requires=['pytest-runner', 'flake8'],
     tests_require=['pytest'],
     entry_points={